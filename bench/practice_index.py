@@ -0,0 +1,72 @@
+"""
+Замер отбора пользователей для вечерних напоминаний.
+
+Запуск из корня репозитория: python -m bench.practice_index
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from daily_practice.completions import PracticeCompletionIndex
+from daily_practice.schedule import get_moscow_time
+from utils import serializer
+
+
+def benchmark(users: int = 100_000, legacy_sample: int = 1_000) -> None:
+    """
+    Сравнение: прежний отбор (история каждого пользователя из заново
+    разобранного документа) и разность множеств по индексу.
+    """
+    today = get_moscow_time().date()
+    users_data = {}
+    for user_id in range(1, users + 1):
+        history = {}
+        for back in range(random.randint(0, 5)):
+            day = (today - timedelta(days=back)).isoformat()
+            history[day] = {"type": "daily_practice", "completed_at": f"{day}T12:00:00", "data": {}}
+        users_data[str(user_id)] = {"practice_history": history}
+    payload = serializer.dumps(users_data)
+    today_key = today.isoformat()
+
+    # Прежний путь: на каждого пользователя документ разбирается заново
+    sample = list(users_data)[:legacy_sample]
+    start = time.perf_counter()
+    for user_key in sample:
+        history = serializer.loads(payload).get(user_key, {}).get("practice_history", {})
+        max(history, default=None)
+    legacy = (time.perf_counter() - start) / len(sample) * users
+
+    # Новый путь: индекс за день и одна разность множеств
+    async def fill_index() -> PracticeCompletionIndex:
+        index = PracticeCompletionIndex()
+        for user_key, user_info in users_data.items():
+            if today_key in user_info["practice_history"]:
+                await index.mark_done(int(user_key), today)
+        return index
+
+    async def select_pending(index: PracticeCompletionIndex) -> tuple:
+        start = time.perf_counter()
+        all_users = {int(k) for k in users_data}
+        pending = all_users - await index.done_on(today)
+        return pending, time.perf_counter() - start
+
+    # Индекс читает и пишет документ через utils.storage — во временном каталоге
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            index = asyncio.run(fill_index())
+            pending, indexed = asyncio.run(select_pending(index))
+        finally:
+            os.chdir(cwd)
+
+    print(f"Пользователей: {users}, без практики сегодня: {len(pending)}")
+    print(f"  прежний отбор (оценка по {legacy_sample}): {legacy:10.1f} с")
+    print(f"  индекс + разность множеств:       {indexed * 1000:10.1f} мс")
+
+
+if __name__ == "__main__":
+    benchmark()
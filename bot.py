@@ -1,20 +1,21 @@
 import os
 import re
-import json
 import asyncio
 import logging
+import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiohttp import web
 
 from config.texts import *
@@ -41,8 +42,10 @@ logger = logging.getLogger(__name__)
 try:
     from stats.action_logger import log_action, get_global_stats, get_user_stats, handle_action_logger_command
     from stats.action_logger import format_global_report, format_user_report, ADMIN_ID as ACTION_ADMIN_ID
+    from stats.action_logger import action_queue
 except ImportError:
     log_action = None
+    action_queue = None
     get_global_stats = None
     get_user_stats = None
     format_global_report = None
@@ -52,10 +55,11 @@ except ImportError:
 
 # ==================== ИМПОРТЫ МОДУЛЕЙ ====================
 try:
-    from stats.user_stats import UserStats, update_stats
+    from stats.user_stats import UserStats, update_stats, stats_registry
 except ImportError:
     UserStats = None
     update_stats = None
+    stats_registry = None
     logger.warning("stats.user_stats не найден")
 
 try:
@@ -64,11 +68,31 @@ except ImportError:
     TreeProgress = None
 
 try:
-    from payment.yookassa_client import create_payment
+    from payment.yookassa_client import create_payment, get_payment, yookassa_api
 except ImportError:
     create_payment = None
-
-from yookassa import Payment, Configuration
+    get_payment = None
+    yookassa_api = None
+
+from utils.preferences import preferences
+from utils.locks import followup_locks, storage_locks
+from utils.atomic import fsync_batcher
+from utils.executor import run_io, loop_monitor, shutdown_executor
+from utils.storage import delete_document, delete_user_data, user_exists
+from utils.shared_state import create_fsm_storage, close_redis, counter_store, lease_lock
+from utils.timers import timer_service
+from utils.subscription_index import subscription_index
+from utils.reminder_buckets import (
+    reminder_buckets, parse_reminder_time, is_valid_timezone, user_reminder_settings, in_reminder_audience,
+    REMINDER_OFF
+)
+from scheduler import start_reminder_system, stop_reminder_system
+from utils.update_queue import update_queue, WEBHOOK_MODE
+from daily_practice.completions import practice_index
+from daily_practice.schedule import get_next_practice, complete_practice
+from payment.pending import pending_payments, STATUS_SUCCEEDED, STATUS_CANCELED
+from payment.notifications import client_ip, is_allowed_ip, notification_payment_id
+from payment.reconcile import payment_reconciler
 
 
 
@@ -76,6 +100,8 @@ from yookassa import Payment, Configuration
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 FREE_DAYS_LIMIT = 3
+# Срок аренды на применение платежа (несколько воркеров)
+PAYMENT_LOCK_TTL = 60
 ADMIN_ID = 5782224611  # Твой ID
 
 # ==================== СОСТОЯНИЯ ====================
@@ -93,24 +119,18 @@ class PaymentStates(StatesGroup):
 
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 TOKEN = os.getenv("BOT_TOKEN")
-storage = MemoryStorage()
+storage = create_fsm_storage()
 bot = Bot(token=TOKEN)
 dp = Dispatcher(storage=storage)
-active_timers = {}
 
 # ==================== ПРОВЕРКИ ДОСТУПА ====================
 
 
-async def get_user_status(user_id: int) -> dict:
-    """Получить статус пользователя"""
-    file_path = DATA_DIR / "user_preferences.json"
-    if not file_path.exists():
-        return {"is_paid": False, "registration_date": None}
-    
+async def get_user_status(user_id: int, user_data: Optional[dict] = None) -> dict:
+    """Получить статус пользователя (user_data — уже прочитанные настройки)"""
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        user_data = data.get(str(user_id), {})
+        if user_data is None:
+            user_data = await preferences.get_user(user_id)
         
         sub_end_str = user_data.get("subscription_end_date")
         is_paid = False
@@ -138,23 +158,8 @@ async def get_user_status(user_id: int) -> dict:
 
 async def update_user_status(user_id: int, key: str, value) -> None:
     """Обновить статус пользователя"""
-    file_path = DATA_DIR / "user_preferences.json"
-    data = {}
-    
-    if file_path.exists():
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except:
-            pass
-    
-    if str(user_id) not in data or not isinstance(data[str(user_id)], dict):
-        data[str(user_id)] = {}
-    
-    data[str(user_id)][key] = value
-    
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    async with storage_locks.user(user_id):
+        await preferences.set_value(user_id, key, value)
 
 
 async def is_premium(user_id: int) -> bool:
@@ -195,35 +200,79 @@ async def check_access(user_id: int) -> bool:
 
 async def activate_subscription(user_id: int, months: int = 1) -> datetime:
     """Активировать подписку"""
-    status = await get_user_status(user_id)
-    base_date = get_moscow_time()
-    
-    if status["is_paid"] and status["subscription_end_date"]:
-        try:
-            current_end = datetime.fromisoformat(status["subscription_end_date"])
-            if current_end > base_date:
-                base_date = current_end
-        except:
-            pass
-    
-    new_end = base_date + timedelta(days=30 * months)
-    await update_user_status(user_id, "subscription_end_date", new_end.isoformat())
+    # Чтение и запись под одной блокировкой, чтобы два продления не потеряли друг друга;
+    # аренда — то же между воркерами
+    async with storage_locks.user(user_id), lease_lock(f"subscription:{user_id}", ttl=PAYMENT_LOCK_TTL):
+        status = await get_user_status(user_id)
+        base_date = get_moscow_time()
+        
+        if status["is_paid"] and status["subscription_end_date"]:
+            try:
+                current_end = datetime.fromisoformat(status["subscription_end_date"])
+                if current_end > base_date:
+                    base_date = current_end
+            except:
+                pass
+        
+        new_end = base_date + timedelta(days=30 * months)
+        await update_user_status(user_id, "subscription_end_date", new_end.isoformat())
+        await subscription_index.update(user_id, new_end)
+        await schedule_subscription_expiry(user_id, new_end.timestamp())
     return new_end
 
 
+def subscription_timer_key(user_id: int) -> str:
+    return f"subscription:{user_id}"
+
+
+async def schedule_subscription_expiry(user_id: int, end_ts: float) -> None:
+    """Точный таймер на момент окончания подписки (переставляется при продлении)"""
+    await timer_service.schedule(subscription_timer_key(user_id), "subscription_expired", end_ts, user_id=user_id)
+
+
+async def on_subscription_expired(record: dict) -> None:
+    """Подписка закончилась: убираем из индекса и сообщаем пользователю"""
+    user_id = record["user_id"]
+    end_ts = await subscription_index.get(user_id)
+    # Продлили после постановки таймера — ждём нового срока
+    if end_ts is not None and end_ts > datetime.now().timestamp() + 1:
+        return
+    await subscription_index.remove(user_id)
+    logger.info(f"Подписка пользователя {user_id} закончилась")
+    
+    await bot.send_message(
+        chat_id=user_id,
+        text="Подписка закончилась. Дерево и статистика сохранены — продли доступ, чтобы продолжить.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Продлить подписку", callback_data="pay_unlock")]
+        ])
+    )
+
+
+timer_service.register("subscription_expired", on_subscription_expired)
+
+
+async def restore_subscription_timers() -> int:
+    """Поставить таймеры окончания для активных подписок, у которых их нет (память, перезапуск)"""
+    restored = 0
+    for user_id, end_ts in await subscription_index.active_after(get_moscow_time()):
+        if not timer_service.has(subscription_timer_key(user_id)):
+            await schedule_subscription_expiry(user_id, end_ts)
+            restored += 1
+    return restored
+
+
 # ==================== СТАТИСТИКА ====================
 
 # ==================== СТАТИСТИКА ====================
 
-async def get_today_stats(user_id: int) -> dict:
-    """Статистика за сегодня"""
-    file_path = DATA_DIR / "user_preferences.json"
+async def get_today_stats(user_id: int, user_data: Optional[dict] = None) -> dict:
+    """Статистика за сегодня (user_data — уже прочитанные настройки)"""
     saved_minutes = 0
     
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        user_data = data.get(str(user_id), {})
+        if user_data is None:
+            user_data = await preferences.get_user(user_id)
         
         # Используем московское время
         today = get_moscow_time().date().isoformat()
@@ -238,7 +287,7 @@ async def get_today_stats(user_id: int) -> dict:
     conscious_count = 0
     if UserStats:
         try:
-            stats = UserStats(user_id)
+            stats = await stats_registry.get(user_id)
             stats_data = await stats.get_stats("today")
             conscious_count = stats_data.get("events_count", {}).get("conscious_stop", 0)
         except:
@@ -251,8 +300,6 @@ async def get_today_stats(user_id: int) -> dict:
 
 async def get_full_stats(user_id: int) -> dict:
     """Полная статистика (премиум)"""
-    file_path = DATA_DIR / "user_preferences.json"
-    
     # Значения по умолчанию
     saved_minutes = 0
     total_saved = 0
@@ -260,9 +307,7 @@ async def get_full_stats(user_id: int) -> dict:
     month_saved = 0
     
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        user_data = data.get(str(user_id), {})
+        user_data = await preferences.get_user(user_id)
         
         today = get_moscow_time().date().isoformat()
         if user_data.get("saved_date") == today:
@@ -283,15 +328,14 @@ async def get_full_stats(user_id: int) -> dict:
         }
     
     try:
-        stats = UserStats(user_id)
+        stats = await stats_registry.get(user_id)
         
-        today_data = await stats.get_stats("today")
-        week_data = await stats.get_stats("week")
-        month_data = await stats.get_stats("month")
+        # Все периоды за одну загрузку
+        counts = await stats.get_period_counts()
         
-        today_count = today_data.get("events_count", {}).get("conscious_stop", 0)
-        week_count = week_data.get("events_count", {}).get("conscious_stop", 0)
-        month_count = month_data.get("events_count", {}).get("conscious_stop", 0)
+        today_count = counts["today"].get("conscious_stop", 0)
+        week_count = counts["week"].get("conscious_stop", 0)
+        month_count = counts["month"].get("conscious_stop", 0)
         
         days = await get_usage_days(user_id)
         
@@ -320,26 +364,94 @@ async def get_full_stats(user_id: int) -> dict:
             "week_avg": 0, "month_avg": 0
         }
         
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ====================
+
+class UserContext:
+    """
+    Данные пользователя на время обработки одного обновления.
+    
+    Настройки, статус и статистика за сегодня вычисляются при первом
+    обращении и дальше берутся из объекта, так что проверка премиума,
+    текст меню и клавиатура в одном обработчике не повторяют одну и ту же
+    работу. Если обработчик меняет подписку или статистику, а потом снова
+    читает их, нужно вызвать invalidate().
+    """
+    
+    __slots__ = ("user_id", "_user_data", "_status", "_today")
+    
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._user_data: Optional[dict] = None
+        self._status: Optional[dict] = None
+        self._today: Optional[dict] = None
+    
+    async def user_data(self) -> dict:
+        if self._user_data is None:
+            self._user_data = await preferences.get_user(self.user_id)
+        return self._user_data
+    
+    async def status(self) -> dict:
+        if self._status is None:
+            self._status = await get_user_status(self.user_id, await self.user_data())
+        return self._status
+    
+    async def is_premium(self) -> bool:
+        return (await self.status()).get("is_paid", False)
+    
+    async def today_stats(self) -> dict:
+        if self._today is None:
+            self._today = await get_today_stats(self.user_id, await self.user_data())
+        return self._today
+    
+    def invalidate(self) -> None:
+        """Сбросить прочитанное (после изменения настроек или статистики)"""
+        self._user_data = None
+        self._status = None
+        self._today = None
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Передаёт обработчикам UserContext пользователя в аргументе user_ctx"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            data["user_ctx"] = UserContext(user.id)
+        return await handler(event, data)
+
+
+dp.message.middleware(UserContextMiddleware())
+dp.callback_query.middleware(UserContextMiddleware())
+
+
 # ==================== МЕНЮ ====================
 
-async def get_main_menu(user_id: int) -> InlineKeyboardMarkup:
+async def get_main_menu(user_id: int, ctx: Optional[UserContext] = None) -> InlineKeyboardMarkup:
     """Главное меню"""
-    if await is_premium(user_id):
+    ctx = ctx or UserContext(user_id)
+    if await ctx.is_premium():
         return menu_with_sub()
     return menu_no_sub()
 
 
-async def get_start_menu(user_id: int) -> InlineKeyboardMarkup:
+async def get_start_menu(user_id: int, ctx: Optional[UserContext] = None) -> InlineKeyboardMarkup:
     """Стартовое меню"""
-    if await is_premium(user_id):
+    ctx = ctx or UserContext(user_id)
+    if await ctx.is_premium():
         return menu_start_with_sub()
     return menu_start_no_sub()
 
 
-async def get_menu_text(user_id: int) -> str:
+async def get_menu_text(user_id: int, ctx: Optional[UserContext] = None) -> str:
     """Текст меню с цифрами"""
-    stats = await get_today_stats(user_id)
-    is_prem = await is_premium(user_id)
+    ctx = ctx or UserContext(user_id)
+    stats = await ctx.today_stats()
+    is_prem = await ctx.is_premium()
     
     if is_prem:
         return MENU_WITH_SUB.format(count=stats["count"], saved_time=stats["saved_time"])
@@ -348,28 +460,111 @@ async def get_menu_text(user_id: int) -> str:
 
 # ==================== ТАЙМЕР ====================
 
-async def quick_pause_timer_with_finish(user_id: int, minutes: int, bot_instance: Bot):
-    """Фоновая задача: ждёт время и напоминает"""
-    try:
-        await asyncio.sleep(minutes * 60)
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Я закончил", callback_data="qp_finish"),
-                InlineKeyboardButton(text="Я остаюсь", callback_data="qp_timer_stay_action")
-            ]
-        ])
-        
-        await bot_instance.send_message(
-            chat_id=user_id,
-            text=f"Твои {minutes} минут прошли.\n\nТы всё ещё в приложении?",
-            reply_markup=keyboard
-        )
-    except asyncio.CancelledError:
-        pass
-    finally:
-        if user_id in active_timers:
-            del active_timers[user_id]
+def quick_pause_timer_key(user_id: int) -> str:
+    return f"quick_pause:{user_id}"
+
+
+def timer_counters_key() -> str:
+    """Счётчики таймеров за сегодня — по московской дате, как остальная статистика."""
+    return f"timers:{get_moscow_time().date().isoformat()}"
+
+
+async def on_quick_pause_timer(record: dict) -> None:
+    """Срок Quick Pause вышел: спрашиваем, закончил ли пользователь"""
+    user_id = record["user_id"]
+    minutes = record["minutes"]
+    await counter_store.incr(timer_counters_key(), "fired")
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Я закончил", callback_data="qp_finish"),
+            InlineKeyboardButton(text="Я остаюсь", callback_data="qp_timer_stay_action")
+        ]
+    ])
+    
+    await bot.send_message(
+        chat_id=user_id,
+        text=f"Твои {minutes} минут прошли.\n\nТы всё ещё в приложении?",
+        reply_markup=keyboard
+    )
+
+
+timer_service.register("quick_pause", on_quick_pause_timer)
+
+
+async def cancel_quick_pause_timer(user_id: int) -> None:
+    """Отменить таймер Quick Pause (в том числе поставленный другим воркером)."""
+    await timer_service.cancel(quick_pause_timer_key(user_id))
+
+
+# ==================== ОТЛОЖЕННЫЕ СООБЩЕНИЯ ====================
+
+# Пауза между ответом и следующим сообщением (секунды)
+FOLLOWUP_DELAY = 1.0
+
+
+def followup_timer_prefix(user_id: int) -> str:
+    """Общий префикс ключей отложенных сообщений пользователя."""
+    return f"followup:{user_id}:"
+
+
+def followup_timer_key(user_id: int) -> str:
+    """Новый ключ на каждое сообщение: второе не должно перенести первое."""
+    return f"{followup_timer_prefix(user_id)}{uuid.uuid4().hex}"
+
+
+async def on_followup_timer(record: dict) -> None:
+    """
+    Отправить отложенное сообщение; меню собирается на момент отправки.
+
+    Ошибку отправки пробрасываем: timer_service повторит таймер, а прерванный
+    остановкой бота — отправит после перезапуска. Не повторяем только то,
+    что повтором не исправить.
+    """
+    # Таймеры срабатывают по порядку, а обработчики идут отдельными задачами:
+    # блокировка не даёт быстрому второму сообщению обогнать первое
+    async with followup_locks.user(record["user_id"]):
+        try:
+            await _send_followup_now(record)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logger.warning(f"Отложенное сообщение {record['what']} для {record['user_id']} не отправлено: {e}")
+
+
+async def _send_followup_now(record: dict) -> None:
+    user_id = record["user_id"]
+    if record["what"] == "menu":
+        ctx = UserContext(user_id)
+        text = await get_menu_text(user_id, ctx)
+        reply_markup = await get_main_menu(user_id, ctx)
+    elif record["what"] == "qp_reason":
+        text = QP_REASON
+        reply_markup = qp_reason_keyboard()
+    else:
+        logger.error(f"Неизвестное отложенное сообщение: {record['what']}")
+        return
+    
+    await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+
+
+timer_service.register("followup", on_followup_timer)
+
+
+async def send_followup(user_id: int, what: str, delay: float = FOLLOWUP_DELAY) -> None:
+    """
+    Отправить сообщение через delay секунд, не задерживая обработчик.
+    
+    Args:
+        user_id: ID пользователя
+        what: "menu" — главное меню, "qp_reason" — вопрос о причине Quick Pause
+        delay: Задержка в секундах
+    """
+    await timer_service.schedule(
+        followup_timer_key(user_id),
+        "followup",
+        datetime.now().timestamp() + delay,
+        user_id=user_id,
+        what=what
+    )
 
 
 def parse_duration(text: str) -> int:
@@ -384,24 +579,41 @@ def parse_duration(text: str) -> int:
     return None
 
 
+async def refresh_reminder_bucket(user_id: int, user_data: dict) -> None:
+    """Переложить пользователя в корзинах напоминаний или убрать, если напоминать ему не нужно"""
+    if in_reminder_audience(user_data, await user_exists(user_id)):
+        await reminder_buckets.set_user(user_id, user_data)
+    else:
+        await reminder_buckets.remove(user_id)
+
+
 # ==================== ОБРАБОТЧИКИ ====================
 
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext) -> None:
+async def cmd_start(message: types.Message, state: FSMContext, user_ctx: UserContext) -> None:
     """Расширенное меню с тарифами и хелпом"""
     user_id = message.from_user.id
     await state.clear()
     
     # Сохраняем дату регистрации ЕСЛИ ЕЁ НЕТ
-    status = await get_user_status(user_id)
+    status = await user_ctx.status()
     if not status.get("registration_date"):
         await update_user_status(user_id, "registration_date", datetime.now().isoformat())
+        user_ctx.invalidate()
+        await refresh_reminder_bucket(user_id, await user_ctx.user_data())
         logger.info(f"Новый пользователь {user_id}, сохранена дата регистрации")
     
-    is_prem = await is_premium(user_id)
+    # Имя для напоминаний (корзины не читают настройки при рассылке)
+    full_name = message.from_user.full_name
+    if full_name and (await user_ctx.user_data()).get("full_name") != full_name:
+        await update_user_status(user_id, "full_name", full_name)
+        user_ctx.invalidate()
+        await refresh_reminder_bucket(user_id, await user_ctx.user_data())
+    
+    is_prem = await user_ctx.is_premium()
     
     # Статистика
-    stats = await get_today_stats(user_id)
+    stats = await user_ctx.today_stats()
     
     # Текст меню
     text = EXTENDED_MENU.format(count=stats["count"], saved_time=stats["saved_time"])
@@ -428,11 +640,57 @@ async def cmd_help(message: types.Message) -> None:
     await message.answer(HELP_TEXT)
 
 
+@dp.message(Command("reminder"))
+async def cmd_reminder(message: types.Message) -> None:
+    """Время напоминания о практике: /reminder 21:30 [Europe/Moscow] или /reminder off"""
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    
+    if not args:
+        reminder_time, tz_name = user_reminder_settings(await preferences.get_user(user_id), user_id)
+        if reminder_time == REMINDER_OFF:
+            current = "Напоминания выключены."
+        else:
+            current = f"Напоминание в {reminder_time} ({tz_name})."
+        await message.answer(
+            f"{current}\n\n"
+            "Изменить: /reminder 21:30\n"
+            "С часовым поясом: /reminder 21:30 Asia/Yekaterinburg\n"
+            "Выключить: /reminder off"
+        )
+        return
+    
+    if args[0].lower() == REMINDER_OFF:
+        reminder_time = REMINDER_OFF
+    else:
+        reminder_time = parse_reminder_time(args[0])
+        if not reminder_time:
+            await message.answer("Формат времени: ЧЧ:ММ, например /reminder 21:30")
+            return
+    
+    tz_name = args[1] if len(args) > 1 else None
+    if tz_name and not is_valid_timezone(tz_name):
+        await message.answer("Не знаю такой часовой пояс. Пример: Europe/Moscow, Asia/Novosibirsk")
+        return
+    
+    async with storage_locks.user(user_id):
+        await preferences.set_value(user_id, "reminder_time", reminder_time)
+        if tz_name:
+            await preferences.set_value(user_id, "timezone", tz_name)
+        user_data = await preferences.get_user(user_id)
+    await refresh_reminder_bucket(user_id, user_data)
+    
+    if reminder_time == REMINDER_OFF:
+        await message.answer("Напоминания выключены.")
+    else:
+        _, tz_name = user_reminder_settings(user_data)
+        await message.answer(f"Буду напоминать в {reminder_time} ({tz_name}).")
+
+
 @dp.message(Command("tariffs"))
-async def cmd_tariffs(message: types.Message) -> None:
+async def cmd_tariffs(message: types.Message, user_ctx: UserContext) -> None:
     """Тарифы"""
-    user_id = message.from_user.id
-    status = await get_user_status(user_id)
+    status = await user_ctx.status()
     
     text = TARIFFS
     
@@ -452,17 +710,21 @@ async def cmd_tariffs(message: types.Message) -> None:
 
 @dp.message(Command("cancel"))
 @dp.callback_query(F.data == "cancel_action")
-async def cancel_action(event: types.Message | types.CallbackQuery, state: FSMContext):
+async def cancel_action(event: types.Message | types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Отмена"""
     await state.clear()
     
     if isinstance(event, types.CallbackQuery):
         user_id = event.from_user.id
-        await event.message.answer(CANCEL_TEXT, reply_markup=await get_main_menu(user_id))
+        await event.message.answer(CANCEL_TEXT, reply_markup=await get_main_menu(user_id, user_ctx))
         await event.answer()
     else:
         user_id = event.from_user.id
-        await event.answer(CANCEL_TEXT, reply_markup=await get_main_menu(user_id))
+        await event.answer(CANCEL_TEXT, reply_markup=await get_main_menu(user_id, user_ctx))
+
+
+# Документы хранилища с данными одного пользователя: <префикс>_<user_id>
+USER_DOCUMENT_PREFIXES = ("user_stats", "daily_practice_schedule", "daily_check", "quick_pause")
 
 
 @dp.message(Command("unstart"))
@@ -470,28 +732,27 @@ async def cmd_unstart(message: types.Message):
     """Сброс данных пользователя"""
     user_id = message.from_user.id
     
-    # Удаляем предпочтения
-    file_path = DATA_DIR / "user_preferences.json"
-    if file_path.exists():
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            if str(user_id) in data:
-                del data[str(user_id)]
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2)
-        except:
-            pass
-    
-    # Удаляем дерево
-    tree_file = DATA_DIR / f"tree_{user_id}.json"
-    if tree_file.exists():
-        tree_file.unlink()
-    
-    # Удаляем статистику
-    stats_file = DATA_DIR / f"user_stats_{user_id}.json"
-    if stats_file.exists():
-        stats_file.unlink()
+    async with storage_locks.user(user_id):
+        # Удаляем предпочтения
+        await preferences.delete_user(user_id)
+        await subscription_index.remove(user_id)
+        await reminder_buckets.remove(user_id)
+        # Отложенные сообщения удалённому пользователю больше не нужны
+        for timer_key in (subscription_timer_key(user_id), quick_pause_timer_key(user_id)):
+            await timer_service.cancel(timer_key)
+        await timer_service.cancel_prefix(followup_timer_prefix(user_id))
+        
+        # Удаляем дерево
+        tree_file = DATA_DIR / f"tree_{user_id}.json"
+        await run_io(tree_file.unlink, missing_ok=True)
+        
+        # Удаляем статистику (и живой объект, чтобы сброс её не вернул) и документы пользователя
+        if stats_registry:
+            await stats_registry.discard(user_id)
+        for prefix in USER_DOCUMENT_PREFIXES:
+            await delete_document(f"{prefix}_{user_id}")
+        # Запись пользователя (история практик, статистика)
+        await delete_user_data(user_id)
     
     await message.answer("Данные удалены. Начни заново: /start")
 
@@ -527,18 +788,44 @@ async def cmd_admin_stats(message: types.Message) -> None:
         await message.answer("Нет доступа.")
         return
     
-    file_path = DATA_DIR / "user_preferences.json"
-    if not file_path.exists():
+    data = await preferences.items()
+    if not data:
         await message.answer("Нет данных.")
         return
     
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    
     total = len(data)
-    paid = sum(1 for u in data.values() if u.get("subscription_end_date"))
+    paid = sum(1 for _, u in data if u.get("subscription_end_date"))
+    
+    text = f"Пользователей: {total}\nПодписок: {paid}"
+    timers = await counter_store.get_all(timer_counters_key())
+    text += f"\nТаймеры сегодня: запущено {timers.get('started', 0)}, сработало {timers.get('fired', 0)}"
+    if stats_registry:
+        m = stats_registry.metrics()
+        text += (
+            f"\n\nКэш статистики: {m['size']}/{m['capacity']}, грязных {m['dirty']}\n"
+            f"Попадания: {m['hits']}, промахи: {m['misses']}, вытеснения: {m['evictions']}"
+        )
     
-    await message.answer(f"Пользователей: {total}\nПодписок: {paid}")
+    await message.answer(text)
+
+@dp.message(Command("loop_stats"))
+async def cmd_loop_stats(message: types.Message) -> None:
+    """Задержки event loop (админ). /loop_stats reset — начать новое окно"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Нет доступа.")
+        return
+    
+    if message.text.split()[1:] == ["reset"]:
+        loop_monitor.reset()
+        await message.answer("Окно измерений сброшено.")
+        return
+    
+    m = loop_monitor.snapshot()
+    await message.answer(
+        f"Задержка event loop ({m['samples']} замеров):\n"
+        f"p50: {m['p50_ms']} мс\np99: {m['p99_ms']} мс\nmax: {m['max_ms']} мс\n"
+        f"Зависаний: {m['stalls']}"
+    )
 
 @dp.message(Command("action_logger"))
 async def cmd_action_logger(message: types.Message) -> None:
@@ -576,8 +863,7 @@ async def callback_go_tiktok(callback: types.CallbackQuery, state: FSMContext) -
             pass
     
     await callback.message.edit_text(QP_START)
-    await asyncio.sleep(1)
-    await callback.message.answer(QP_REASON, reply_markup=qp_reason_keyboard())
+    await send_followup(callback.from_user.id, "qp_reason")
     await callback.answer()
 
 
@@ -651,11 +937,7 @@ async def callback_qp_say_no(callback: types.CallbackQuery, state: FSMContext) -
         f"Ты молодец. Осознанный выбор.\n"
         f"Причина \"{reason}\" записана."
     )
-    await asyncio.sleep(1)
-    await callback.message.answer(
-        await get_menu_text(user_id), 
-        reply_markup=await get_main_menu(user_id)
-    )
+    await send_followup(user_id, "menu")
     await callback.answer()
 
 @dp.message(QuickPauseStates.waiting_time)
@@ -671,8 +953,14 @@ async def process_time_input(message: types.Message, state: FSMContext):
     
     await state.update_data(planned_minutes=minutes, start_time=start_time.isoformat())
     
-    task = asyncio.create_task(quick_pause_timer_with_finish(user_id, minutes, message.bot))
-    active_timers[user_id] = task
+    await timer_service.schedule(
+        quick_pause_timer_key(user_id),
+        "quick_pause",
+        start_time.timestamp() + minutes * 60,
+        user_id=user_id,
+        minutes=minutes,
+    )
+    await counter_store.incr(timer_counters_key(), "started")
     
     await message.answer(
         f"Таймер: {minutes} мин.",
@@ -693,14 +981,7 @@ async def callback_qp_finish(callback: types.CallbackQuery, state: FSMContext) -
     """Завершение (нажал Я закончил)"""
     user_id = callback.from_user.id
     
-    if user_id in active_timers:
-        active_timers[user_id].cancel()
-        try:
-            await active_timers[user_id]
-        except asyncio.CancelledError:
-            pass
-        finally:
-            active_timers.pop(user_id, None)
+    await cancel_quick_pause_timer(user_id)
     
     data = await state.get_data()
     start_time_str = data.get("start_time")
@@ -749,64 +1030,58 @@ async def callback_qp_finish(callback: types.CallbackQuery, state: FSMContext) -
             pass
     
     await callback.message.edit_text(f"{praise}\n\nДерево отмечает выбор.")
-    await asyncio.sleep(1)
-    await callback.message.answer(await get_menu_text(user_id), reply_markup=await get_main_menu(user_id))
+    await send_followup(user_id, "menu")
     await state.clear()
     await callback.answer()
 
+# Поля настроек, которые ведёт update_user_saved_time
+SAVED_TIME_FIELDS = (
+    "today_saved_minutes", "week_saved_minutes", "month_saved_minutes", "total_saved_minutes",
+    "saved_date", "week_reset_date", "month_reset_date",
+)
+
 async def update_user_saved_time(user_id: int, minutes: int) -> None:
     """Сохранить сэкономленное время за сегодня"""
-    file_path = DATA_DIR / "user_preferences.json"
-    data = {}
-    
-    if file_path.exists():
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except:
-            pass
-    
-    if str(user_id) not in data or not isinstance(data[str(user_id)], dict):
-        data[str(user_id)] = {}
-    
-    user_data = data[str(user_id)]
-    moscow_now = get_moscow_time()
-    today = moscow_now.date()
-    today_str = today.isoformat()
-    
-    # Проверяем, нужно ли сбрасывать неделю (понедельник)
-    last_week_reset = user_data.get("week_reset_date")
-    is_monday = today.weekday() == 0  # 0 = понедельник
-    
-    if last_week_reset != today_str and is_monday:
-        # Новый понедельник - сбрасываем неделю
-        user_data["week_saved_minutes"] = 0
-        user_data["week_reset_date"] = today_str
-    
-    # Проверяем, нужно ли сбрасывать месяц (1 число)
-    last_month_reset = user_data.get("month_reset_date")
-    is_first_of_month = today.day == 1
-    
-    if last_month_reset != today_str and is_first_of_month:
-        # Новый месяц - сбрасываем месяц
-        user_data["month_saved_minutes"] = 0
-        user_data["month_reset_date"] = today_str
-    
-    # Если это первый запуск сегодня - сбрасываем дневное
-    last_date = user_data.get("saved_date")
-    if last_date != today_str:
-        user_data["today_saved_minutes"] = 0
+    # Накопительные счётчики — чтение и запись под блокировкой настроек пользователя
+    async with storage_locks.user(user_id), preferences.locked(user_id):
+        user_data = await preferences.get_user(user_id)
+        moscow_now = get_moscow_time()
+        today = moscow_now.date()
+        today_str = today.isoformat()
+    
+        # Проверяем, нужно ли сбрасывать неделю (понедельник)
+        last_week_reset = user_data.get("week_reset_date")
+        is_monday = today.weekday() == 0  # 0 = понедельник
+    
+        if last_week_reset != today_str and is_monday:
+            # Новый понедельник - сбрасываем неделю
+            user_data["week_saved_minutes"] = 0
+            user_data["week_reset_date"] = today_str
+    
+        # Проверяем, нужно ли сбрасывать месяц (1 число)
+        last_month_reset = user_data.get("month_reset_date")
+        is_first_of_month = today.day == 1
+    
+        if last_month_reset != today_str and is_first_of_month:
+            # Новый месяц - сбрасываем месяц
+            user_data["month_saved_minutes"] = 0
+            user_data["month_reset_date"] = today_str
+    
+        # Если это первый запуск сегодня - сбрасываем дневное
+        last_date = user_data.get("saved_date")
+        if last_date != today_str:
+            user_data["today_saved_minutes"] = 0
     
-    # Добавляем ко всему
-    user_data["today_saved_minutes"] = user_data.get("today_saved_minutes", 0) + minutes
-    user_data["week_saved_minutes"] = user_data.get("week_saved_minutes", 0) + minutes
-    user_data["month_saved_minutes"] = user_data.get("month_saved_minutes", 0) + minutes
-    user_data["total_saved_minutes"] = user_data.get("total_saved_minutes", 0) + minutes
+        # Добавляем ко всему
+        user_data["today_saved_minutes"] = user_data.get("today_saved_minutes", 0) + minutes
+        user_data["week_saved_minutes"] = user_data.get("week_saved_minutes", 0) + minutes
+        user_data["month_saved_minutes"] = user_data.get("month_saved_minutes", 0) + minutes
+        user_data["total_saved_minutes"] = user_data.get("total_saved_minutes", 0) + minutes
     
-    user_data["saved_date"] = today_str
+        user_data["saved_date"] = today_str
     
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        # Пишем только свои поля: остальные мог изменить другой воркер
+        await preferences.set_values(user_id, {key: user_data[key] for key in SAVED_TIME_FIELDS if key in user_data})
         
 @dp.callback_query(F.data == "qp_stop")
 async def callback_qp_stop(callback: types.CallbackQuery, state: FSMContext) -> None:
@@ -844,14 +1119,7 @@ async def callback_qp_stop(callback: types.CallbackQuery, state: FSMContext) ->
             pass
     
 
-    if user_id in active_timers:
-        active_timers[user_id].cancel()
-        try:
-            await active_timers[user_id]
-        except asyncio.CancelledError:
-            pass
-        finally:
-            active_timers.pop(user_id, None)    
+    await cancel_quick_pause_timer(user_id)
     await state.clear()
     await callback.message.edit_text(QP_STOPPED_EARLY.format(saved=saved))
     await callback.answer()
@@ -871,14 +1139,7 @@ async def callback_qp_timer_stay(callback: types.CallbackQuery) -> None:
     """Остался в TikTok"""
     user_id = callback.from_user.id
     
-    if user_id in active_timers:
-        active_timers[user_id].cancel()
-        try:
-            await active_timers[user_id]
-        except asyncio.CancelledError:
-            pass
-        finally:
-            active_timers.pop(user_id, None)
+    await cancel_quick_pause_timer(user_id)
     
     # Логируем действие
     try:
@@ -888,15 +1149,14 @@ async def callback_qp_timer_stay(callback: types.CallbackQuery) -> None:
         pass
     
     await callback.message.edit_text("Мы отметили этот момент.")
-    await asyncio.sleep(1)
-    await callback.message.answer(await get_menu_text(user_id), reply_markup=await get_main_menu(user_id))
+    await send_followup(user_id, "menu")
     await callback.answer()
 
 
 # ==================== STATS ====================
 
 @dp.callback_query(F.data == "stats")
-async def callback_stats(callback: types.CallbackQuery) -> None:
+async def callback_stats(callback: types.CallbackQuery, user_ctx: UserContext) -> None:
     if log_action:
         try:
             await log_action(callback.from_user.id, "stats")
@@ -904,7 +1164,7 @@ async def callback_stats(callback: types.CallbackQuery) -> None:
             pass
     """Статистика"""
     user_id = callback.from_user.id
-    is_prem = await is_premium(user_id)
+    is_prem = await user_ctx.is_premium()
     
     if is_prem:
         stats = await get_full_stats(user_id)
@@ -921,7 +1181,7 @@ async def callback_stats(callback: types.CallbackQuery) -> None:
             month_avg=stats["month_avg"]
         )
     else:
-        stats = await get_today_stats(user_id)
+        stats = await user_ctx.today_stats()
         text = STATS_FREE.format(
             today_count=stats["count"],
             saved_time=stats["saved_time"]
@@ -931,6 +1191,49 @@ async def callback_stats(callback: types.CallbackQuery) -> None:
     await callback.answer()
 
 
+# ==================== ДНЕВНАЯ ПРАКТИКА ====================
+
+@dp.callback_query(F.data == "daily_practice")
+async def callback_daily_practice(callback: types.CallbackQuery) -> None:
+    """Практика дня (кнопка из вечернего напоминания)"""
+    user_id = callback.from_user.id
+    practice = await get_next_practice(user_id)
+    
+    if not practice:
+        await callback.message.edit_text("Практика пока недоступна.", reply_markup=await get_main_menu(user_id))
+        await callback.answer()
+        return
+    
+    if practice.get("completed"):
+        text = f"{practice['title']}\n\nПрактика на сегодня уже выполнена."
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=BTN_BACK, callback_data="back_to_menu")]
+        ])
+    else:
+        text = f"{practice['title']}\n\n{practice['instruction']}"
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Выполнено", callback_data="daily_practice_done")],
+            [InlineKeyboardButton(text=BTN_BACK, callback_data="back_to_menu")]
+        ])
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "daily_practice_done")
+async def callback_daily_practice_done(callback: types.CallbackQuery) -> None:
+    """Отметить практику дня выполненной"""
+    user_id = callback.from_user.id
+    
+    if await complete_practice(user_id):
+        text = "Практика выполнена. Сегодня напоминаний больше не будет."
+    else:
+        text = "Практика на сегодня уже отмечена."
+    
+    await callback.message.edit_text(text, reply_markup=await get_main_menu(user_id))
+    await callback.answer()
+
+
 # ==================== SOS (только премиум) ====================
 
 @dp.callback_query(F.data == "sos")
@@ -998,7 +1301,7 @@ async def callback_sos_action(callback: types.CallbackQuery, state: FSMContext)
 
 @dp.callback_query(F.data == "subscribe")
 @dp.callback_query(F.data == "manage_subscription")
-async def callback_subscribe(callback: types.CallbackQuery) -> None:
+async def callback_subscribe(callback: types.CallbackQuery, user_ctx: UserContext) -> None:
     if log_action:
         try:
             await log_action(callback.from_user.id, "subscribe")
@@ -1006,8 +1309,8 @@ async def callback_subscribe(callback: types.CallbackQuery) -> None:
             pass
     """Управление подпиской"""
     user_id = callback.from_user.id
-    status = await get_user_status(user_id)
-    is_prem = await is_premium(user_id)
+    status = await user_ctx.status()
+    is_prem = await user_ctx.is_premium()
     
     if status["is_paid"] and status["subscription_end_date"]:
         try:
@@ -1053,6 +1356,68 @@ async def callback_subscribe(callback: types.CallbackQuery) -> None:
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
+async def apply_payment(payment: dict, notify: bool = True) -> str:
+    """
+    Применить перечитанный из ЮKassa платёж: активировать подписку ровно один раз.
+    
+    Уведомление, кнопка «Проверить оплату» и повторная доставка могут прийти
+    одновременно — под блокировкой платежа и пользователя активирует только
+    первый, остальные видят статус succeeded в pending_payments.
+    
+    Args:
+        payment: Результат get_payment
+        notify: Написать пользователю об активации (для уведомлений ЮKassa)
+    
+    Returns:
+        str: Статус платежа в ЮKassa
+    """
+    payment_id = payment["id"]
+    status = payment["status"]
+    
+    await pending_payments.load()
+    record = pending_payments.get(payment_id)
+    if record is not None:
+        user_id = record["user_id"]
+    else:
+        # Платёж создан до появления pending_payments — берём пользователя из metadata
+        user_id = payment["metadata"].get("user_id")
+        if not user_id or not str(user_id).isdigit():
+            logger.warning(f"Платёж {payment_id} без user_id, пропускаем")
+            return status
+        user_id = int(user_id)
+    
+    # Платёж и пользователь — одним keys(): шарды берутся в общем порядке;
+    # аренда платежа — то же между воркерами
+    async with storage_locks.keys(f"payment:{payment_id}", user_id), \
+            lease_lock(f"payment:{payment_id}", ttl=PAYMENT_LOCK_TTL):
+        # Другой воркер мог уже применить платёж
+        await pending_payments.load()
+        record = pending_payments.get(payment_id)
+        if record is None:
+            record = await pending_payments.add(payment_id, user_id)
+        
+        if record["status"] == STATUS_SUCCEEDED:
+            return status
+        
+        if status == "succeeded":
+            await activate_subscription(user_id)
+            await pending_payments.set_status(payment_id, STATUS_SUCCEEDED)
+            logger.info(f"Платёж {payment_id}: подписка пользователя {user_id} активирована")
+        elif status == "canceled":
+            await pending_payments.set_status(payment_id, STATUS_CANCELED)
+            return status
+        else:
+            return status
+    
+    if notify:
+        await bot.send_message(
+            chat_id=user_id,
+            text="Оплата прошла! Premium активирован.",
+            reply_markup=menu_start_with_sub()
+        )
+    return status
+
+
 @dp.callback_query(F.data == "pay_unlock")
 async def callback_pay(callback: types.CallbackQuery, state: FSMContext) -> None:
     """Создание платежа"""
@@ -1071,6 +1436,9 @@ async def callback_pay(callback: types.CallbackQuery, state: FSMContext) -> None
     
     try:
         payment_url, payment_id = await create_payment(user_id, return_url)
+        if payment_id:
+            # Платёж переживает перезапуск и подтверждается уведомлением ЮKassa
+            await pending_payments.add(payment_id, user_id)
         
         await state.update_data(last_payment_id=payment_id)
         await state.set_state(PaymentStates.waiting_for_payment)
@@ -1091,34 +1459,43 @@ async def callback_check_payment(callback: types.CallbackQuery, state: FSMContex
     """Проверка оплаты"""
     user_id = callback.from_user.id
     data = await state.get_data()
-    payment_id = data.get("last_payment_id")
+    await pending_payments.load()
+    payment_id = data.get("last_payment_id") or pending_payments.latest_for_user(user_id)
     
-    if not payment_id:
+    if not payment_id or not get_payment:
         await callback.answer("Информация о платеже утеряна. Попробуйте заново.", show_alert=True)
         return
     
-    await callback.answer("Проверяю...")
+    # Уже подтверждён уведомлением ЮKassa
+    record = pending_payments.get(payment_id)
+    if record and record["status"] == STATUS_SUCCEEDED:
+        await state.clear()
+        await callback.message.edit_text(
+            "Оплата прошла! Premium активирован.",
+            reply_markup=menu_start_with_sub()
+        )
+        await callback.answer()
+        return
     
-    def check_payment():
-        Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-        Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
-        return Payment.find_one(payment_id)
+    await callback.answer("Проверяю...")
     
     try:
-        payment = await asyncio.to_thread(check_payment)
+        payment = await get_payment(payment_id)
+        if payment is None:
+            raise RuntimeError("ЮKassa не ответила")
+        status = await apply_payment(payment, notify=False)
         
-        if payment.status == "succeeded":
-            await activate_subscription(user_id)
+        if status == "succeeded":
             await state.clear()
             
             await callback.message.edit_text(
                 "Оплата прошла! Premium активирован.",
                 reply_markup=menu_start_with_sub()
             )
-        elif payment.status == "pending":
+        elif status == "pending":
             await callback.answer("Оплата в обработке. Подождите.", show_alert=True)
         else:
-            await callback.answer(f"Статус: {payment.status}", show_alert=True)
+            await callback.answer(f"Статус: {status}", show_alert=True)
     except Exception as e:
         logger.error(f"Payment check error: {e}")
         await callback.answer("Ошибка проверки.", show_alert=True)
@@ -1127,7 +1504,7 @@ async def callback_check_payment(callback: types.CallbackQuery, state: FSMContex
 # ==================== НАВИГАЦИЯ ====================
 
 @dp.callback_query(F.data == "back_to_menu")
-async def callback_back(callback: types.CallbackQuery) -> None:
+async def callback_back(callback: types.CallbackQuery, user_ctx: UserContext) -> None:
     if log_action:
         try:
             await log_action(callback.from_user.id, "back_to_menu")
@@ -1135,29 +1512,93 @@ async def callback_back(callback: types.CallbackQuery) -> None:
             pass
     """Назад в меню"""
     user_id = callback.from_user.id
-    await callback.message.answer(await get_menu_text(user_id), reply_markup=await get_main_menu(user_id))
+    await callback.message.answer(await get_menu_text(user_id, user_ctx), reply_markup=await get_main_menu(user_id, user_ctx))
     await callback.answer()
 
 
 # ==================== WEBHOOK ====================
 
+async def process_update(data: dict) -> None:
+    """Обработка сырого обновления (из запроса или воркером очереди)"""
+    update = types.Update(**data)
+    await dp.feed_webhook_update(bot, update)
+
+
 async def handle_webhook(request: web.Request) -> web.Response:
     secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
     if secret != os.getenv("WEBHOOK_SECRET"):
         return web.Response(status=403, text="Forbidden")
     
     try:
-        update = types.Update(**await request.json())
-        await dp.feed_webhook_update(bot, update)
+        data = await request.json()
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        return web.Response(status=200)
+    
+    # Асинхронный режим: только в очередь, Telegram сразу получает 200
+    if update_queue.running:
+        if not update_queue.submit(data):
+            logger.warning("Очередь обновлений переполнена, Telegram повторит доставку")
+            return web.Response(status=503, text="Busy")
+        return web.Response(status=200)
+    
+    try:
+        await process_update(data)
     except Exception as e:
         logger.error(f"Webhook error: {e}")
     
     return web.Response(status=200)
 
 
+async def handle_yookassa(request: web.Request) -> web.Response:
+    """
+    Уведомления ЮKassa о платежах.
+    
+    Адрес отправителя сверяется со списком ЮKassa, а статус платежа не берётся
+    из тела — платёж перечитывается из API. Не 200 — ЮKassa повторит доставку.
+    """
+    ip = client_ip(request.remote, request.headers.get("X-Forwarded-For"))
+    if not is_allowed_ip(ip):
+        logger.warning(f"Уведомление ЮKassa с чужого адреса {ip}")
+        return web.Response(status=403, text="Forbidden")
+    
+    try:
+        body = await request.json()
+    except Exception:
+        return web.Response(status=400, text="Bad Request")
+    
+    payment_id = notification_payment_id(body)
+    if not payment_id:
+        return web.Response(status=200)
+    
+    payment = await get_payment(payment_id) if get_payment else None
+    if payment is None:
+        return web.Response(status=503, text="Retry")
+    
+    try:
+        await apply_payment(payment)
+    except Exception as e:
+        logger.error(f"Ошибка обработки платежа {payment_id}: {e}")
+        return web.Response(status=500, text="Error")
+    
+    return web.Response(status=200)
+
+
 async def health_check(request: web.Request) -> web.Response:
     return web.Response(text="OK")
 
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики очереди обновлений, event loop и сверки платежей (JSON)"""
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return web.Response(status=403, text="Forbidden")
+    return web.json_response({
+        "updates": update_queue.metrics(),
+        "event_loop": loop_monitor.snapshot(),
+        "payments": payment_reconciler.metrics(),
+    })
+
 @dp.callback_query(F.data == "sos_locked")
 async def callback_sos_locked(callback: types.CallbackQuery) -> None:
     """SOS заблокирован для бесплатных"""
@@ -1170,16 +1611,16 @@ async def callback_sos_locked(callback: types.CallbackQuery) -> None:
 
 
 @dp.callback_query(F.data == "tariffs")
-async def callback_tariffs(callback: types.CallbackQuery) -> None:
+async def callback_tariffs(callback: types.CallbackQuery, user_ctx: UserContext) -> None:
     if log_action:
         try:
             await log_action(callback.from_user.id, "tariffs")
         except:
             pass
     """Тарифы"""
-    is_prem = await is_premium(callback.from_user.id)
+    is_prem = await user_ctx.is_premium()
     
-    status = await get_user_status(callback.from_user.id)
+    status = await user_ctx.status()
     sub_text = ""
     if status["is_paid"] and status["subscription_end_date"]:
         try:
@@ -1227,31 +1668,66 @@ async def callback_help(callback: types.CallbackQuery) -> None:
     await callback.answer()
 
 @dp.message(Command("menu"))
-async def cmd_menu(message: types.Message, state: FSMContext) -> None:
+async def cmd_menu(message: types.Message, state: FSMContext, user_ctx: UserContext) -> None:
     """Простое меню без подписки и тарифов"""
-    user_id = message.from_user.id
     await state.clear()
     
-    is_prem = await is_premium(user_id)
-    
-    if is_prem:
-        text = MENU_WITH_SUB.format(
-            count=(await get_today_stats(user_id))["count"],
-            saved_time=(await get_today_stats(user_id))["saved_time"]
-        )
-        await message.answer(text, reply_markup=menu_with_sub())
-    else:
-        text = MENU_NO_SUB.format(
-            count=(await get_today_stats(user_id))["count"],
-            saved_time=(await get_today_stats(user_id))["saved_time"]
-        )
-        await message.answer(text, reply_markup=menu_no_sub())
+    text = await get_menu_text(user_ctx.user_id, user_ctx)
+    await message.answer(text, reply_markup=await get_main_menu(user_ctx.user_id, user_ctx))
 
 
 # ==================== MAIN ====================
 
+async def on_startup() -> None:
+    """Запуск фоновых сервисов (общий для polling и webhook)"""
+    loop_monitor.start()
+    fsync_batcher.start()
+    # Первичная загрузка файлов — в пуле потоков, до приёма обновлений
+    await preferences.load()
+    preferences.start()
+    await subscription_index.build(await preferences.items())
+    await pending_payments.load()
+    if action_queue:
+        await run_io(action_queue.store.load)
+        action_queue.start()
+    if stats_registry:
+        stats_registry.start()
+    await practice_index.start()
+    await timer_service.start()
+    await restore_subscription_timers()
+    await start_reminder_system(bot)
+    if get_payment:
+        payment_reconciler.start(get_payment, apply_payment)
+
+
+async def on_shutdown() -> None:
+    """Остановка фоновых сервисов и сброс данных на диск"""
+    # Сначала дообрабатываем принятые обновления — они ещё пишут данные
+    await update_queue.close()
+    # Таймеры больше не срабатывают и не пишут данные
+    await timer_service.close()
+    await stop_reminder_system()
+    await payment_reconciler.close()
+    if yookassa_api:
+        await yookassa_api.close()
+    await preferences.close()
+    if action_queue:
+        await action_queue.close()
+    if stats_registry:
+        await stats_registry.close()
+    await practice_index.close()
+    # Последним: досинхронизировать всё, что записали при остановке
+    await fsync_batcher.close()
+    await dp.storage.close()
+    await close_redis()
+    await loop_monitor.close()
+    # Пул потоков — самым последним: все, кто вызывает run_io, уже остановлены
+    shutdown_executor()
+
+
 async def main():
     webhook_url = os.getenv("WEBHOOK_URL")
+    await on_startup()
     
     if webhook_url:
     
@@ -1262,14 +1738,22 @@ async def main():
         
         if not webhook_url:
             logger.critical("WEBHOOK_URL не задан!")
+            await on_shutdown()
             return
         
-        await bot.delete_webhook(drop_pending_updates=True)
+        # Без сброса очереди: при выкатке обновления ещё принимает старый экземпляр,
+        # накопленные за перезапуск Telegram доставит новому
         await bot.set_webhook(url=webhook_url, secret_token=webhook_secret)
         
         app = web.Application()
         app.router.add_post(webhook_path, handle_webhook)
+        app.router.add_post(os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa"), handle_yookassa)
         app.router.add_get('/health', health_check)
+        app.router.add_get('/metrics', metrics_handler)
+        
+        if WEBHOOK_MODE == "async":
+            update_queue.start(process_update)
+            logger.info(f"Webhook: асинхронная обработка, воркеров {update_queue.workers}")
         
         runner = web.AppRunner(app)
         await runner.setup()
@@ -1285,12 +1769,16 @@ async def main():
             pass
         finally:
             await runner.cleanup()
+            await on_shutdown()
             await bot.session.close()
     else:
         # Локальный запуск - используем polling
         logger.info("Запуск в режиме polling (локально)")
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+        finally:
+            await on_shutdown()
 
 
 if __name__ == "__main__":
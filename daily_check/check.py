@@ -6,8 +6,11 @@ from datetime import datetime
 # Импорт внешних модулей
 from tree_progress.tree import TreeProgress
 from daily_practice.daily_practices import get_daily_practice
-from utils.storage import save_user_data, load_user_data
+from utils.storage import save_user_data, load_user_data, update_user_record
 from daily_practice.schedule import get_moscow_time
+from daily_practice.completions import practice_index
+from utils.preferences import preferences
+from utils.reminder_buckets import user_local_date
 
 logger = logging.getLogger(__name__)
 
@@ -138,28 +141,24 @@ async def load_last_pause(user_id: int) -> Optional[dict]:
 async def save_daily_data(user_id: int, data: dict) -> bool:
     """Сохранение данных дневной практики с историей."""
     try:
-        # Загружаем существующие данные
-        user_data = load_user_data()
-        user_key = str(user_id)
-        
-        if user_key not in user_data:
-            user_data[user_key] = {}
-        
-        # Добавляем запись в историю
         current_time = get_moscow_time()
-        date_key = current_time.date().isoformat()
+        # День практики — по часовому поясу пользователя, как в напоминаниях
+        day = user_local_date(await preferences.get_user(user_id), current_time)
+        date_key = day.isoformat()
         
-        if 'practice_history' not in user_data[user_key]:
-            user_data[user_key]['practice_history'] = {}
+        def add_to_history(user_info: dict) -> None:
+            user_info.setdefault('practice_history', {})[date_key] = {
+                'type': 'daily_practice',
+                'completed_at': current_time.isoformat(),
+                'data': data
+            }
         
-        user_data[user_key]['practice_history'][date_key] = {
-            'type': 'daily_practice',
-            'completed_at': current_time.isoformat(),
-            'data': data
-        }
+        # Читается и пишется только запись этого пользователя, под его блокировкой
+        if not await update_user_record(user_id, add_to_history):
+            return False
         
-        # Сохраняем обновленные данные
-        save_user_data(user_data)
+        # Индекс для вечерних напоминаний
+        await practice_index.mark_done(user_id, day)
         
         return True
         
@@ -0,0 +1,181 @@
+"""Индекс «кто выполнил практику в этот день» для вечерних напоминаний."""
+import asyncio
+import logging
+import os
+from datetime import date, timedelta
+from typing import Dict, Optional, Set
+
+from daily_practice.schedule import get_moscow_time
+from utils.executor import run_io
+from utils.preferences import preferences
+from utils.reminder_buckets import user_local_date
+from utils.shared_state import REDIS_PREFIX, get_redis, run_once, use_redis
+from utils.storage import iter_user_records, load_user_data_async, save_user_data
+
+logger = logging.getLogger(__name__)
+
+# Документ хранилища с индексом
+INDEX_STORAGE_KEY = "practice_completions"
+# Сколько последних дней держать в индексе
+INDEX_KEEP_DAYS = 7
+INDEX_FLUSH_INTERVAL = float(os.getenv("PRACTICE_INDEX_FLUSH_INTERVAL", "5"))
+
+
+class PracticeCompletionIndex:
+    """
+    Множества user_id, выполнивших практику, по дням (ключ — дата у
+    пользователя, в его часовом поясе).
+
+    Обновляется при выполнении практики, поэтому список для напоминаний —
+    одна разность множеств вместо чтения истории каждого пользователя.
+    Хранится документом INDEX_STORAGE_KEY с отложенной записью (как
+    настройки). Если документа ещё нет, индекс один раз строится из
+    practice_history в записях пользователей.
+    """
+
+    def __init__(self, storage_key: str = INDEX_STORAGE_KEY, keep_days: int = INDEX_KEEP_DAYS,
+                 flush_interval: float = INDEX_FLUSH_INTERVAL):
+        self.storage_key = storage_key
+        self.keep_days = keep_days
+        self.flush_interval = flush_interval
+        self._days: Optional[Dict[str, Set[int]]] = None
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- Загрузка ----------
+
+    def _build_from_history(self) -> Dict[str, Set[int]]:
+        """Один проход по practice_history (только при первом запуске)."""
+        cutoff = (get_moscow_time().date() - timedelta(days=self.keep_days)).isoformat()
+        days: Dict[str, Set[int]] = {}
+        for user_id, user_info in iter_user_records():
+            for date_str, practice in user_info.get("practice_history", {}).items():
+                if date_str >= cutoff and practice.get("type") == "daily_practice":
+                    days.setdefault(date_str, set()).add(user_id)
+        return days
+
+    async def _ensure_loaded(self) -> Dict[str, Set[int]]:
+        if self._days is None:
+            data = await load_user_data_async(self.storage_key)
+            if data:
+                days = {d: set(ids) for d, ids in data.get("days", {}).items()}
+            else:
+                days = await run_io(self._build_from_history)
+                self._dirty = True
+                logger.info(f"Индекс практик построен из истории: {len(days)} дн.")
+            if self._days is None:
+                self._days = days
+        return self._days
+
+    # ---------- API ----------
+
+    async def mark_done(self, user_id: int, day: Optional[date] = None) -> None:
+        """Отметить, что пользователь выполнил практику (по умолчанию — сегодня у пользователя)."""
+        days = await self._ensure_loaded()
+        key = (day or user_local_date(await preferences.get_user(user_id))).isoformat()
+        done = days.setdefault(key, set())
+        if user_id not in done:
+            done.add(int(user_id))
+            self._dirty = True
+
+    async def done_on(self, day: Optional[date] = None) -> Set[int]:
+        """Кто выполнил практику в этот день (копия множества)."""
+        days = await self._ensure_loaded()
+        return set(days.get((day or get_moscow_time().date()).isoformat(), ()))
+
+    # ---------- Сброс на диск ----------
+
+    def _prune(self) -> None:
+        cutoff = (get_moscow_time().date() - timedelta(days=self.keep_days)).isoformat()
+        for key in [k for k in self._days if k < cutoff]:
+            del self._days[key]
+            self._dirty = True
+
+    async def flush(self) -> bool:
+        """Сохранить индекс, если были изменения."""
+        if self._days is None:
+            return True
+        self._prune()
+        if not self._dirty:
+            return True
+        # Снимок делается до await: множества дальше можно менять
+        payload = {"days": {d: sorted(ids) for d, ids in self._days.items()}}
+        self._dirty = False
+        if not await save_user_data(payload, self.storage_key):
+            self._dirty = True
+            return False
+        return True
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения индекса практик: {e}")
+
+    async def start(self) -> None:
+        """Загрузить индекс и запустить фоновую запись."""
+        await self._ensure_loaded()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class RedisPracticeCompletionIndex(PracticeCompletionIndex):
+    """
+    Индекс во множествах Redis <prefix>:practice_done:<дата>, общий для
+    воркеров: отметка — один SADD, множество живёт keep_days дней.
+    Из истории строится один раз на все воркеры.
+    """
+
+    def __init__(self, prefix: str = REDIS_PREFIX, keep_days: int = INDEX_KEEP_DAYS):
+        super().__init__(keep_days=keep_days)
+        self.prefix = prefix
+        self.built_key = f"{prefix}:practice_done:built"
+
+    def _key(self, day_str: str) -> str:
+        return f"{self.prefix}:practice_done:{day_str}"
+
+    def _ttl(self) -> int:
+        return (self.keep_days + 1) * 86400
+
+    async def mark_done(self, user_id: int, day: Optional[date] = None) -> None:
+        key = (day or user_local_date(await preferences.get_user(user_id))).isoformat()
+        async with get_redis().pipeline(transaction=False) as pipe:
+            await pipe.sadd(self._key(key), int(user_id)).expire(self._key(key), self._ttl()).execute()
+
+    async def done_on(self, day: Optional[date] = None) -> Set[int]:
+        key = (day or get_moscow_time().date()).isoformat()
+        return {int(member) for member in await get_redis().smembers(self._key(key))}
+
+    async def start(self) -> None:
+        await run_once(self.built_key, self._import, self.prefix)
+
+    async def _import(self) -> None:
+        days = await run_io(self._build_from_history)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for day_str, user_ids in days.items():
+                pipe.sadd(self._key(day_str), *user_ids).expire(self._key(day_str), self._ttl())
+            await pipe.execute()
+        logger.info(f"Индекс практик в Redis построен из истории: {len(days)} дн.")
+
+    async def flush(self) -> bool:
+        return True
+
+    async def close(self) -> None:
+        pass
+
+
+# Единый экземпляр на процесс
+practice_index: PracticeCompletionIndex = RedisPracticeCompletionIndex() if use_redis() else PracticeCompletionIndex()
+
@@ -4,7 +4,15 @@ import random
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List, Dict
 
-from utils.storage import save_user_data, load_user_data
+from utils.locks import storage_locks
+from utils.preferences import preferences
+from utils.reminder_buckets import user_local_date
+from utils.storage import (
+    save_user_data,
+    load_user_data_async,
+    load_user_record_async,
+    update_user_record,
+)
 from daily_practice.daily_practices import DAILY_PRACTICES
 
 logger = logging.getLogger(__name__)
@@ -16,6 +24,11 @@ MOSCOW_TZ = timezone(timedelta(hours=3))
 UPDATE_HOUR = 7
 
 
+def _schedule_key(user_id: int) -> str:
+    """Ключ документа с текущей практикой пользователя."""
+    return f"daily_practice_schedule_{user_id}"
+
+
 def get_moscow_time() -> datetime:
     """Получает текущее время в Москве."""
     return datetime.now(MOSCOW_TZ)
@@ -30,10 +43,17 @@ def get_user_practice_day(user_id: int) -> int:
     return max(1, days_passed + 1)
 
 
-def should_update_practice(user_id: int) -> bool:
-    """Проверяет, нужно ли обновить практику для пользователя."""
+async def should_update_practice(user_id: int, user_data: Optional[Dict] = None) -> bool:
+    """
+    Проверяет, нужно ли обновить практику для пользователя.
+    
+    Args:
+        user_id: ID пользователя
+        user_data: Уже загруженное расписание (иначе читается в пуле потоков)
+    """
     try:
-        user_data = load_user_data(user_id, "daily_practice_schedule")
+        if user_data is None:
+            user_data = await load_user_data_async(_schedule_key(user_id))
         
         if not user_data:
             return True
@@ -58,9 +78,9 @@ def should_update_practice(user_id: int) -> bool:
 
 async def get_next_practice(user_id: int) -> Optional[Dict]:
     """Получает следующую практику для пользователя."""
-    if not should_update_practice(user_id):
+    user_data = await load_user_data_async(_schedule_key(user_id))
+    if not await should_update_practice(user_id, user_data):
         # Возвращаем текущую практику
-        user_data = await load_user_data(user_id, "daily_practice_schedule")
         if user_data:
             return user_data.get("current_practice")
         return None
@@ -106,31 +126,36 @@ async def save_practice_schedule(user_id: int, practice_data: Dict) -> bool:
         "total_completed": 0
     }
     
-    return await save_user_data(user_id, schedule_data, "daily_practice_schedule")
+    return await save_user_data(schedule_data, _schedule_key(user_id))
 
 
 async def complete_practice(user_id: int) -> bool:
     """Отмечает практику как выполненную и обновляет статистику."""
-    user_data = await load_user_data(user_id, "daily_practice_schedule")
-    
-    if not user_data or not user_data.get("current_practice"):
-        return False
-    
-    current_practice = user_data["current_practice"]
-    if current_practice.get("completed"):
-        return False
-    
-    # Отмечаем как выполненную
-    current_practice["completed"] = True
-    current_practice["completed_at"] = get_moscow_time().isoformat()
-    
-    # Обновляем счетчики
-    user_data["total_completed"] += 1
-    
-    success = await save_user_data(user_id, user_data, "daily_practice_schedule")
+    # Чтение и запись расписания — под блокировкой пользователя,
+    # чтобы двойное нажатие не засчитало практику дважды
+    async with storage_locks.user(user_id):
+        user_data = await load_user_data_async(_schedule_key(user_id))
+        
+        if not user_data or not user_data.get("current_practice"):
+            return False
+        
+        current_practice = user_data["current_practice"]
+        if current_practice.get("completed"):
+            return False
+        
+        # Отмечаем как выполненную
+        current_practice["completed"] = True
+        current_practice["completed_at"] = get_moscow_time().isoformat()
+        
+        # Обновляем счетчики
+        user_data["total_completed"] = user_data.get("total_completed", 0) + 1
+        
+        success = await save_user_data(user_data, _schedule_key(user_id))
     
     # НОВОЕ: Обновляем статистику пользователя
     if success:
+        from daily_practice.completions import practice_index
+        await practice_index.mark_done(user_id)
         await update_user_stats(user_id, current_practice)
         logger.info(f"Практика {current_practice['practice_id']} выполнена пользователем {user_id}")
     
@@ -147,9 +172,8 @@ async def get_user_practice_status(user_id: int) -> Dict:
         Dict: Статус практики с информацией о последнем выполнении
     """
     try:
-        # Загружаем данные пользователя
-        user_data = load_user_data()
-        user_info = user_data.get(str(user_id), {})
+        # Загружаем запись пользователя
+        user_info = await load_user_record_async(user_id)
         
         # Получаем историю практик (если есть)
         practice_history = user_info.get('practice_history', {})
@@ -176,8 +200,8 @@ async def get_user_practice_status(user_id: int) -> Dict:
             'last_practice': last_practice
         }
         
-        # Проверяем, выполнялась ли практика сегодня
-        today = get_moscow_time().date()
+        # Проверяем, выполнялась ли практика сегодня (по часовому поясу пользователя)
+        today = user_local_date(await preferences.get_user(user_id))
         if last_date == today:
             status['has_practiced_today'] = True
             if last_practice:
@@ -199,29 +223,20 @@ async def get_user_practice_status(user_id: int) -> Dict:
 async def update_user_stats(user_id: int, practice_data: dict) -> bool:
     """Обновляет статистику пользователя после выполнения практики."""
     try:
-        # Обновляем базовую статистику (существующий код)
-        user_data = load_user_data()
-        user_key = str(user_id)
-        
-        if user_key not in user_data:
-            user_data[user_key] = {"stats": {}}
-        
-        if "stats" not in user_data[user_key]:
-            user_data[user_key]["stats"] = {}
-        
-        stats = user_data[user_key]["stats"]
-        
-        # Обновляем статистику
-        stats["total_practices"] = stats.get("total_practices", 0) + 1
-        stats["xp_total"] = stats.get("xp_total", 0) + practice_data.get("xp", 5)
-        stats["last_practice_date"] = practice_data.get("completed_at")
-        stats["practice_types"] = stats.get("practice_types", {})
-        
-        practice_type = practice_data.get("type", "daily_practice")
-        stats["practice_types"][practice_type] = stats.get(practice_type, 0) + 1
+        # Обновляем базовую статистику в записи пользователя
+        def add_practice(user_info: dict) -> None:
+            stats = user_info.setdefault("stats", {})
+            
+            stats["total_practices"] = stats.get("total_practices", 0) + 1
+            stats["xp_total"] = stats.get("xp_total", 0) + practice_data.get("xp", 5)
+            stats["last_practice_date"] = practice_data.get("completed_at")
+            stats["practice_types"] = stats.get("practice_types", {})
+            
+            practice_type = practice_data.get("type", "daily_practice")
+            stats["practice_types"][practice_type] = stats.get(practice_type, 0) + 1
         
         # Сохраняем обновленные данные
-        save_user_data(user_data)
+        await update_user_record(user_id, add_practice)
         
         # НОВОЕ: Обновляем детализированную статистику
         from stats.user_stats import update_stats
@@ -237,7 +252,7 @@ async def update_user_stats(user_id: int, practice_data: dict) -> bool:
 async def get_user_stats(user_id: int, period: str = "total") -> dict:
     """Получает статистику пользователя за указанный период."""
     try:
-        user_profile = await load_user_data(user_id)
+        user_profile = await load_user_data_async(user_id)
         if not user_profile:
             return {"error": "Пользователь не найден"}
         
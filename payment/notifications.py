@@ -0,0 +1,97 @@
+"""Входящие уведомления ЮKassa: проверка отправителя и разбор тела."""
+import ipaddress
+import logging
+import os
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Адреса, с которых ЮKassa шлёт уведомления (документация ЮKassa, раздел «Входящие уведомления»)
+YOOKASSA_NETWORKS = (
+    "185.71.76.0/27",
+    "185.71.77.0/27",
+    "77.75.153.0/25",
+    "77.75.156.11/32",
+    "77.75.156.35/32",
+    "77.75.154.128/25",
+    "2a02:5180::/32",
+)
+
+# Свой список через запятую; "*" — не проверять адрес (локальная отладка)
+ALLOWED_NETWORKS_ENV = os.getenv("YOOKASSA_NOTIFY_ALLOWED_IPS", "")
+# За прокси (Render и т.п.) адрес клиента приходит в X-Forwarded-For
+TRUST_FORWARDED = os.getenv("YOOKASSA_TRUST_FORWARDED", "0") == "1"
+
+
+def _parse_networks(spec: str) -> Optional[list]:
+    if spec.strip() == "*":
+        return None
+    items = [s.strip() for s in spec.split(",") if s.strip()] or list(YOOKASSA_NETWORKS)
+    return [ipaddress.ip_network(item, strict=False) for item in items]
+
+
+_networks = _parse_networks(ALLOWED_NETWORKS_ENV)
+
+
+def client_ip(remote: Optional[str], forwarded_for: Optional[str]) -> Optional[str]:
+    """Адрес отправителя: первый из X-Forwarded-For, если прокси доверенный."""
+    if TRUST_FORWARDED and forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return remote
+
+
+def is_allowed_ip(ip: Optional[str]) -> bool:
+    """Пришло ли уведомление с адреса ЮKassa."""
+    if _networks is None:
+        return True
+    if not ip:
+        return False
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in _networks)
+
+
+def notification_payment_id(body: dict) -> Optional[str]:
+    """
+    id платежа из уведомления о платеже (payment.succeeded, payment.canceled, ...).
+
+    Статус из тела не используется: тело может быть подделано, поэтому
+    платёж всегда перечитывается из API ЮKassa.
+    """
+    if not isinstance(body, dict) or body.get("type") != "notification":
+        return None
+    if not str(body.get("event", "")).startswith("payment."):
+        return None
+    payment = body.get("object")
+    if not isinstance(payment, dict):
+        return None
+    return payment.get("id")
+
+
+async def send_fake_notification(url: str, payment_id: str, event: str = "payment.succeeded") -> Tuple[int, str]:
+    """
+    Отправить уведомление в формате ЮKassa на локальный бот (отладка и тесты).
+
+    Returns:
+        tuple: (HTTP-статус, тело ответа)
+    """
+    import aiohttp
+
+    body = {
+        "type": "notification",
+        "event": event,
+        "object": {"id": payment_id, "status": event.split(".", 1)[1]},
+    }
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=body) as response:
+            return response.status, await response.text()
+
+
+if __name__ == "__main__":
+    # python -m payment.notifications http://localhost:10000/yookassa <payment_id> [event]
+    import asyncio
+    import sys
+
+    print(*asyncio.run(send_fake_notification(*sys.argv[1:4])))
@@ -0,0 +1,176 @@
+"""Незавершённые платежи ЮKassa: переживают перезапуск, активация — один раз."""
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from utils.shared_state import lease_lock, use_redis
+from utils.storage import load_user_data_async, save_user_data
+
+logger = logging.getLogger(__name__)
+
+# Документ хранилища с платежами
+PENDING_STORAGE_KEY = "pending_payments"
+
+STATUS_PENDING = "pending"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_CANCELED = "canceled"
+# Не оплачен за PAYMENT_EXPIRE_HOURS (payment.reconcile) — больше не сверяем
+STATUS_EXPIRED = "expired"
+
+# Сколько дней держать завершённые платежи (защита от повторной активации)
+FINISHED_KEEP_DAYS = 30
+# Первая сверка — не раньше, чем через столько секунд (обычно раньше приходит уведомление)
+FIRST_CHECK_DELAY = float(os.getenv("PAYMENT_FIRST_CHECK_DELAY", "60"))
+# Срок аренды на изменение документа платежей (несколько воркеров)
+PAYMENTS_LOCK_TTL = 30
+
+
+class PendingPayments:
+    """
+    Платежи по payment_id: пользователь, статус, время создания.
+
+    Раньше id платежа жил только в FSM и терялся при перезапуске. Теперь
+    запись создаётся сразу после создания платежа и сохраняется документом
+    PENDING_STORAGE_KEY при каждом изменении (платежей мало, отложенная
+    запись не нужна). Завершённые записи хранятся FINISHED_KEEP_DAYS дней:
+    повторное уведомление о том же платеже видит статус succeeded и не
+    продлевает подписку второй раз.
+
+    attempts и next_check_at ведёт фоновая сверка (payment.reconcile).
+
+    shared=True (несколько воркеров): load() каждый раз перечитывает
+    документ, а изменения делаются под арендой — документ перечитывается,
+    меняется одна запись и сохраняется. Отложенные сверки (defer) копятся
+    и накладываются на свежий документ в save(), не затирая платежи,
+    добавленные другими воркерами.
+    """
+
+    def __init__(self, storage_key: str = PENDING_STORAGE_KEY, keep_days: int = FINISHED_KEEP_DAYS,
+                 shared: bool = False):
+        self.storage_key = storage_key
+        self.keep_days = keep_days
+        self.shared = shared
+        self._payments: Optional[Dict[str, dict]] = None
+        # payment_id -> (attempts, next_check_at), ещё не сохранённые (shared)
+        self._deferred: Dict[str, tuple] = {}
+
+    async def _read(self) -> Dict[str, dict]:
+        data = await load_user_data_async(self.storage_key)
+        return data.get("payments", {}) if data else {}
+
+    async def load(self) -> Dict[str, dict]:
+        if self.shared:
+            self._payments = await self._read()
+            return self._payments
+        if self._payments is None:
+            payments = await self._read()
+            if self._payments is None:
+                self._payments = payments
+                logger.info(f"Незавершённых платежей: {len(self.pending())}")
+        return self._payments
+
+    async def save(self) -> bool:
+        if self.shared:
+            async with lease_lock(self.storage_key, ttl=PAYMENTS_LOCK_TTL):
+                self._payments = await self._read()
+                for payment_id, (attempts, next_check_at) in self._deferred.items():
+                    record = self._payments.get(payment_id)
+                    if record is not None and record["status"] == STATUS_PENDING:
+                        record["attempts"] = attempts
+                        record["next_check_at"] = next_check_at
+                self._deferred.clear()
+                return await self._write()
+        return await self._write()
+
+    async def _write(self) -> bool:
+        self._prune()
+        # Снимок делается до await, с копиями записей: defer() и set_status()
+        # меняют записи на месте, пока поток хранилища сериализует документ
+        snapshot = {payment_id: dict(record) for payment_id, record in self._payments.items()}
+        return await save_user_data({"payments": snapshot}, self.storage_key)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.keep_days * 86400
+        for payment_id, record in list(self._payments.items()):
+            if record["status"] != STATUS_PENDING and record["updated_at"] < cutoff:
+                del self._payments[payment_id]
+
+    # ---------- API ----------
+
+    async def add(self, payment_id: str, user_id: int) -> dict:
+        """Записать новый платёж (статус pending)."""
+        now = time.time()
+        record = {
+            "user_id": int(user_id), "status": STATUS_PENDING, "created_at": now, "updated_at": now,
+            "attempts": 0, "next_check_at": now + FIRST_CHECK_DELAY,
+        }
+        async with self._changing() as payments:
+            payments[payment_id] = record
+        return record
+
+    @asynccontextmanager
+    async def _changing(self) -> AsyncIterator[Dict[str, dict]]:
+        """Изменение записей: у общего документа — под арендой и по свежей копии."""
+        if not self.shared:
+            payments = await self.load()
+            yield payments
+            await self._write()
+            return
+        async with lease_lock(self.storage_key, ttl=PAYMENTS_LOCK_TTL):
+            payments = await self.load()
+            yield payments
+            await self._write()
+
+    def get(self, payment_id: str) -> Optional[dict]:
+        if self._payments is None:
+            return None
+        return self._payments.get(payment_id)
+
+    async def set_status(self, payment_id: str, status: str) -> None:
+        """Перевести платёж в новый статус и сохранить."""
+        async with self._changing() as payments:
+            record = payments.get(payment_id)
+            if record is None or record["status"] == status:
+                return
+            record["status"] = status
+            record["updated_at"] = time.time()
+
+    def pending(self) -> List[str]:
+        """id платежей, ожидающих оплаты."""
+        if self._payments is None:
+            return []
+        return [pid for pid, record in self._payments.items() if record["status"] == STATUS_PENDING]
+
+    def due(self, now: float, limit: int) -> List[str]:
+        """Незавершённые платежи, которые пора сверить (самые давние сроки первыми)."""
+        due = [
+            (record.get("next_check_at", 0), payment_id)
+            for payment_id, record in self._payments.items()
+            if record["status"] == STATUS_PENDING and record.get("next_check_at", 0) <= now
+        ] if self._payments else []
+        due.sort()
+        return [payment_id for _, payment_id in due[:limit]]
+
+    def defer(self, payment_id: str, delay: float) -> None:
+        """Отложить следующую сверку; сохраняется ближайшим save()."""
+        record = self.get(payment_id)
+        if record is not None:
+            record["attempts"] = record.get("attempts", 0) + 1
+            record["next_check_at"] = time.time() + delay
+            if self.shared:
+                self._deferred[payment_id] = (record["attempts"], record["next_check_at"])
+
+    def latest_for_user(self, user_id: int) -> Optional[str]:
+        """Последний незавершённый платёж пользователя."""
+        latest = None
+        for payment_id in self.pending():
+            record = self._payments[payment_id]
+            if record["user_id"] == user_id and (latest is None or record["created_at"] > latest[1]):
+                latest = (payment_id, record["created_at"])
+        return latest[0] if latest else None
+
+
+# Единый экземпляр на процесс
+pending_payments = PendingPayments(shared=use_redis())
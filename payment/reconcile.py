@@ -0,0 +1,151 @@
+"""Фоновая сверка незавершённых платежей с ЮKassa."""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from payment.pending import STATUS_EXPIRED, STATUS_PENDING, PendingPayments, pending_payments
+from utils.shared_state import lease_store
+
+logger = logging.getLogger(__name__)
+
+# Как часто искать платежи, которым пора на сверку (секунды)
+RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "30"))
+# Одновременных запросов к ЮKassa
+RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "4"))
+# Платежей за один проход
+RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", "100"))
+# Экспоненциальная пауза между сверками одного платежа: BASE * 2^попытки, не больше MAX
+BACKOFF_BASE = float(os.getenv("PAYMENT_BACKOFF_BASE", "60"))
+BACKOFF_MAX = float(os.getenv("PAYMENT_BACKOFF_MAX", "3600"))
+# Платёж без оплаты дольше этого срока считается брошенным
+PAYMENT_EXPIRE_HOURS = float(os.getenv("PAYMENT_EXPIRE_HOURS", "24"))
+# Аренда прохода сверки (несколько воркеров)
+RECONCILE_LEASE = "payment_reconcile"
+
+PaymentFetcher = Callable[[str], Awaitable[Optional[dict]]]
+PaymentApplier = Callable[[dict], Awaitable[Any]]
+
+
+def backoff_delay(attempts: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """Пауза перед следующей сверкой после attempts неудачных попыток."""
+    return min(cap, base * (2 ** min(attempts, 30)))
+
+
+class PaymentReconciler:
+    """
+    Досверка платежей, по которым не пришло уведомление.
+
+    Раз в RECONCILE_INTERVAL секунд берёт из pending_payments платежи со
+    сроком сверки не позже текущего момента и перечитывает их из ЮKassa, не больше
+    RECONCILE_CONCURRENCY запросов одновременно. Оплаченные и отменённые
+    передаются в apply (тот же путь, что у уведомлений, — активация
+    идемпотентна). Всё ещё ожидающие откладываются с экспоненциальной
+    паузой, а старше PAYMENT_EXPIRE_HOURS — помечаются expired.
+
+    Если платежи общие для нескольких воркеров (store.shared), проход
+    делает тот, кто взял аренду RECONCILE_LEASE на интервал сверки.
+    """
+
+    def __init__(self, store: PendingPayments = pending_payments, interval: float = RECONCILE_INTERVAL,
+                 concurrency: int = RECONCILE_CONCURRENCY, batch: int = RECONCILE_BATCH):
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._fetch: Optional[PaymentFetcher] = None
+        self._apply: Optional[PaymentApplier] = None
+        self._task: Optional[asyncio.Task] = None
+        self.checked = 0
+        self.resolved = 0
+        self.expired = 0
+        self.errors = 0
+
+    async def _check(self, payment_id: str) -> None:
+        record = self.store.get(payment_id)
+        if record is None or record["status"] != STATUS_PENDING:
+            return
+        async with self._semaphore:
+            payment = await self._fetch(payment_id)
+        self.checked += 1
+
+        if payment is not None and payment["status"] in ("succeeded", "canceled"):
+            await self._apply(payment)
+            self.resolved += 1
+            logger.info(f"Сверка: платёж {payment_id} -> {payment['status']}")
+            return
+
+        if payment is None:
+            self.errors += 1
+        if time.time() - record["created_at"] > PAYMENT_EXPIRE_HOURS * 3600:
+            await self.store.set_status(payment_id, STATUS_EXPIRED)
+            self.expired += 1
+            logger.info(f"Сверка: платёж {payment_id} не оплачен, срок истёк")
+            return
+        self.store.defer(payment_id, backoff_delay(record.get("attempts", 0)))
+
+    async def run_once(self) -> int:
+        """
+        Один проход сверки.
+
+        Returns:
+            int: Сколько платежей проверено
+        """
+        await self.store.load()
+        due = self.store.due(time.time(), self.batch)
+        if not due:
+            return 0
+        results = await asyncio.gather(*(self._check(pid) for pid in due), return_exceptions=True)
+        for payment_id, result in zip(due, results):
+            if isinstance(result, Exception):
+                self.errors += 1
+                self.store.defer(payment_id, backoff_delay(self.store.get(payment_id).get("attempts", 0)))
+                logger.error(f"Ошибка сверки платежа {payment_id}: {result}")
+        # Новые сроки сверки — одной записью за проход
+        await self.store.save()
+        return len(due)
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                if not self.store.shared or await lease_store.acquire(RECONCILE_LEASE, self.interval):
+                    await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка сверки платежей: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self, fetch: PaymentFetcher, apply: PaymentApplier) -> None:
+        """
+        Запустить фоновую сверку.
+
+        Args:
+            fetch: Чтение платежа из ЮKassa (get_payment); None — ошибка запроса
+            apply: Применение оплаченного или отменённого платежа (apply_payment)
+        """
+        self._fetch = fetch
+        self._apply = apply
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "pending": len(self.store.pending()),
+            "checked": self.checked,
+            "resolved": self.resolved,
+            "expired": self.expired,
+            "errors": self.errors,
+        }
+
+
+# Единый экземпляр на процесс
+payment_reconciler = PaymentReconciler()
@@ -1,31 +1,152 @@
 import os
 import asyncio
-import yookassa
-from yookassa import Configuration, Payment
+import base64
+import uuid
 import logging
 from datetime import datetime, timedelta
 
+import aiohttp
+
 logger = logging.getLogger(__name__)
 
 # Настройка конфигурации ЮKassa
 shop_id = os.getenv("YOOKASSA_SHOP_ID")
 secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 
+# Адрес API; для локальных тестов можно указать фейковый сервер
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+# Таймаут одного запроса (секунды)
+REQUEST_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+# Повторы при сетевых ошибках, 429 и 5xx
+MAX_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "3"))
+RETRY_BASE_DELAY = 0.5
+# Максимум соединений keep-alive к API
+POOL_SIZE = int(os.getenv("YOOKASSA_POOL_SIZE", "20"))
+
+
+def _basic_auth(login: str, password: str) -> str:
+    """Заголовок Authorization для HTTP Basic (auth= у ClientSession устарел)."""
+    token = base64.b64encode(f"{login}:{password}".encode()).decode("ascii")
+    return f"Basic {token}"
+
+
+def _is_retryable(status: int) -> bool:
+    """Повторяем только 429 и 5xx; остальные 4xx — ошибка запроса, повтор не поможет."""
+    return status == 429 or status >= 500
+
+
 # ДОБАВЛЕНО: Проверка наличия ключей при старте
 if not shop_id or not secret_key:
     logger.critical("КРИТИЧЕСКАЯ ОШИБКА: YOOKASSA_SHOP_ID или YOOKASSA_SECRET_KEY не найдены в переменных окружения!")
     # Раскомментируй строку ниже, чтобы бот падал при старте, если ключей нет
     # raise ValueError("Yookassa credentials are missing in environment variables")
-else:
-    Configuration.account_id = shop_id
-    Configuration.secret_key = secret_key
+
+
+class YooKassaError(Exception):
+    """Запрос к API ЮKassa не удался (после всех повторов)."""
+
+
+async def _read_body(response: aiohttp.ClientResponse) -> dict:
+    """Тело ответа с ошибкой; {}, если это не JSON-объект (например, HTML прокси)."""
+    try:
+        body = await response.json(content_type=None)
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API ЮKassa на aiohttp.
+
+    Одна сессия на процесс с пулом keep-alive соединений; ключи магазина
+    передаются через BasicAuth сессии, глобальная конфигурация SDK не
+    нужна. POST-запросы идут с Idempotence-Key — повтор после таймаута
+    не создаст второй платёж. Сетевые ошибки, 429 и 5xx повторяются с
+    экспоненциальной паузой; 202 (ЮKassa ещё обрабатывает запрос) —
+    через retry_after из ответа.
+    """
+
+    def __init__(self, account_id: str | None = shop_id, key: str | None = secret_key,
+                 api_url: str = YOOKASSA_API_URL, timeout: float = REQUEST_TIMEOUT,
+                 retries: int = MAX_RETRIES, pool_size: int = POOL_SIZE):
+        self.account_id = account_id
+        self.key = key
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.account_id and self.key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": _basic_auth(self.account_id, self.key)},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, payload: dict | None = None) -> dict:
+        headers = {}
+        if method == "POST":
+            # Один ключ на все повторы запроса
+            headers["Idempotence-Key"] = str(uuid.uuid4())
+
+        url = f"{self.api_url}{path}"
+        for attempt in range(self.retries + 1):
+            delay = RETRY_BASE_DELAY * (2 ** attempt)
+            try:
+                async with self._get_session().request(method, url, json=payload, headers=headers) as response:
+                    # Сначала статус: у 4xx/5xx от прокси тело может быть не JSON
+                    if response.status == 202:
+                        body = await _read_body(response)
+                        delay = body.get("retry_after", delay * 1000) / 1000
+                    elif _is_retryable(response.status):
+                        body = await _read_body(response)
+                        logger.warning(f"ЮKassa {method} {path}: {response.status}, попытка {attempt + 1}")
+                    elif response.status >= 400:
+                        body = await _read_body(response)
+                        raise YooKassaError(f"{response.status}: {body.get('description')}")
+                    else:
+                        try:
+                            return await response.json(content_type=None)
+                        except ValueError:
+                            raise YooKassaError(f"{response.status}: ответ не в формате JSON") from None
+                    last_error = YooKassaError(f"{response.status}: {body.get('description')}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"ЮKassa {method} {path}: {e!r}, попытка {attempt + 1}")
+                last_error = YooKassaError(repr(e))
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+        raise last_error
+
+    async def create_payment(self, payment_dict: dict) -> dict:
+        return await self._request("POST", "/payments", payment_dict)
+
+    async def find_payment(self, payment_id: str) -> dict:
+        return await self._request("GET", f"/payments/{payment_id}")
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+# Единый экземпляр на процесс
+yookassa_api = YooKassaClient()
+
 
 async def create_payment(user_id: int, return_url: str) -> tuple[str | None, str | None]:
     """
     Создает платеж в ЮKassa.
     Возвращает кортеж: (confirmation_url, payment_id)
     """
-    if not Configuration.account_id or not Configuration.secret_key:
+    if not yookassa_api.configured:
         logger.error("Попытка создать платеж без настроенных ключей API.")
         return None, None
 
@@ -47,22 +168,40 @@ async def create_payment(user_id: int, return_url: str) -> tuple[str | None, str
             # "save_payment_method": True,
             "test": False # Сюда потом поставим False для боевого режима
         }
-        
-        payment = await asyncio.to_thread(Payment.create, payment_dict)
-
-        logger.info(f"Платеж создан: {payment.id} для пользователя {user_id}")
-        
-        url = None
-        if payment.confirmation and payment.confirmation.confirmation_url:
-            url = payment.confirmation.confirmation_url
-            
-        return url, payment.id
+
+        payment = await yookassa_api.create_payment(payment_dict)
+
+        logger.info(f"Платеж создан: {payment['id']} для пользователя {user_id}")
+
+        url = (payment.get("confirmation") or {}).get("confirmation_url")
+
+        return url, payment["id"]
     except Exception as e:
         logger.error(f"Ошибка создания платежа: {e}")
         return None, None
 
 
+async def get_payment(payment_id: str) -> dict | None:
+    """
+    Перечитывает платеж из ЮKassa.
+    Возвращает {"id", "status", "metadata"} или None при ошибке запроса.
+    """
+    if not yookassa_api.configured:
+        logger.error("Попытка проверить платеж без настроенных ключей API.")
+        return None
+
+    try:
+        payment = await yookassa_api.find_payment(payment_id)
+        return {
+            "id": payment["id"],
+            "status": payment["status"],
+            "metadata": payment.get("metadata") or {},
+        }
+    except Exception as e:
+        logger.error(f"Ошибка получения платежа {payment_id}: {e}")
+        return None
+
 
 def calculate_subscription_end_date(months: int = 1) -> str:
     """Вычисляет дату окончания подписки."""
-    return (datetime.now() + timedelta(days=30 * months)).isoformat()
\ No newline at end of file
+    return (datetime.now() + timedelta(days=30 * months)).isoformat()
@@ -12,6 +12,7 @@ from aiogram.fsm.storage.memory import MemoryStorage
 
 # Импорт утилит
 from utils.storage import save_user_data, load_user_data, user_exists
+from utils.preferences import preferences
 
 logger = logging.getLogger(__name__)
 
@@ -25,8 +26,6 @@ class RegistrationState(StatesGroup):
     confirm = State()        # Подтверждение данных
 
 
-import os
-import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -34,22 +33,10 @@ logger = logging.getLogger(__name__)
 async def is_user_registered(user_id: int) -> bool:
     """
     Проверяет, проходил ли пользователь онбординг.
-    Смотрит в файл user_preferences.json.
+    Смотрит в настройки пользователей (utils.preferences).
     """
-    file_path = "data/user_preferences.json"
-
-    # Если файла настроек нет, значит и пользователей нет
-    if not os.path.exists(file_path):
-        return False
-    
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # Если ID пользователя есть как ключ в файле, считаем, что он зарегистрирован
-            return str(user_id) in data
-    except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"Ошибка при проверке регистрации пользователя {user_id}: {e}")
-        return False
+    # Если ID пользователя есть как ключ в настройках, считаем, что он зарегистрирован
+    return await preferences.has_user(user_id)
 
 async def start_registration(message: types.Message, state: FSMContext) -> None:
     """Начинает процесс регистрации."""
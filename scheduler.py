@@ -1,94 +1,248 @@
 """Система напоминаний для дневной практики и проверки подписок."""
 import asyncio
 import os
-import json
-from datetime import datetime, time, timedelta
-from typing import List, Dict
+from datetime import date, datetime, time, timedelta
+from typing import List, Dict, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import undefined
+try:
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+except ImportError:
+    # SQLAlchemy не установлен — задачи будут только в памяти
+    SQLAlchemyJobStore = None
 import pytz
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 # Импорты из твоего проекта
 from daily_check.check import save_daily_data
-from daily_practice.schedule import get_user_practice_status, get_moscow_time
-from utils.storage import load_user_data
+from daily_practice.schedule import get_moscow_time
+from daily_practice.completions import practice_index
+from utils.subscription_index import subscription_index
+from utils.broadcast import BROADCAST_DIR, BroadcastJournal, broadcast_engine, cleanup_journals
+from utils.executor import run_io
+from utils.storage import iter_user_records
+from utils.preferences import preferences
+from utils.reminder_buckets import in_reminder_audience, reminder_buckets
+from utils.shared_state import REDIS_PREFIX, REDIS_URL, lease_store, use_redis
 
 # Настройка таймзоны Москвы
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
+# Хранилище задач планировщика: sqlite (по умолчанию), redis или memory
+SCHEDULER_JOBSTORE = os.getenv("SCHEDULER_JOBSTORE", "redis" if use_redis() else "sqlite").lower()
+SCHEDULER_DB_URL = os.getenv("SCHEDULER_DB_URL", "sqlite:///data/scheduler.sqlite3")
+
+# Ежедневная проверка подписок (МСК) и сколько её можно догонять после простоя;
+# до конца суток задача повторяется каждый час, пока проверка не выполнена
+SUBSCRIPTION_CHECK_HOUR = 12
+DAILY_MISFIRE_GRACE = 6 * 3600
+# Корзины напоминаний: сколько пропущенных минут догонять после перезапуска
+REMINDER_CATCHUP_MINUTES = 15
+# Метка «уже выполнено» живёт дольше суток, чтобы пережить любой рестарт;
+# ставится только после успешного завершения работы
+DAILY_LEASE_TTL = 36 * 3600
+# Аренда идущей работы (проверки подписок, рассылки корзины): продлевается,
+# пока работа идёт, после падения экземпляра истекает — тогда её доделает другой
+BROADCAST_RUN_LEASE_TTL = 120
+
 # Глобальная переменная для хранения экземпляра планировщика
 _scheduler_instance = None
 
+
+def _build_jobstore():
+    """Постоянное хранилище задач: переживает перезапуск, пропуски догоняются по misfire_grace_time."""
+    if SCHEDULER_JOBSTORE == "redis":
+        from apscheduler.jobstores.redis import RedisJobStore
+        from redis import Redis
+        return RedisJobStore(
+            jobs_key=f"{REDIS_PREFIX}:apscheduler.jobs",
+            run_times_key=f"{REDIS_PREFIX}:apscheduler.run_times",
+            connection_pool=Redis.from_url(REDIS_URL).connection_pool
+        )
+    if SCHEDULER_JOBSTORE == "sqlite":
+        if SQLAlchemyJobStore is not None:
+            os.makedirs("data", exist_ok=True)
+            return SQLAlchemyJobStore(url=SCHEDULER_DB_URL)
+        print("SQLAlchemy не установлен, задачи планировщика хранятся в памяти")
+    elif SCHEDULER_JOBSTORE != "memory":
+        print(f"Внимание: неизвестное значение SCHEDULER_JOBSTORE={SCHEDULER_JOBSTORE!r} "
+              f"(ожидается sqlite, redis или memory), задачи планировщика хранятся в памяти")
+    return MemoryJobStore()
+
+
+# Задачи — функции модуля, а не методы: постоянное хранилище сохраняет
+# ссылку на функцию ("scheduler:run_..."), а экземпляр с ботом берётся отсюда
+
+async def run_subscription_check():
+    if _scheduler_instance:
+        await _scheduler_instance.check_subscriptions_once_a_day()
+
+
+async def run_reminder_buckets():
+    if _scheduler_instance:
+        await _scheduler_instance.dispatch_due_buckets()
+
+
+async def run_reminder_bucket(minute: int, day: str = None):
+    if _scheduler_instance:
+        await _scheduler_instance.dispatch_reminder_bucket(minute, date.fromisoformat(day) if day else None)
+
+
+async def run_rebuild_reminder_buckets():
+    if _scheduler_instance:
+        await _scheduler_instance.rebuild_reminder_buckets()
+        await _scheduler_instance.cleanup_broadcasts()
+
+
+def reminder_broadcast_id(day, minute: int) -> str:
+    """Один журнал на корзину в день: повторный запуск не дублирует сообщения."""
+    return f"reminder_{day.isoformat()}_{minute:04d}"
+
+
+def done_marker(job_id: str) -> str:
+    """Метка успешно выполненной разовой работы (аренда на DAILY_LEASE_TTL)."""
+    return f"{job_id}:done"
+
 class ReminderScheduler:
     """Класс для управления системой напоминаний."""
     
     def __init__(self, bot):
         """Инициализация планировщика при создании объекта."""
-        self.scheduler = AsyncIOScheduler(timezone=MOSCOW_TZ)
+        self.scheduler = AsyncIOScheduler(
+            timezone=MOSCOW_TZ,
+            jobstores={'default': _build_jobstore()},
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 60}
+        )
         self.bot = bot
+
+    def _ensure_job(self, func, trigger: str, job_id: str, **kwargs):
+        """
+        Добавить задачу, сохранив срок из постоянного хранилища.
         
-        # Планируем задачи сразу при инициализации
-        self._schedule_subscription_checks()
-        self._schedule_daily_reminders()
+        Параметры задачи обновляются при каждом запуске, а next_run_time
+        остаётся сохранённым: запуск, пропущенный за время простоя,
+        догоняется в пределах misfire_grace_time, а не переносится на
+        следующий день. Вызывать после scheduler.start() — до старта
+        хранилище ещё не открыто.
+        """
+        existing = self.scheduler.get_job(job_id)
+        next_run_time = existing.next_run_time if existing is not None else undefined
+        self.scheduler.add_job(
+            func,
+            trigger,
+            id=job_id,
+            next_run_time=next_run_time,
+            replace_existing=True,
+            **kwargs
+        )
 
     def _schedule_subscription_checks(self):
-        """Добавляет задачу проверки подписок в планировщик."""
-        self.scheduler.add_job(
-            self.check_subscriptions_and_remind,
-            'interval',
-            days=1,  # Раз в день
-            id='check_subscription_reminders',
-            replace_existing=True
+        """
+        Добавляет задачу проверки подписок в планировщик.
+        
+        Cron вместо interval: время не сдвигается при каждом перезапуске,
+        а пропущенный из-за простоя запуск догоняется в пределах
+        DAILY_MISFIRE_GRACE (несколько пропусков схлопываются в один).
+        После SUBSCRIPTION_CHECK_HOUR задача срабатывает каждый час: если
+        проверка упала или экземпляр перезапустился, она повторяется, а
+        выполненная — пропускается по метке дня.
+        """
+        self._ensure_job(
+            run_subscription_check,
+            'cron',
+            'check_subscription_reminders',
+            hour=f"{SUBSCRIPTION_CHECK_HOUR}-23",
+            minute=0,
+            misfire_grace_time=DAILY_MISFIRE_GRACE
         )
 
     def _schedule_daily_reminders(self):
-        """Планирование ежедневных напоминаний в 19:00 МСК."""
-        self.scheduler.add_job(
-            self.send_daily_reminders,
+        """
+        Планирование напоминаний: каждую минуту — своя корзина пользователей.
+        
+        Время и часовой пояс каждый выбирает сам (по умолчанию 19:00 МСК),
+        поэтому отправка распределена по суткам, а не идёт одним залпом.
+        """
+        self._ensure_job(
+            run_reminder_buckets,
             'cron',
-            hour=19,
+            'reminder_buckets',
+            minute='*',
+            max_instances=3,
+            misfire_grace_time=50
+        )
+        self._ensure_job(
+            run_rebuild_reminder_buckets,
+            'cron',
+            'reminder_buckets_rebuild',
+            hour=0,
             minute=0,
-            id='daily_reminder',
-            replace_existing=True
+            timezone=pytz.utc
         )
 
-    async def check_subscriptions_and_remind(self):
-        """Проверяет окончания подписок и отправляет напоминания."""
-        file_path = "data/user_preferences.json"
-        if not os.path.exists(file_path):
+    async def check_subscriptions_once_a_day(self):
+        """
+        Проверка подписок один раз в сутки на все экземпляры бота.
+        
+        Пока проверка идёт, экземпляр держит продлеваемую аренду; метка дня
+        ставится только после успешного завершения. Упавшая или прерванная
+        проверка повторяется при следующем срабатывании задачи, а уже
+        отправленные напоминания пропускаются по журналу рассылки.
+        """
+        job_id = f"subscription_check:{get_moscow_time().date().isoformat()}"
+        if await lease_store.exists(done_marker(job_id)):
+            print("Проверка подписок сегодня уже выполнена")
             return
-
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            result = await self._run_exclusive(f"{job_id}:running", lambda: self._check_once(job_id))
+        except Exception as e:
+            print(f"Ошибка проверки подписок, повторю при следующем запуске: {e}")
+            return
+        if result is None:
+            print("Проверку подписок сейчас выполняет другой экземпляр")
 
-            now = datetime.now()
-            reminder_threshold = timedelta(days=2) # Напоминать за 2 дня
+    async def _check_once(self, job_id: str) -> bool:
+        # Другой экземпляр мог закончить, пока мы ждали аренду
+        if await lease_store.exists(done_marker(job_id)):
+            return True
+        await self.check_subscriptions_and_remind(job_id.replace(":", "_"))
+        await lease_store.acquire(done_marker(job_id), DAILY_LEASE_TTL)
+        return True
 
-            for user_id_str, user_data in data.items():
-                user_id = int(user_id_str)
-                sub_end_str = user_data.get("subscription_end_date")
-                
-                if sub_end_str:
-                    try:
-                        sub_end = datetime.fromisoformat(sub_end_str)
-                        time_left = sub_end - now
-
-                        # Если осталось 2 дня или меньше, но подписка еще активна
-                        if timedelta(0) < time_left <= reminder_threshold:
-                            days_left = time_left.days + 1 # Округление
-                            await self._send_subscription_reminder(user_id, days_left)
-                            
-                    except ValueError:
-                        continue
-        except Exception as e:
-            print(f"Ошибка проверки подписок: {e}")
+    async def check_subscriptions_and_remind(self, broadcast_id: str = None):
+        """
+        Проверяет окончания подписок и отправляет напоминания.
+        
+        Ошибки чтения индекса не перехватываются: проверка считается
+        невыполненной и повторяется.
+        """
+        now = get_moscow_time()
+        broadcast_id = broadcast_id or f"subscription_check_{now.date().isoformat()}"
+        reminder_threshold = timedelta(days=2) # Напоминать за 2 дня
+
+        # Только подписки, которые ещё активны и закончатся в ближайшие 2 дня
+        days_left = {}
+        for user_id, end_ts in await subscription_index.expiring_between(now, now + reminder_threshold):
+            time_left = timedelta(seconds=end_ts - now.timestamp())
+            days_left[user_id] = time_left.days + 1 # Округление
+        if not days_left:
+            return
+        summary = await broadcast_engine.run(
+            broadcast_id,
+            list(days_left),
+            lambda user_id: self._send_subscription_reminder(user_id, days_left[user_id])
+        )
+        print(f"Напоминания о подписке разосланы: {summary}")
 
     async def _send_subscription_reminder(self, user_id: int, days_left: int):
-        """Отправляет напоминание о подписке."""
+        """
+        Отправляет напоминание о подписке.
+        
+        Ошибки Telegram разбирает broadcast_engine (как у _send_reminder_to_user).
+        """
         text = (
             f"⏳ <b>Внимание!</b>\n\n"
             f"Твоя подписка на unTT закончится через {days_left} дн.\n\n"
@@ -98,96 +252,235 @@ class ReminderScheduler:
             [InlineKeyboardButton(text="Продлить подписку", callback_data="pay_unlock")]
         ])
         
-        try:
-            await self.bot.send_message(user_id, text, parse_mode="HTML", reply_markup=keyboard)
-        except Exception as e:
-            print(f"Не удалось отправить напоминание {user_id}: {e}")
+        await self.bot.send_message(user_id, text, parse_mode="HTML", reply_markup=keyboard)
 
-    async def send_daily_reminders(self):
-        """Отправка напоминаний пользователям, которые не выполнили практику."""
+    async def dispatch_due_buckets(self):
+        """
+        Разослать корзину текущей минуты и догнать пропущенные.
+        
+        Корзина считается разосланной только по метке, которую ставит
+        dispatch_reminder_bucket после завершения рассылки. Поэтому
+        последние REMINDER_CATCHUP_MINUTES минут без метки догоняются:
+        и пропущенные за простой, и прерванные падением ещё до первой
+        записи журнала.
+        """
+        now_utc = datetime.now(pytz.utc)
+        for back in range(REMINDER_CATCHUP_MINUTES, -1, -1):
+            moment = now_utc - timedelta(minutes=back)
+            minute = moment.hour * 60 + moment.minute
+            if not await reminder_buckets.users_at(minute):
+                continue
+            if not await lease_store.exists(done_marker(reminder_broadcast_id(moment.date(), minute))):
+                await self.dispatch_reminder_bucket(minute, moment.date())
+    
+    async def dispatch_reminder_bucket(self, minute: int = None, day=None):
+        """
+        Отправка напоминаний корзины одной минуты (UTC).
+        
+        Вызывается из dispatch_due_buckets и при докачке. Рассылку ведёт
+        один экземпляр (продлеваемая аренда), после завершения ставится
+        метка «разослано». Берёт только пользователей, выбравших это время,
+        и только тех, кто ещё не выполнил практику сегодня.
+        """
         try:
-            print(f"[{get_moscow_time()}] Начинаю отправку напоминаний о практике...")
-            
-            users_to_remind = await self._get_users_needing_reminder()
-            
-            if not users_to_remind:
-                print("Нет пользователей для напоминания")
-                return
-            
-            print(f"Найдено {len(users_to_remind)} пользователей для напоминания")
-            
-            for user_data in users_to_remind:
-                await self._send_reminder_to_user(user_data)
+            now_utc = datetime.now(pytz.utc)
+            if minute is None:
+                minute = now_utc.hour * 60 + now_utc.minute
+            day = day or now_utc.date()
+            broadcast_id = reminder_broadcast_id(day, minute)
+            # Журнал один на все экземпляры: пока его дописывает один (например,
+            # старый при выкатке новой версии), второй ту же корзину не продолжает
+            summary = await self._run_exclusive(
+                f"{broadcast_id}:running", lambda: self._send_bucket(minute, day, broadcast_id)
+            )
+            if summary is None:
+                print(f"Корзину {broadcast_id} рассылает другой экземпляр")
                 
         except Exception as e:
             print(f"Ошибка при отправке напоминаний: {e}")
     
-    async def _get_users_needing_reminder(self) -> List[Dict]:
-        """Получение списка пользователей, которым нужно отправить напоминание."""
+    async def _send_bucket(self, minute: int, day, broadcast_id: str) -> Dict[str, int]:
+        """Разослать корзину и поставить метку «разослано» (под арендой рассылки)."""
+        # Другой экземпляр мог закончить, пока мы ждали аренду
+        if await lease_store.exists(done_marker(broadcast_id)):
+            return {}
+        summary = {}
+        users_to_remind = await self._get_users_needing_reminder(minute, day)
+        if users_to_remind:
+            print(f"[{get_moscow_time()}] Корзина {minute // 60:02d}:{minute % 60:02d} UTC: "
+                  f"{len(users_to_remind)} пользователей для напоминания")
+            # Рассылка идёт параллельно с ограничением скорости; повторный запуск
+            # той же корзины в тот же день продолжает её по журналу
+            by_id = {u['user_id']: u for u in users_to_remind}
+            summary = await broadcast_engine.run(
+                broadcast_id,
+                list(by_id),
+                lambda user_id: self._send_reminder_to_user(by_id[user_id])
+            )
+            print(f"Напоминания разосланы: {summary}")
+        await lease_store.acquire(done_marker(broadcast_id), DAILY_LEASE_TTL)
+        return summary
+    
+    async def _run_exclusive(self, lease: str, job):
+        """
+        Выполнить job(), держа аренду lease (продлевается, пока job идёт).
+        
+        Returns:
+            Результат job() или None, если аренду держит другой экземпляр
+        """
+        if not await lease_store.acquire(lease, BROADCAST_RUN_LEASE_TTL):
+            return None
+        
+        async def renew():
+            while True:
+                await asyncio.sleep(BROADCAST_RUN_LEASE_TTL / 3)
+                await lease_store.renew(lease, BROADCAST_RUN_LEASE_TTL)
+        
+        renewer = asyncio.create_task(renew())
         try:
-            all_users_data = load_user_data()
-            users_to_remind = []
-            today = get_moscow_time().date()
-            
-            for user_id, user_data in all_users_data.items():
-                user_id = int(user_id)
-                practice_status = await get_user_practice_status(user_id)
-                last_completion_date = practice_status.get('last_completion_date')
-                
-                if last_completion_date:
-                    last_date = datetime.fromisoformat(last_completion_date).date()
-                    if last_date == today:
-                        continue
-                
-                users_to_remind.append({
-                    'user_id': user_id,
-                    'username': user_data.get('username', 'Пользователь'),
-                    'full_name': user_data.get('full_name', 'Без имени')
-                })
-            
-            return users_to_remind
-            
-        except Exception as e:
-            print(f"Ошибка при получении списка пользователей: {e}")
-            return []
+            return await job()
+        finally:
+            renewer.cancel()
+            await lease_store.release(lease)
+    
+    async def _get_users_needing_reminder(self, minute: int, day=None) -> List[Dict]:
+        """
+        Получение списка пользователей, которым нужно отправить напоминание.
+        
+        Корзина минуты минус выполнившие практику сегодня (practice_index) —
+        без чтения истории каждого. «Сегодня» — дата у пользователя в момент
+        корзины: в одной минуте UTC у разных часовых поясов разные даты.
+        Имя берётся из корзины, настройки заново не читаются. Ошибки не
+        перехватываются: корзина не получит метку «разослано» и догонится.
+        """
+        day = day or datetime.now(pytz.utc).date()
+        moment = pytz.utc.localize(datetime.combine(day, time(minute // 60, minute % 60)))
+        done_by_day = {}
+        users = []
+        for user_id, entry in (await reminder_buckets.entries_at(minute)).items():
+            local_day = moment.astimezone(pytz.timezone(entry.tz_name)).date()
+            if local_day not in done_by_day:
+                done_by_day[local_day] = await practice_index.done_on(local_day)
+            if user_id in done_by_day[local_day]:
+                continue
+            user = {'user_id': user_id}
+            if entry.full_name:
+                user['full_name'] = entry.full_name
+            users.append(user)
+        return users
+    
+    async def rebuild_reminder_buckets(self):
+        """
+        Разложить пользователей по минутным корзинам (раз в сутки — из-за перехода на летнее время).
+        
+        Корзины в Redis общие: их пересобирает один экземпляр в сутки (аренда
+        на дату), остальные видят результат и изменения настроек сразу.
+        """
+        today = datetime.now(pytz.utc).date()
+        if use_redis() and not await lease_store.acquire(f"reminder_buckets_rebuild:{today.isoformat()}",
+                                                         DAILY_LEASE_TTL):
+            return
+        await reminder_buckets.build(await self._reminder_audience(), today)
+
+    @staticmethod
+    async def _reminder_audience() -> List[Tuple[str, dict]]:
+        """
+        Кому напоминать: пользователи с записями практик (как до корзин)
+        и те, кто сам выбрал время напоминания.
+        """
+        practicing = await run_io(lambda: {user_id for user_id, _ in iter_user_records()})
+        audience = []
+        for user_id_str, user_data in await preferences.items():
+            user_id = int(user_id_str)
+            if in_reminder_audience(user_data, user_id in practicing):
+                audience.append((user_id_str, user_data))
+            practicing.discard(user_id)
+        # Практиковались, но настроек нет — время и пояс по умолчанию
+        audience.extend((str(user_id), {}) for user_id in practicing)
+        return audience
     
     async def _send_reminder_to_user(self, user_data: Dict):
-        """Отправка напоминания конкретному пользователю."""
-        try:
-            user_id = user_data['user_id']
-            full_name = user_data.get('full_name', 'Друг')
-            
-            reminder_text = (
-                f"⏰ Напоминание, {full_name}!\n\n"
-                "📅 Сегодня еще не выполнена дневная практика.\n\n"
-                "🌱 Помни: каждый день важен для твоего роста!\n"
-                "💪 Пропустишь день - и прогресс остановится.\n\n"
-                "Выполни практику сейчас, чтобы не потерять достижения! 🚀"
-            )
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📚 Начать практику", callback_data="daily_practice")]
-            ])
-            
-            if self.bot:
-                await self.bot.send_message(
-                    chat_id=user_id,
-                    text=reminder_text,
-                    reply_markup=keyboard
-                )
-            else:
-                print(f"Bot не инициализирован, не могу отправить сообщение пользователю {user_id}")
-            
-            print(f"Напоминание отправлено пользователю {user_id}")
-            
-        except Exception as e:
-            print(f"Ошибка отправки напоминания пользователю {user_data['user_id']}: {e}")
+        """
+        Отправка напоминания конкретному пользователю.
+        
+        Ошибки Telegram не перехватываются: их разбирает broadcast_engine
+        (пауза при 429, учёт заблокировавших бота).
+        """
+        user_id = user_data['user_id']
+        full_name = user_data.get('full_name', 'Друг')
+        
+        reminder_text = (
+            f"⏰ Напоминание, {full_name}!\n\n"
+            "📅 Сегодня еще не выполнена дневная практика.\n\n"
+            "🌱 Помни: каждый день важен для твоего роста!\n"
+            "💪 Пропустишь день - и прогресс остановится.\n\n"
+            "Выполни практику сейчас, чтобы не потерять достижения! 🚀"
+        )
+        
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📚 Начать практику", callback_data="daily_practice")]
+        ])
+        
+        if not self.bot:
+            raise RuntimeError("Bot не инициализирован")
+        await self.bot.send_message(
+            chat_id=user_id,
+            text=reminder_text,
+            reply_markup=keyboard
+        )
+
+    async def cleanup_broadcasts(self):
+        """Удалить старые журналы рассылок (раз в сутки, вместе с пересборкой корзин)."""
+        removed = await run_io(cleanup_journals)
+        if removed:
+            print(f"Удалено старых журналов рассылок: {removed}")
 
     def start(self):
-        """Запуск планировщика."""
+        """
+        Запуск планировщика.
+        
+        Планировщик работает на каждом экземпляре бота, в том числе на двух
+        сразу во время выкатки: задачи, которые нельзя выполнять дважды,
+        сами берут аренду (на дату, на корзину, на идущую рассылку).
+        """
         if not self.scheduler.running:
-            self.scheduler.start()
+            # На паузе хранилище уже открыто, но пропуски ещё не разбираются:
+            # сначала задачи получают сохранённые сроки
+            self.scheduler.start(paused=True)
+            self._schedule_subscription_checks()
+            self._schedule_daily_reminders()
+            self.scheduler.resume()
             print("Планировщик запущен.")
+            self._resume_reminders()
+    
+    def _resume_reminders(self):
+        """
+        Доотправить корзины, рассылка которых прервалась падением.
+        
+        Корзины, прерванные ещё до первой записи журнала, догоняет
+        dispatch_due_buckets: у них нет метки «разослано».
+        Корзину, которую ещё рассылает другой экземпляр (старый при выкатке),
+        dispatch_reminder_bucket пропустит: её аренда рассылки занята.
+        """
+        if not BROADCAST_DIR.exists():
+            return
+        today = datetime.now(pytz.utc).date()
+        # Вчерашние тоже: рассылку, прерванную около 23:59 UTC, поднимают уже после полуночи
+        for day in (today - timedelta(days=1), today):
+            prefix = f"reminder_{day.isoformat()}_"
+            for path in BROADCAST_DIR.glob(f"{prefix}*.jsonl"):
+                journal = BroadcastJournal(path.stem)
+                journal.load()
+                if journal.finished:
+                    continue
+                minute = int(path.stem[len(prefix):])
+                print(f"Найдена прерванная рассылка корзины {path.stem}, продолжаю")
+                self.scheduler.add_job(
+                    run_reminder_bucket,
+                    kwargs={'minute': minute, 'day': day.isoformat()},
+                    id=f'reminder_resume_{day.isoformat()}_{minute}',
+                    replace_existing=True
+                )
     
     def stop(self):
         """Остановка планировщика."""
@@ -202,6 +495,7 @@ async def start_reminder_system(bot):
     global _scheduler_instance
     if _scheduler_instance is None:
         _scheduler_instance = ReminderScheduler(bot)
+        await _scheduler_instance.rebuild_reminder_buckets()
         _scheduler_instance.start()
         print("Система напоминаний инициализирована и запущена.")
     else:
@@ -2,20 +2,45 @@
 Модуль логирования действий пользователей.
 База данных всех действий для аналитики и улучшений.
 """
-import json
+import asyncio
+import fcntl
 import logging
-from datetime import datetime, timedelta
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 from collections import defaultdict
 
 from dotenv import load_dotenv
+
+from utils import serializer
+from utils.atomic import atomic_write_bytes, atomic_write_json, note_appended
+from utils.executor import run_io
+from utils.shared_state import use_redis
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 DATA_DIR = Path("data")
-ACTIONS_FILE = DATA_DIR / "actions_log.json"
+ACTIONS_FILE = DATA_DIR / "actions_log.json"        # старый формат (только для миграции)
+LOG_FILE = DATA_DIR / "actions_log.jsonl"           # append-only лог действий
+SNAPSHOT_FILE = DATA_DIR / "actions_snapshot.json"  # компактные счётчики
+BASE_FILE = DATA_DIR / "actions_base.json"          # счётчики свёрнутых действий
+
+# Пакетная запись лога
+BATCH_TIMEOUT = 1.0         # максимум секунд ожидания до записи пачки
+BATCH_MAX_RECORDS = 500     # максимальный размер пачки
+SNAPSHOT_INTERVAL = 60.0    # секунд между сохранениями снимка
+
+# Сколько дней хранить свёртки активных пользователей
+ROLLUP_RETENTION_DAYS = 120
+
+# Хранение сырых действий: последние N действий пользователя, не старше D дней
+RETENTION_MAX_ACTIONS = int(os.getenv("ACTION_RETENTION_MAX", "1000"))
+RETENTION_DAYS = int(os.getenv("ACTION_RETENTION_DAYS", "90"))
+COMPACT_INTERVAL = 24 * 3600.0  # секунд между автоматическими компактациями
 ADMIN_ID = 5782224611
 
 # Все типы действий
@@ -67,92 +92,724 @@ def get_moscow_time():
     return datetime.now(pytz.timezone('Europe/Moscow'))
 
 
-def load_actions() -> Dict:
-    """Загрузить лог действий."""
-    if not ACTIONS_FILE.exists():
-        return {"users": {}, "global_stats": {}}
-    try:
-        with open(ACTIONS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return {"users": {}, "global_stats": {}}
+def _new_snapshot() -> Dict:
+    """Пустой снимок счётчиков."""
+    return {"log_offset": 0, "users": {}, "global_stats": {}, "rollups": {"days": {}, "weeks": {}}}
 
 
-def save_actions(data: Dict) -> None:
-    """Сохранить лог действий."""
-    DATA_DIR.mkdir(exist_ok=True)
-    with open(ACTIONS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _iso_week(date_str: str) -> str:
+    """Ключ ISO-недели для даты: 2026-W09."""
+    year, week, _ = datetime.fromisoformat(date_str).isocalendar()
+    return f"{year}-W{week:02d}"
 
 
-async def log_action(user_id: int, action: str, details: Optional[Dict] = None) -> None:
-    # Не логировать действия админа
-    if user_id == ADMIN_ID:
-        return    
+def _restore_rollups(snapshot: Dict) -> None:
     """
-    Записать действие пользователя.
+    Привести свёртки активных пользователей к множествам.
     
-    Args:
-        user_id: ID пользователя
-        action: Тип действия (ключ из ACTION_TYPES)
-        details: Дополнительные данные
+    В файле они хранятся списками. Если снимок старый и свёрток в нём нет,
+    они строятся один раз из daily_stats пользователей.
     """
-    data = load_actions()
-    user_id_str = str(user_id)
-    now = get_moscow_time()
-    today = now.date().isoformat()
-    hour = now.hour
+    rollups = snapshot.get("rollups")
+    if rollups is None:
+        rollups = {"days": {}, "weeks": {}}
+        for user_id_str, user_data in snapshot.get("users", {}).items():
+            for day in user_data.get("daily_stats", {}):
+                rollups["days"].setdefault(day, set()).add(user_id_str)
+                rollups["weeks"].setdefault(_iso_week(day), set()).add(user_id_str)
+        snapshot["rollups"] = rollups
+        return
+    for kind in ("days", "weeks"):
+        rollups[kind] = {k: set(v) for k, v in rollups.get(kind, {}).items()}
+
+
+def _prune_rollups(snapshot: Dict, today: date) -> None:
+    """Выбросить дневные/недельные свёртки старше ROLLUP_RETENTION_DAYS."""
+    oldest_day = (today - timedelta(days=ROLLUP_RETENTION_DAYS)).isoformat()
+    oldest_week = _iso_week(oldest_day)
+    rollups = snapshot["rollups"]
+    for day in [d for d in rollups["days"] if d < oldest_day]:
+        del rollups["days"][day]
+    for week in [w for w in rollups["weeks"] if w < oldest_week]:
+        del rollups["weeks"][week]
+
+
+def _log_header(generation: int) -> bytes:
+    """Первая строка лога: поколение (сколько раз лог переписан компактором)."""
+    return serializer.dumps_line({"log_generation": generation})
+
+
+def _read_generation(path: Path) -> int:
+    """Поколение лога по первой строке; у лога без заголовка — 0."""
+    try:
+        with open(path, "rb") as f:
+            header = serializer.loads(f.readline())
+        return int(header.get("log_generation", 0))
+    except Exception:
+        return 0
+
+
+def _json_default(obj):
+    """Множества из свёрток сохраняем отсортированными списками."""
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _apply_record(snapshot: Dict, record: Dict) -> None:
+    """
+    Применить одно действие к счётчикам снимка.
     
-    # Инициализация пользователя
-    if user_id_str not in data["users"]:
-        data["users"][user_id_str] = {
-            "actions": [],
+    Используется и при записи, и при воспроизведении лога.
+    """
+    user_id_str = str(record["user_id"])
+    action = record["action"]
+    timestamp = record["timestamp"]
+    today = record["date"]
+    hour = str(record["hour"])
+    
+    users = snapshot["users"]
+    if user_id_str not in users:
+        users[user_id_str] = {
             "action_counts": {},
             "hourly_stats": {},  # {hour: count}
             "daily_stats": {},   # {date: count}
-            "first_action": now.isoformat(),
-            "last_action": now.isoformat(),
+            "first_action": timestamp,
+            "last_action": timestamp,
             "total_actions": 0
         }
     
-    user_data = data["users"][user_id_str]
+    user_data = users[user_id_str]
+    user_data["total_actions"] += 1
+    user_data["last_action"] = timestamp
+    user_data["action_counts"][action] = user_data["action_counts"].get(action, 0) + 1
+    user_data["hourly_stats"][hour] = user_data["hourly_stats"].get(hour, 0) + 1
+    user_data["daily_stats"][today] = user_data["daily_stats"].get(today, 0) + 1
     
-    # Запись действия
-    action_record = {
-        "timestamp": now.isoformat(),
-        "date": today,
-        "hour": hour,
-        "action": action,
-        "action_name": ACTION_TYPES.get(action, action),
-        "details": details or {}
-    }
+    global_stats = snapshot["global_stats"]
+    global_stats["total_actions"] = global_stats.get("total_actions", 0) + 1
+    global_stats[action] = global_stats.get(action, 0) + 1
+    global_hourly = global_stats.setdefault("hourly_stats", {})
+    global_hourly[hour] = global_hourly.get(hour, 0) + 1
     
-    user_data["actions"].append(action_record)
-    user_data["total_actions"] += 1
-    user_data["last_action"] = now.isoformat()
+    # Свёртки уникальных активных пользователей по дням и ISO-неделям
+    rollups = snapshot["rollups"]
+    rollups["days"].setdefault(today, set()).add(user_id_str)
+    rollups["weeks"].setdefault(_iso_week(today), set()).add(user_id_str)
+
+
+class ActionStore:
+    """
+    Хранилище действий: append-only лог + компактный снимок счётчиков.
+    
+    Каждое действие — одна строка JSON в actions_log.jsonl. Счётчики
+    (по пользователям и глобальные) живут в памяти и периодически
+    сохраняются в actions_snapshot.json вместе со смещением в логе,
+    до которого они посчитаны. При старте читается снимок и
+    воспроизводится только хвост лога после этого смещения.
+    
+    Запись идёт пачками через ActionQueue.
+    
+    Сырые действия хранятся ограниченно (см. compact): устаревшие строки
+    удаляются из лога, а их вклад в счётчики переносится в базовый файл
+    actions_base.json, с которого начинается пересчёт.
+    
+    Компактор переписывает лог с новым поколением (заголовок — первая
+    строка лога); базовый файл и снимок помнят поколение лога, к которому
+    они относятся. Обрыв между записью базы и заменой лога доводится до
+    конца при следующей загрузке, поэтому свёрнутые действия не
+    учитываются дважды.
+    
+    shared=True — лог пишут несколько воркеров (STATE_BACKEND=redis, общий
+    каталог data/). Запись, компактация и сохранение снимка идут под
+    файловой блокировкой actions_log.jsonl.lock, а перед своей пачкой
+    воркер дочитывает строки, дописанные другими после его смещения, —
+    счётчики каждого воркера всегда соответствуют смещению в снимке.
+    Если лог тем временем сжал другой воркер, снимок перечитывается.
+    """
     
-    # Счётчик действий
-    user_data["action_counts"][action] = user_data["action_counts"].get(action, 0) + 1
+    def __init__(self, log_file: Path = LOG_FILE, snapshot_file: Path = SNAPSHOT_FILE,
+                 legacy_file: Path = ACTIONS_FILE, base_file: Path = BASE_FILE, shared: bool = False):
+        self.log_file = Path(log_file)
+        self.snapshot_file = Path(snapshot_file)
+        self.legacy_file = Path(legacy_file)
+        self.base_file = Path(base_file)
+        # Новый лог компактора, пока он не заменил текущий
+        self.next_log_file = self.log_file.with_name(self.log_file.name + ".next")
+        self._snapshot: Optional[Dict] = None
+        self._snapshot_dirty = False
+        self.shared = shared
+        self.lock_file = self.log_file.with_name(self.log_file.name + ".lock")
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_fd = None
+    
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Файловая блокировка лога между воркерами (только shared, повторный вход — без ожидания)."""
+        if not self.shared:
+            yield
+            return
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                DATA_DIR.mkdir(exist_ok=True)
+                self._lock_fd = open(self.lock_file, "ab")
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+                    self._lock_fd.close()
+                    self._lock_fd = None
+    
+    # ---------- Загрузка ----------
+    
+    @property
+    def snapshot(self) -> Dict:
+        """Текущие счётчики (загружаются при первом обращении)."""
+        if self._snapshot is None:
+            with self._locked():
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+        return self._snapshot
+    
+    def _load(self) -> Dict:
+        DATA_DIR.mkdir(exist_ok=True)
+        if not self.log_file.exists() and self.legacy_file.exists():
+            self._migrate_legacy()
+        self._recover_compaction()
+        
+        snapshot = None
+        if self.snapshot_file.exists():
+            try:
+                snapshot = serializer.load_file(self.snapshot_file)
+                _restore_rollups(snapshot)
+            except Exception as e:
+                logger.error(f"Снимок действий повреждён, пересчитываю из лога: {e}")
+                snapshot = None
+        if snapshot is not None and snapshot.get("log_generation", 0) != self._log_generation():
+            # Снимок посчитан по логу до компактации — его смещение не годится
+            logger.warning("Снимок действий от другого поколения лога, пересчитываю из базы")
+            snapshot = None
+        if snapshot is None:
+            snapshot = self._load_base()
+        
+        self._repair_tail()
+        replayed = self._replay(snapshot)
+        if replayed:
+            self._snapshot_dirty = True
+            logger.info(f"Воспроизведено {replayed} действий из лога")
+        return snapshot
+    
+    def _load_base(self) -> Dict:
+        """Счётчики, свёрнутые из удалённых компактором действий."""
+        base = _new_snapshot()
+        if self.base_file.exists():
+            try:
+                base = serializer.load_file(self.base_file)
+                _restore_rollups(base)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать {self.base_file}: {e}")
+                base = _new_snapshot()
+        base["log_offset"] = 0
+        return base
+    
+    def _log_generation(self) -> int:
+        if not self.log_file.exists():
+            return 0
+        return _read_generation(self.log_file)
+    
+    def _recover_compaction(self) -> None:
+        """
+        Довести до конца или откатить прерванную компактацию.
+        
+        Порядок записи в compact: новый лог (.next) -> база -> замена лога.
+        Если база уже того же поколения, что и новый лог, — свёрнутые
+        действия в ней, и лог надо заменить. Иначе база старая, и новый
+        лог выбрасывается.
+        """
+        if not self.next_log_file.exists():
+            return
+        next_generation = _read_generation(self.next_log_file)
+        base_generation = 0
+        if self.base_file.exists():
+            try:
+                base_generation = serializer.load_file(self.base_file).get("log_generation", 0)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать {self.base_file}: {e}")
+        if next_generation and base_generation == next_generation:
+            os.replace(self.next_log_file, self.log_file)
+            note_appended(self.log_file)
+            logger.warning(f"Компактация лога действий завершена после сбоя (поколение {next_generation})")
+        else:
+            self.next_log_file.unlink()
+            logger.warning("Прерванная компактация лога действий отменена")
+    
+    def _repair_tail(self) -> None:
+        """Отрезать недописанную последнюю строку (обрыв при записи)."""
+        if not self.log_file.exists():
+            return
+        with open(self.log_file, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Ищем последний перевод строки
+            pos = size - 1
+            chunk = 4096
+            while pos > 0:
+                start = max(0, pos - chunk)
+                f.seek(start)
+                data = f.read(pos - start)
+                idx = data.rfind(b"\n")
+                if idx != -1:
+                    f.truncate(start + idx + 1)
+                    logger.warning("Лог действий: отрезана недописанная строка")
+                    return
+                pos = start
+            f.truncate(0)
+    
+    def _replay(self, snapshot: Dict) -> int:
+        """Применить к снимку строки лога после snapshot["log_offset"]."""
+        if not self.log_file.exists():
+            snapshot["log_offset"] = 0
+            return 0
+        
+        count = 0
+        offset = snapshot.get("log_offset", 0)
+        if offset > self.log_file.stat().st_size:
+            # Лог короче снимка (заменён вручную) — пересчитываем с нуля
+            logger.warning("Смещение снимка за концом лога, пересчитываю с нуля")
+            snapshot.clear()
+            snapshot.update(self._load_base())
+            offset = 0
+        
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    record = serializer.loads(line)
+                    if "log_generation" in record:
+                        continue
+                    _apply_record(snapshot, record)
+                    count += 1
+                except Exception as e:
+                    logger.error(f"Пропущена битая строка лога действий: {e}")
+            snapshot["log_offset"] = f.tell()
+        snapshot["log_generation"] = self._log_generation()
+        return count
+    
+    def _read_since(self, offset: int) -> List[Dict]:
+        """Записи лога после offset (их дописали другие воркеры)."""
+        records = []
+        if not self.log_file.exists():
+            return records
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    record = serializer.loads(line)
+                    if "log_generation" not in record:
+                        records.append(record)
+                except Exception as e:
+                    logger.error(f"Пропущена битая строка лога действий: {e}")
+        return records
+    
+    def _catch_up(self) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        Что дописали другие воркеры (вызывать под _locked).
+        
+        Returns:
+            tuple: (свежий снимок, если лог сменил поколение, иначе None;
+                    записи после нашего смещения)
+        """
+        if self.snapshot.get("log_generation", 0) != self._log_generation():
+            return self._load(), []
+        return None, self._read_since(self.snapshot.get("log_offset", 0))
+    
+    def append_shared(self, records: List[Dict]) -> Tuple[Optional[Dict], List[Dict], int]:
+        """
+        Дописать пачку в общий лог (shared, из пула потоков).
+        
+        Returns:
+            tuple: _catch_up() и смещение конца лога после записи —
+                   передаются в apply_foreign() и apply() в потоке event loop
+        """
+        with self._locked():
+            fresh, foreign = self._catch_up()
+            return fresh, foreign, self.append_lines(records)
+    
+    def apply_foreign(self, fresh: Optional[Dict], foreign: List[Dict]) -> None:
+        """Учесть записи других воркеров (в потоке event loop)."""
+        if fresh is not None:
+            self._snapshot = fresh
+        for record in foreign:
+            _apply_record(self.snapshot, record)
+        if fresh is not None or foreign:
+            self._snapshot_dirty = True
+    
+    def _migrate_legacy(self) -> None:
+        """Одноразовый перенос старого actions_log.json в JSONL."""
+        try:
+            legacy = serializer.load_file(self.legacy_file)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать {self.legacy_file}: {e}")
+            return
+        
+        lines = []
+        for user_id_str, user_data in legacy.get("users", {}).items():
+            for action in user_data.get("actions", []):
+                record = {
+                    "user_id": int(user_id_str),
+                    "timestamp": action["timestamp"],
+                    "date": action["date"],
+                    "hour": action["hour"],
+                    "action": action["action"],
+                    "details": action.get("details") or {}
+                }
+                lines.append(serializer.dumps_line(record))
+        
+        atomic_write_bytes(self.log_file, b"".join(lines))
+        logger.info(f"Лог действий перенесён в {self.log_file}: {len(lines)} записей")
+    
+    # ---------- Запись ----------
+    
+    def load(self) -> Dict:
+        """Загрузить снимок и хвост лога (для вызова из пула потоков)."""
+        return self.snapshot
+    
+    def append_lines(self, records: List[Dict]) -> int:
+        """
+        Дописать пачку в лог одной операцией (можно вызывать из пула потоков).
+        
+        Returns:
+            int: Смещение конца лога после записи
+        """
+        payload = b"".join(serializer.dumps_line(r) for r in records)
+        DATA_DIR.mkdir(exist_ok=True)
+        with open(self.log_file, "ab") as f:
+            f.write(payload)
+            offset = f.tell()
+        note_appended(self.log_file)
+        return offset
+    
+    def apply(self, records: List[Dict], log_offset: int) -> None:
+        """Учесть записанную пачку в счётчиках (в потоке event loop)."""
+        snapshot = self.snapshot
+        for record in records:
+            _apply_record(snapshot, record)
+        snapshot["log_offset"] = log_offset
+        self._snapshot_dirty = True
+    
+    def write_batch(self, records: List[Dict]) -> None:
+        """Дописать пачку в лог и учесть её в счётчиках (синхронно)."""
+        if not records:
+            return
+        # Снимок грузится до записи, иначе загрузка воспроизведёт эту же пачку
+        self.load()
+        if self.shared:
+            fresh, foreign, offset = self.append_shared(records)
+            self.apply_foreign(fresh, foreign)
+            self.apply(records, offset)
+            return
+        self.apply(records, self.append_lines(records))
+    
+    def save_snapshot(self) -> None:
+        """Сохранить снимок счётчиков, если он изменился."""
+        if not self._snapshot_dirty:
+            return
+        with self._locked():
+            # Лог уже сжал другой воркер: наш снимок относится к старому поколению
+            if self.shared and self.snapshot.get("log_generation", 0) != self._log_generation():
+                return
+            _prune_rollups(self.snapshot, get_moscow_time().date())
+            atomic_write_json(self.snapshot_file, self.snapshot, default=_json_default)
+            self._snapshot_dirty = False
+    
+    def rebuild(self) -> Dict:
+        """Пересчитать снимок: базовые счётчики + воспроизведение всего лога."""
+        with self._locked():
+            self._recover_compaction()
+            snapshot = self._load_base()
+            self._repair_tail()
+            self._replay(snapshot)
+            self._snapshot = snapshot
+            self._snapshot_dirty = True
+            self.save_snapshot()
+            return snapshot
+    
+    def compact(self, max_actions: int = RETENTION_MAX_ACTIONS,
+                max_days: int = RETENTION_DAYS) -> Dict:
+        """
+        Ограничить сырую историю действий.
+        
+        У каждого пользователя в логе остаются только последние max_actions
+        действий и только за последние max_days дней. Остальные
+        сворачиваются в actions_base.json (те же action_counts, hourly_stats,
+        daily_stats и т.д.), поэтому итоговые счётчики и rebuild() после
+        компактации дают тот же результат. Свёртки активных пользователей
+        в базе ограничены тем же сроком, что и в снимке.
+        
+        Returns:
+            dict: Сколько строк оставлено и сколько свёрнуто
+        """
+        with self._locked():
+            if self.shared:
+                # Смещение после компактации верно, только если счётчики учли весь лог
+                self.apply_foreign(*self._catch_up())
+                self.snapshot["log_offset"] = self.log_file.stat().st_size if self.log_file.exists() else 0
+            return self._compact(max_actions, max_days)
+    
+    def _compact(self, max_actions: int, max_days: int) -> Dict:
+        result = {"kept": 0, "folded": 0}
+        if not self.log_file.exists():
+            return result
+        
+        self._recover_compaction()
+        self._repair_tail()
+        today = get_moscow_time().date()
+        cutoff = (today - timedelta(days=max_days)).isoformat()
+        
+        # Первый проход: сколько действий у каждого пользователя
+        totals: Dict[str, int] = defaultdict(int)
+        with open(self.log_file, "rb") as f:
+            for line in f:
+                try:
+                    record = serializer.loads(line)
+                    if "log_generation" not in record:
+                        totals[str(record["user_id"])] += 1
+                except Exception:
+                    continue
+        
+        # Второй проход: делим строки на оставляемые и сворачиваемые
+        base = self._load_base()
+        seen: Dict[str, int] = defaultdict(int)
+        kept_lines: List[bytes] = []
+        with open(self.log_file, "rb") as src:
+            for line in src:
+                try:
+                    record = serializer.loads(line)
+                except Exception:
+                    continue
+                if "log_generation" in record:
+                    continue
+                user_id_str = str(record["user_id"])
+                seen[user_id_str] += 1
+                is_recent = totals[user_id_str] - seen[user_id_str] < max_actions
+                if is_recent and record["date"] >= cutoff:
+                    kept_lines.append(line)
+                    result["kept"] += 1
+                else:
+                    _apply_record(base, record)
+                    result["folded"] += 1
+        
+        if not result["folded"]:
+            return result
+        
+        generation = self._log_generation() + 1
+        base.pop("log_offset", None)
+        base["log_generation"] = generation
+        _prune_rollups(base, today)
+        new_log = _log_header(generation) + b"".join(kept_lines)
+        # Сбой между шагами разбирает _recover_compaction при следующей загрузке
+        atomic_write_bytes(self.next_log_file, new_log)
+        atomic_write_json(self.base_file, base, default=_json_default)
+        os.replace(self.next_log_file, self.log_file)
+        note_appended(self.log_file)
+        
+        # Счётчики не меняются, меняется только позиция конца лога
+        self.snapshot["log_offset"] = len(new_log)
+        self.snapshot["log_generation"] = generation
+        self._snapshot_dirty = True
+        self.save_snapshot()
+        logger.info(f"Компактация лога действий: оставлено {result['kept']}, свёрнуто {result['folded']}")
+        return result
+
+
+class _Command:
+    """Служебная операция над хранилищем, выполняемая потребителем очереди."""
     
-    # Почасовая статистика
-    user_data["hourly_stats"][str(hour)] = user_data["hourly_stats"].get(str(hour), 0) + 1
+    def __init__(self, func, future: asyncio.Future):
+        self.func = func
+        self.future = future
+
+
+class ActionQueue:
+    """
+    Очередь логирования действий.
     
-    # Дневная статистика
-    user_data["daily_stats"][today] = user_data["daily_stats"].get(today, 0) + 1
+    log_action только кладёт запись в asyncio.Queue и сразу возвращается.
+    Единственная фоновая задача забирает записи пачками (до BATCH_MAX_RECORDS
+    штук или по истечении BATCH_TIMEOUT секунд) и пишет каждую пачку в
+    ActionStore одной операцией. Снимок счётчиков сохраняется не чаще
+    раза в SNAPSHOT_INTERVAL секунд и обязательно при остановке.
     
-    # Глобальная статистика
-    if "global_stats" not in data:
-        data["global_stats"] = {}
+    Запись в файлы, сериализация, компактация и пересчёт выполняются в пуле
+    потоков хранилища. Всё это делает только задача-потребитель, по очереди,
+    поэтому счётчики никогда не сериализуются одновременно с изменением.
+    """
+    
+    def __init__(self, store: ActionStore, batch_size: int = BATCH_MAX_RECORDS,
+                 batch_timeout: float = BATCH_TIMEOUT):
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_snapshot = 0.0
+        self._last_compact = 0.0
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def put(self, record: Dict) -> None:
+        """Поставить действие в очередь (без ожидания диска)."""
+        if not self.running:
+            # Очередь не запущена (скрипты, тесты) — пишем сразу
+            self.store.write_batch([record])
+            return
+        self._queue.put_nowait(record)
+    
+    async def submit(self, func):
+        """
+        Выполнить операцию над хранилищем (rebuild, compact) в порядке очереди.
+        
+        Returns:
+            Результат func
+        """
+        if not self.running:
+            return await run_io(func)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Command(func, future))
+        return await future
+    
+    async def _next_batch(self) -> List:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_timeout
+        # Пачка заканчивается на маркере остановки или служебной команде
+        while len(batch) < self.batch_size and isinstance(batch[-1], dict):
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._last_snapshot = loop.time()
+        self._last_compact = loop.time()
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1] is None
+            records = [r for r in batch if isinstance(r, dict)]
+            try:
+                if records:
+                    if self.store.shared:
+                        fresh, foreign, offset = await run_io(self.store.append_shared, records)
+                        self.store.apply_foreign(fresh, foreign)
+                    else:
+                        offset = await run_io(self.store.append_lines, records)
+                    self.store.apply(records, offset)
+                if stop or loop.time() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+                    await run_io(self.store.save_snapshot)
+                    self._last_snapshot = loop.time()
+            except Exception as e:
+                logger.error(f"Ошибка записи пачки действий ({len(records)} шт.): {e}")
+            
+            command = batch[-1]
+            if isinstance(command, _Command):
+                # Вызывающий мог уже отменить ожидание (таймаут, остановка):
+                # в отменённый future писать нельзя, а падать потребителю —
+                # тем более, иначе log_action перейдёт на синхронную запись
+                try:
+                    result = await run_io(command.func)
+                except Exception as e:
+                    if not command.future.done():
+                        command.future.set_exception(e)
+                else:
+                    if not command.future.done():
+                        command.future.set_result(result)
+            
+            if not stop and loop.time() - self._last_compact >= COMPACT_INTERVAL:
+                self._last_compact = loop.time()
+                try:
+                    await run_io(self.store.compact)
+                except Exception as e:
+                    logger.error(f"Ошибка компактации лога действий: {e}")
+            if stop:
+                return
+    
+    def start(self) -> None:
+        """Запустить фоновую запись (снимок лучше заранее загрузить через store.load)."""
+        if not self.running:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._consume())
+    
+    async def close(self) -> None:
+        """Дописать всё, что в очереди, и остановить фоновую задачу."""
+        if self.running:
+            # Маркер конца: всё, что было в очереди до него, будет записано
+            self._queue.put_nowait(None)
+            await self._task
+        self._task = None
+        await run_io(self.store.save_snapshot)
+
+
+action_store = ActionStore(shared=use_redis())
+action_queue = ActionQueue(action_store)
+
+
+def load_actions() -> Dict:
+    """Текущий снимок счётчиков действий."""
+    return action_store.snapshot
+
+
+def save_actions() -> None:
+    """Сохранить снимок счётчиков действий."""
+    action_store.save_snapshot()
+
+
+async def log_action(user_id: int, action: str, details: Optional[Dict] = None) -> None:
+    """
+    Записать действие пользователя.
     
-    data["global_stats"]["total_actions"] = data["global_stats"].get("total_actions", 0) + 1
-    data["global_stats"][action] = data["global_stats"].get(action, 0) + 1
+    Запись ставится в очередь и попадает на диск фоновой задачей,
+    поэтому вызов не ждёт файловых операций.
     
-    # Глобальная почасовая
-    if "hourly_stats" not in data["global_stats"]:
-        data["global_stats"]["hourly_stats"] = {}
-    data["global_stats"]["hourly_stats"][str(hour)] = data["global_stats"]["hourly_stats"].get(str(hour), 0) + 1
+    Args:
+        user_id: ID пользователя
+        action: Тип действия (ключ из ACTION_TYPES)
+        details: Дополнительные данные
+    """
+    # Не логировать действия админа
+    if user_id == ADMIN_ID:
+        return
     
-    save_actions(data)
+    now = get_moscow_time()
+    action_queue.put({
+        "user_id": user_id,
+        "timestamp": now.isoformat(),
+        "date": now.date().isoformat(),
+        "hour": now.hour,
+        "action": action,
+        "details": details or {}
+    })
     logger.info(f"[ACTION_LOG] user={user_id}, action={action}")
 
 
@@ -199,20 +856,21 @@ async def get_global_stats() -> Dict:
     data = load_actions()
     users = data.get("users", {})
     global_stats = data.get("global_stats", {})
+    day_rollups = data["rollups"]["days"]
     
     # Активные пользователи сегодня
-    today = get_moscow_time().date().isoformat()
-    active_today = sum(
-        1 for u in users.values() 
-        if today in u.get("daily_stats", {})
-    )
-    
-    # Активные за неделю
-    week_ago = (get_moscow_time() - timedelta(days=7)).date().isoformat()
-    active_week = sum(
-        1 for u in users.values() 
-        if any(d >= week_ago for d in u.get("daily_stats", {}).keys())
-    )
+    now = get_moscow_time()
+    today = now.date()
+    active_today = len(day_rollups.get(today.isoformat(), ()))
+    
+    # Активные за неделю: объединение дневных свёрток за последние 7 дней
+    week_users = set()
+    for days_back in range(8):
+        week_users |= day_rollups.get((today - timedelta(days=days_back)).isoformat(), set())
+    active_week = len(week_users)
+    
+    # Активные за текущую ISO-неделю
+    active_iso_week = len(data["rollups"]["weeks"].get(_iso_week(today.isoformat()), ()))
     
     # Всего пользователей
     total_users = len(users)
@@ -233,6 +891,7 @@ async def get_global_stats() -> Dict:
         "total_actions": global_stats.get("total_actions", 0),
         "active_today": active_today,
         "active_week": active_week,
+        "active_iso_week": active_iso_week,
         "top_actions": [(ACTION_TYPES.get(a, a), c) for a, c in top_global],
         "peak_hours": [(f"{h}:00", c) for h, c in global_peak_hours]
     }
@@ -277,6 +936,7 @@ async def format_global_report() -> str:
         f"Всего действий: {stats['total_actions']}",
         f"Активных сегодня: {stats['active_today']}",
         f"Активных за неделю: {stats['active_week']}",
+        f"Активных на этой неделе (пн–вс): {stats['active_iso_week']}",
         "",
         "🔝 Топ действий (все пользователи):"
     ]
@@ -292,9 +952,6 @@ async def format_global_report() -> str:
 
 
 # Команда для админа
-ADMIN_ID = 5782224611  # Твой ID
-
-
 async def handle_action_logger_command(message, user_id: int) -> str:
     """Обработать команду /action_logger."""
     if user_id != ADMIN_ID:
@@ -307,6 +964,20 @@ async def handle_action_logger_command(message, user_id: int) -> str:
         # Общая статистика
         return await format_global_report()
     
+    elif len(args) == 2 and args[1] == "rebuild":
+        # Пересчёт снимка и свёрток из лога
+        snapshot = await action_queue.submit(action_store.rebuild)
+        return (
+            f"Снимок пересчитан из лога.\n"
+            f"Действий: {snapshot['global_stats'].get('total_actions', 0)}, "
+            f"пользователей: {len(snapshot['users'])}"
+        )
+    
+    elif len(args) == 2 and args[1] == "compact":
+        # Свернуть устаревшие сырые действия
+        result = await action_queue.submit(action_store.compact)
+        return f"Компактация: оставлено {result['kept']}, свёрнуто {result['folded']}"
+    
     elif len(args) == 2:
         # Конкретный пользователь
         try:
@@ -316,12 +987,17 @@ async def handle_action_logger_command(message, user_id: int) -> str:
             return "Неверный формат ID"
     
     else:
-        return "Использование:\n/action_logger — общая статистика\n/action_logger <user_id> — статистика пользователя"
+        return "Использование:\n/action_logger — общая статистика\n/action_logger <user_id> — статистика пользователя\n/action_logger rebuild — пересчитать статистику из лога\n/action_logger compact — свернуть старые действия"
 
 async def backup_actions() -> None:
     """Создать бэкап лога действий"""
     import shutil
-    if ACTIONS_FILE.exists():
-        backup_file = DATA_DIR / "actions_log_backup.json"
-        shutil.copy(ACTIONS_FILE, backup_file)
-        logger.info("Бэкап действий создан")
\ No newline at end of file
+    
+    def copy_files() -> None:
+        action_store.save_snapshot()
+        if LOG_FILE.exists():
+            shutil.copy(LOG_FILE, DATA_DIR / "actions_log_backup.jsonl")
+            shutil.copy(SNAPSHOT_FILE, DATA_DIR / "actions_snapshot_backup.json")
+            logger.info("Бэкап действий создан")
+    
+    await action_queue.submit(copy_files)
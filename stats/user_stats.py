@@ -1,21 +1,53 @@
 """Модуль статистики пользователя."""
 import logging
 from datetime import datetime, timedelta
-from typing import Dict
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, Optional
+import asyncio
 import os
+import weakref
 
-from utils.storage import save_user_data, load_user_data
+from utils.storage import save_user_data, load_user_data_async
+from utils.locks import storage_locks
+from utils.shared_state import lease_lock, use_redis
 from daily_practice.schedule import get_moscow_time
 
 logger = logging.getLogger(__name__)
 
+# Размер кольцевого буфера дневных счётчиков (дней); должен покрывать "month"
+COUNTER_DAYS = 32
+
+# Сколько последних событий каждого типа хранить целиком; количества
+# берутся из daily_counters и event_totals, а не из этих списков
+STATS_EVENTS_KEEP = int(os.getenv("STATS_EVENTS_KEEP", "50"))
+
+# Сколько дней назад (включительно с сегодняшним) охватывает период
+PERIOD_DAYS = {"today": 0, "week": 7, "month": 30}
+
+# Реестр живых объектов UserStats
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "1000"))
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+# Срок аренды на изменение статистики пользователя (несколько воркеров)
+STATS_LOCK_TTL = 30
+
+
 class UserStats:
     """Класс для управления статистикой пользователя."""
     
-    def __init__(self, user_id: int):
+    def __init__(self, user_id: int, on_change: Optional[Callable[["UserStats"], None]] = None,
+                 shared: bool = False):
         self.user_id = user_id
         self.stats_key = f"user_stats_{user_id}"
         self.data = None  # Данные будут загружены при первом запросе (lazy loading)
+        # Если задан (объект живёт в реестре), изменения не пишутся сразу,
+        # а помечаются «грязными» и сбрасываются реестром
+        self._on_change = on_change
+        # Данные пользователя удалены (/unstart) — изменения больше не сохраняются
+        self._discarded = False
+        # Статистику пишут несколько воркеров: каждое изменение перечитывает
+        # запись под арендой пользователя и сразу сохраняет её
+        self._shared = shared
 
     def _create_default_stats(self) -> Dict:
         """Создает структуру статистики по умолчанию."""
@@ -44,14 +76,60 @@ class UserStats:
                 "active_days": 0,
                 "slips_today": 0
             },
-            "last_slip_date": None
+            "last_slip_date": None,
+            # Счётчики событий по дням: слот = номер дня % COUNTER_DAYS
+            "daily_counters": self._empty_counters(),
+            # Общее количество событий каждого типа
+            "event_totals": {}
         }
 
+    @staticmethod
+    def _empty_counters() -> Dict:
+        """Пустой кольцевой буфер дневных счётчиков."""
+        return {"days": [0] * COUNTER_DAYS, "events": {}}
+
+    @staticmethod
+    def _bump_counter(stats_data: Dict, event_type: str, day_ordinal: int) -> None:
+        """Увеличивает счётчик события за день (слот старого дня обнуляется)."""
+        counters = stats_data["daily_counters"]
+        slot = day_ordinal % COUNTER_DAYS
+        if counters["days"][slot] != day_ordinal:
+            counters["days"][slot] = day_ordinal
+            for values in counters["events"].values():
+                values[slot] = 0
+        values = counters["events"].setdefault(event_type, [0] * COUNTER_DAYS)
+        values[slot] += 1
+
+    def _ensure_counters(self, stats_data: Dict) -> None:
+        """МИГРАЦИЯ: строит дневные счётчики и итоги из списков событий."""
+        if "daily_counters" in stats_data and "event_totals" in stats_data:
+            return
+
+        stats_data["daily_counters"] = self._empty_counters()
+        stats_data["event_totals"] = {}
+        oldest = get_moscow_time().date().toordinal() - (COUNTER_DAYS - 1)
+
+        for event_type, events in stats_data.get("events", {}).items():
+            stats_data["event_totals"][event_type] = len(events)
+            for event in events:
+                try:
+                    day_ordinal = datetime.fromisoformat(event["date"]).toordinal()
+                except (KeyError, ValueError):
+                    continue
+                if day_ordinal >= oldest:
+                    self._bump_counter(stats_data, event_type, day_ordinal)
+
+    @staticmethod
+    def _trim_events(stats_data: Dict) -> None:
+        """МИГРАЦИЯ: обрезает списки событий, накопленные до ограничения STATS_EVENTS_KEEP."""
+        for events in stats_data["events"].values():
+            del events[:-STATS_EVENTS_KEEP]
+
     async def _load_stats(self) -> Dict:
         """Асинхронно загружает статистику пользователя."""
         try:
-            # load_user_data - СИНХРОННАЯ функция, await НЕ нужен
-            stats_data = load_user_data(self.stats_key)
+            # Чтение и разбор JSON — в пуле потоков хранилища
+            stats_data = await load_user_data_async(self.stats_key)
             
             if not stats_data:
                 # Если файла нет, создаем дефолтный и сохраняем
@@ -76,6 +154,11 @@ class UserStats:
                 stats_data["streaks"] = defaults["streaks"]
             if "summary" not in stats_data:
                 stats_data["summary"] = defaults["summary"]
+            
+            self._ensure_counters(stats_data)
+            # После переноса количеств в счётчики полная история не нужна:
+            # сброс реестра пишет запись размером в окно, а не во всю историю
+            self._trim_events(stats_data)
                 
             return stats_data
                 
@@ -87,15 +170,41 @@ class UserStats:
         """Асинхронно сохраняет статистику пользователя."""
         try:
             data_to_save = stats_data or self.data
-            data_to_save["updated_at"] = get_moscow_time().isoformat()
             
-            # Меняем местами аргументы: сначала данные, потом ключ
-            await save_user_data(data_to_save, self.stats_key)
+            # Под блокировкой пользователя данные никто не меняет,
+            # пока поток хранилища их сериализует. save_user_data берёт
+            # блокировку из document_locks — порядок user -> документ
+            # единый для всех, взаимной блокировки нет
+            async with storage_locks.user(self.user_id):
+                data_to_save["updated_at"] = get_moscow_time().isoformat()
+                # Меняем местами аргументы: сначала данные, потом ключ
+                await save_user_data(data_to_save, self.stats_key)
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения статистики для user_id {self.user_id}: {e}")
             return False
 
+    @asynccontextmanager
+    async def _locked(self) -> AsyncIterator[None]:
+        """Блокировка на изменение: пользователь, а у общих данных — ещё и аренда."""
+        async with storage_locks.user(self.user_id):
+            if not self._shared:
+                if self.data is None:
+                    self.data = await self._load_stats()
+                yield
+                return
+            async with lease_lock(f"user_stats:{self.user_id}", ttl=STATS_LOCK_TTL):
+                # Другой воркер мог изменить запись после нашей загрузки
+                self.data = await self._load_stats()
+                yield
+
+    async def _commit(self) -> None:
+        """Фиксирует изменения: сразу на диск или через реестр (отложенно)."""
+        if self._on_change is not None:
+            self._on_change(self)
+        else:
+            await self._save_stats()
+
     async def _update_streak(self) -> None:
         """Обновляет информацию о серии активных дней."""
         today = get_moscow_time().date()
@@ -124,14 +233,23 @@ class UserStats:
     async def _add_event(self, event_type: str, event_data: Dict = None) -> None:
         """Добавляет событие в статистику."""
         event_data = event_data or {}
+        now = get_moscow_time()
         event_data.update({
-            "timestamp": get_moscow_time().isoformat(),
-            "date": get_moscow_time().date().isoformat()
+            "timestamp": now.isoformat(),
+            "date": now.date().isoformat()
         })
         
-        self.data["events"][event_type].append(event_data)
+        events = self.data["events"][event_type]
+        events.append(event_data)
+        # Храним только последние события, иначе запись растёт без предела
+        del events[:-STATS_EVENTS_KEEP]
         self.data["summary"]["total_events"] += 1
         
+        # Дневной счётчик и итог по типу
+        self._bump_counter(self.data, event_type, now.date().toordinal())
+        totals = self.data["event_totals"]
+        totals[event_type] = totals.get(event_type, 0) + 1
+        
         # Обновляем счетчики по типам
         if event_type == "quick_pause":
             self.data["summary"]["total_pauses"] += 1
@@ -146,100 +264,267 @@ class UserStats:
         await self._update_streak()
         
         # Сохраняем изменения
-        await self._save_stats()
+        await self._commit()
 
     async def update_stats(self, event_type: str, event_data: Dict = None) -> bool:
         """Публичный метод для обновления статистики."""
         try:
-            # Если данные еще не загружены, загружаем их
-            if self.data is None:
-                self.data = await self._load_stats()
-                
-            await self._add_event(event_type, event_data)
+            # Изменения — под блокировкой пользователя (см. _save_stats);
+            # данные загружаются под ней же
+            async with self._locked():
+                await self._add_event(event_type, event_data)
             return True
         except Exception as e:
             logger.error(f"Ошибка в update_stats: {e}")
             return False
 
-    async def get_stats(self, period: str = "total") -> Dict:
-        """Получить статистику за период: today, week, month, total"""
-        data = await self._load_stats()
+    async def get_period_counts(self) -> Dict[str, Dict[str, int]]:
+        """
+        Количество событий каждого типа сразу за все периоды.
         
-        now = get_moscow_time()
-        if period == "today":
-            start_date = now.date()
-        elif period == "week":
-            start_date = (now - timedelta(days=7)).date()
-        elif period == "month":
-            start_date = (now - timedelta(days=30)).date()
-        else:
-            start_date = None
+        Одна загрузка статистики; today/week/month — суммы по окну
+        кольцевого буфера (не больше COUNTER_DAYS слотов), total — из итогов.
         
-        result = {"events_count": {}}
+        Returns:
+            dict: {"today": {...}, "week": {...}, "month": {...}, "total": {...}}
+        """
+        if self.data is None:
+            self.data = await self._load_stats()
+        data = self.data
+        counters = data["daily_counters"]
+        today_ordinal = get_moscow_time().date().toordinal()
         
-        for event_type, events in data.get("events", {}).items():
-            if start_date:
-                count = sum(1 for e in events if e.get("date", "") >= start_date.isoformat())
-            else:
-                count = len(events)
-            result["events_count"][event_type] = count
+        result = {period: {} for period in PERIOD_DAYS}
+        result["total"] = {}
+        
+        for event_type in data.get("events", {}):
+            values = counters["events"].get(event_type)
+            for period, back_days in PERIOD_DAYS.items():
+                count = 0
+                if values:
+                    for day_ordinal in range(today_ordinal - back_days, today_ordinal + 1):
+                        slot = day_ordinal % COUNTER_DAYS
+                        if counters["days"][slot] == day_ordinal:
+                            count += values[slot]
+                result[period][event_type] = count
+            result["total"][event_type] = data["event_totals"].get(event_type, 0)
         
         return result
 
+    async def get_stats(self, period: str = "total") -> Dict:
+        """Получить статистику за период: today, week, month, total"""
+        counts = await self.get_period_counts()
+        return {"events_count": counts.get(period, counts["total"])}
+
     async def increment_slip(self) -> int:
         """
         Увеличивает счетчик срывов за сегодня.
         Сбрасывает счетчик, если наступил новый день (после 7:00 МСК).
         Возвращает текущее значение счетчика.
         """
-        now = get_moscow_time()
+        async with self._locked():
+            now = get_moscow_time()
         
-        # Логика "Новый день" начинается в 07:00
-        # Если сейчас раньше 7 утра, считаем, что всё еще "вчерашний" день
-        today_date = now.date()
-        if now.hour < 7:
-            today_date = today_date - timedelta(days=1)
-
-        last_slip_str = self.data.get("last_slip_date")
-        reset_needed = False
-
-        if last_slip_str:
-            # Парсим дату последнего срыва (хранится как ISO date string, YYYY-MM-DD)
-            # Если хранится полный ISO timestamp, берем только дату
-            try:
-                if "T" in last_slip_str:
-                    last_date = datetime.fromisoformat(last_slip_str).date()
-                else:
-                    last_date = datetime.strptime(last_slip_str, "%Y-%m-%d").date()
+            # Логика "Новый день" начинается в 07:00
+            # Если сейчас раньше 7 утра, считаем, что всё еще "вчерашний" день
+            today_date = now.date()
+            if now.hour < 7:
+                today_date = today_date - timedelta(days=1)
+
+            last_slip_str = self.data.get("last_slip_date")
+            reset_needed = False
+
+            if last_slip_str:
+                # Парсим дату последнего срыва (хранится как ISO date string, YYYY-MM-DD)
+                # Если хранится полный ISO timestamp, берем только дату
+                try:
+                    if "T" in last_slip_str:
+                        last_date = datetime.fromisoformat(last_slip_str).date()
+                    else:
+                        last_date = datetime.strptime(last_slip_str, "%Y-%m-%d").date()
                 
-                if last_date < today_date:
+                    if last_date < today_date:
+                        reset_needed = True
+                except Exception:
                     reset_needed = True
-            except Exception:
+            else:
                 reset_needed = True
-        else:
-            reset_needed = True
 
-        if reset_needed:
-            self.data["summary"]["slips_today"] = 0
+            if reset_needed:
+                self.data["summary"]["slips_today"] = 0
 
-        # Увеличиваем счетчик
-        current_count = self.data["summary"].get("slips_today", 0) + 1
-        self.data["summary"]["slips_today"] = current_count
+            # Увеличиваем счетчик
+            current_count = self.data["summary"].get("slips_today", 0) + 1
+            self.data["summary"]["slips_today"] = current_count
         
-        # Сохраняем дату последнего срыва (только дата, без времени)
-        self.data["last_slip_date"] = today_date.isoformat()
+            # Сохраняем дату последнего срыва (только дата, без времени)
+            self.data["last_slip_date"] = today_date.isoformat()
         
-        await self._save_stats()
+            await self._commit()
         return current_count   
     
     
 
+class UserStatsRegistry:
+    """
+    LRU-реестр живых объектов UserStats.
+    
+    Объект пользователя загружается один раз и дальше живёт в памяти.
+    Изменения помечают его «грязным»; фоновая задача раз в
+    STATS_FLUSH_INTERVAL секунд сохраняет грязные объекты. При переполнении
+    вытесняется давно не использованный пользователь — перед удалением
+    его данные записываются на диск.
+    
+    Вытесненный объект может ещё держать вызывающий код. Пока он жив,
+    get() возвращает его же, а не свежую копию с диска, а изменение такого
+    объекта возвращает его в реестр — на пользователя всегда один объект.
+    
+    shared=True (несколько воркеров, STATE_BACKEND=redis): кэша нет —
+    объект в памяти одного воркера устарел бы после записи другого.
+    get() каждый раз читает запись, изменения пишутся сразу (см. UserStats).
+    """
+    
+    def __init__(self, capacity: int = STATS_CACHE_SIZE, flush_interval: float = STATS_FLUSH_INTERVAL,
+                 shared: bool = False):
+        self.capacity = max(1, capacity)
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._items: "OrderedDict[int, UserStats]" = OrderedDict()
+        self._dirty: Dict[int, UserStats] = {}
+        # Вытесняемые объекты, пока идёт их запись (чтобы не прочитать старое)
+        self._evicting: Dict[int, UserStats] = {}
+        # Вытесненные объекты, на которые ещё есть ссылки
+        self._detached: "weakref.WeakValueDictionary[int, UserStats]" = weakref.WeakValueDictionary()
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+    
+    def _mark_dirty(self, stats: UserStats) -> None:
+        if stats._discarded:
+            return
+        user_id = stats.user_id
+        if self._items.get(user_id) is not stats and self._evicting.get(user_id) is not stats:
+            # Объект уже вытеснен, а держатель его изменил. Другой копии
+            # нет (get() вернул бы этот же объект) — возвращаем его в реестр,
+            # лишнее вытеснит следующий flush()
+            self._detached.pop(user_id, None)
+            self._items[user_id] = stats
+        self._dirty[user_id] = stats
+    
+    async def get(self, user_id: int) -> UserStats:
+        """Возвращает загруженный UserStats пользователя."""
+        if self.shared:
+            self.misses += 1
+            stats = UserStats(user_id, shared=True)
+            stats.data = await stats._load_stats()
+            return stats
+        
+        stats = self._items.get(user_id)
+        if stats is not None:
+            self._items.move_to_end(user_id)
+            self.hits += 1
+            return stats
+        
+        stats = self._evicting.get(user_id)
+        if stats is None:
+            stats = self._detached.pop(user_id, None)
+        if stats is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            stats = UserStats(user_id, on_change=self._mark_dirty)
+            stats.data = await stats._load_stats()
+            # Пока грузили, объект мог появиться в реестре
+            if user_id in self._items:
+                return self._items[user_id]
+            if user_id in self._evicting:
+                stats = self._evicting[user_id]
+        
+        self._items[user_id] = stats
+        await self._evict_overflow()
+        return stats
+    
+    async def _write(self, stats: UserStats) -> None:
+        self._dirty.pop(stats.user_id, None)
+        if await stats._save_stats():
+            self.writes += 1
+        else:
+            self._dirty[stats.user_id] = stats
+    
+    async def _evict_overflow(self) -> None:
+        while len(self._items) > self.capacity:
+            user_id, stats = self._items.popitem(last=False)
+            self.evictions += 1
+            self._detached[user_id] = stats
+            if user_id in self._dirty:
+                self._evicting[user_id] = stats
+                try:
+                    await self._write(stats)
+                finally:
+                    self._evicting.pop(user_id, None)
+    
+    async def flush(self) -> None:
+        """Сохранить все грязные объекты."""
+        await self._evict_overflow()
+        for stats in list(self._dirty.values()):
+            await self._write(stats)
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сброса статистики: {e}")
+    
+    def start(self) -> None:
+        """Запустить периодический сброс."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self) -> None:
+        """Остановить сброс и записать всё грязное."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def discard(self, user_id: int) -> None:
+        """Забыть пользователя без записи на диск (данные удаляются)."""
+        for objects in (self._items, self._evicting, self._detached):
+            stats = objects.pop(user_id, None)
+            if stats is not None:
+                stats._discarded = True
+        self._dirty.pop(user_id, None)
+    
+    def metrics(self) -> Dict[str, int]:
+        """Счётчики для подбора размера реестра."""
+        return {
+            "size": len(self._items),
+            "capacity": self.capacity,
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writes": self.writes,
+        }
+
+
+stats_registry = UserStatsRegistry(shared=use_redis())
+
+
 # --- Асинхронные обертки (добавить после класса) ---
 
 async def update_stats(user_id: int, event_type: str, event_data: dict = None) -> bool:
     """Асинхронная функция-обертка для обновления статистики."""
     try:
-        stats = UserStats(user_id)
+        stats = await stats_registry.get(user_id)
         return await stats.update_stats(event_type, event_data)
     except Exception as e:
         logger = logging.getLogger(__name__)
@@ -249,7 +534,7 @@ async def update_stats(user_id: int, event_type: str, event_data: dict = None) -
 async def get_stats(user_id: int, period: str = "total") -> dict:
     """Асинхронная функция-обертка для получения статистики."""
     try:
-        stats = UserStats(user_id)
+        stats = await stats_registry.get(user_id)
         return await stats.get_stats(period)
     except Exception as e:
         logger = logging.getLogger(__name__)
@@ -267,8 +552,7 @@ async def get_stats(user_id: int, period: str = "total") -> dict:
 async def update_stats(user_id: int, event_type: str, event_data: dict = None) -> bool:
     """Асинхронная функция-обертка для обновления статистики."""
     try:
-        stats = UserStats(user_id)
-        # ВАЖНО: Добавляем await, так как метод класса теперь асинхронный
+        stats = await stats_registry.get(user_id)
         return await stats.update_stats(event_type, event_data)
     except Exception as e:
         logger = logging.getLogger(__name__)
@@ -278,10 +562,18 @@ async def update_stats(user_id: int, event_type: str, event_data: dict = None) -
 async def get_stats(user_id: int, period: str = "total") -> dict:
     """Асинхронная функция-обертка для получения статистики."""
     try:
-        stats = UserStats(user_id)
-        # ВАЖНО: Добавляем await, так как метод класса теперь асинхронный
+        stats = await stats_registry.get(user_id)
         return await stats.get_stats(period)
     except Exception as e:
         logger = logging.getLogger(__name__)
         logger.error(f"Ошибка в async wrapper get_stats для user {user_id}: {e}")
-        return {}
\ No newline at end of file
+        return {}
+
+async def get_period_stats(user_id: int) -> dict:
+    """Количество событий за today/week/month/total одним вызовом."""
+    try:
+        stats = await stats_registry.get(user_id)
+        return await stats.get_period_counts()
+    except Exception as e:
+        logger.error(f"Ошибка в async wrapper get_period_stats для user {user_id}: {e}")
+        return {}
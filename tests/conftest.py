@@ -0,0 +1,38 @@
+"""Общие фикстуры тестов: корень репозитория в sys.path и пустой каталог data/."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Рабочий каталог — временный, хранилище создаётся заново в его data/."""
+    from utils import storage
+    from utils.shared_state import SqliteLeaseStore, SqliteTimerStore, lease_store, timer_store
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    monkeypatch.setattr(storage, "_backend", None)
+    if isinstance(timer_store, SqliteTimerStore):
+        # Соединение открывается заново — в базе этого каталога
+        monkeypatch.setattr(timer_store, "_conn", None)
+    if isinstance(lease_store, SqliteLeaseStore):
+        monkeypatch.setattr(lease_store, "_conn", None)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def fresh_locks(monkeypatch):
+    """
+    asyncio.Lock привязывается к циклу событий при первом ожидании, а каждый
+    тест запускает свой asyncio.run — шарды блокировок создаются заново.
+    """
+    from utils.locks import _TaskReentrantLock, document_locks, followup_locks, storage_locks
+
+    for manager in (storage_locks, document_locks, followup_locks):
+        monkeypatch.setattr(manager, "_shards", [_TaskReentrantLock() for _ in manager._shards])
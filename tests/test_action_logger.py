@@ -0,0 +1,113 @@
+"""Лог действий: компактация не теряет и не удваивает счётчики даже при сбое."""
+from datetime import timedelta
+
+import pytest
+
+from stats import action_logger
+from stats.action_logger import ActionStore, get_moscow_time
+
+
+def _record(user_id: int, days_ago: int, action: str = "sos") -> dict:
+    day = get_moscow_time().date() - timedelta(days=days_ago)
+    return {"user_id": user_id, "timestamp": f"{day}T12:00:00", "date": day.isoformat(),
+            "hour": 12, "action": action, "details": {}}
+
+
+@pytest.fixture
+def store(data_dir):
+    store = ActionStore()
+    store.write_batch([_record(1, 200), _record(1, 150), _record(2, 100), _record(1, 1), _record(2, 0)])
+    store.save_snapshot()
+    return store
+
+
+def _totals(snapshot: dict) -> dict:
+    return {user_id: data["total_actions"] for user_id, data in snapshot["users"].items()}
+
+
+def test_compact_keeps_totals_and_prunes_base_rollups(store):
+    before = _totals(store.snapshot)
+
+    result = store.compact(max_days=90)
+
+    assert result == {"kept": 2, "folded": 3}
+    assert _totals(ActionStore().rebuild()) == before
+    assert _totals(ActionStore().snapshot) == before
+    # Свёртки в базе — в пределах ROLLUP_RETENTION_DAYS, как в снимке
+    base = action_logger.serializer.load_file(store.base_file)
+    oldest = (get_moscow_time().date() - timedelta(days=action_logger.ROLLUP_RETENTION_DAYS)).isoformat()
+    assert base["rollups"]["days"] and min(base["rollups"]["days"]) >= oldest
+
+
+@pytest.mark.parametrize("crash_at", ["base", "replace"])
+def test_interrupted_compaction_does_not_double_count(store, monkeypatch, crash_at):
+    before = _totals(store.snapshot)
+
+    def crash(*args, **kwargs):
+        raise OSError("сбой")
+
+    with monkeypatch.context() as patch:
+        if crash_at == "base":
+            real_write = action_logger.atomic_write_json
+            patch.setattr(action_logger, "atomic_write_json",
+                          lambda path, *a, **kw: crash() if path == store.base_file else real_write(path, *a, **kw))
+        else:
+            # База уже записана, новый лог ещё не встал на место старого
+            real_replace = action_logger.os.replace
+            patch.setattr(action_logger.os, "replace",
+                          lambda src, dst: crash() if src == store.next_log_file else real_replace(src, dst))
+        with pytest.raises(OSError):
+            store.compact(max_days=90)
+
+    # Перезапуск: и снимок, и полный пересчёт дают прежние итоги
+    assert _totals(ActionStore().snapshot) == before
+    assert _totals(ActionStore().rebuild()) == before
+    assert not store.next_log_file.exists()
+
+
+def test_cancelled_submit_does_not_stop_the_queue(store):
+    import asyncio
+    import threading
+
+    from stats.action_logger import ActionQueue
+
+    release = threading.Event()
+
+    def slow_rebuild():
+        release.wait(5)
+        return "готово"
+
+    async def scenario():
+        queue = ActionQueue(store, batch_timeout=0.01)
+        queue.start()
+        waiter = asyncio.create_task(queue.submit(slow_rebuild))
+        await asyncio.sleep(0.05)
+        # Админский обработчик не дождался и отменил ожидание
+        waiter.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.sleep(0.05)
+        running = queue.running
+        queue.put(_record(3, 0))
+        await queue.close()
+        return running
+
+    assert asyncio.run(scenario()) is True
+    assert store.snapshot["users"]["3"]["total_actions"] == 1
+
+
+def test_shared_log_counts_every_worker(data_dir):
+    first, second = ActionStore(shared=True), ActionStore(shared=True)
+    for i in range(6):
+        (first if i % 2 else second).write_batch([_record(i % 3, 0)])
+    first.save_snapshot()
+    second.save_snapshot()
+    # Второй воркер сжимает лог, первый дописывает уже в новое поколение
+    second.compact(max_actions=1)
+    first.write_batch([_record(1, 0)])
+    first.save_snapshot()
+
+    expected = {"0": 2, "1": 3, "2": 2}
+    assert _totals(first.snapshot) == expected
+    assert _totals(ActionStore().snapshot) == expected
+    assert _totals(ActionStore().rebuild()) == expected
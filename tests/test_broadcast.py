@@ -0,0 +1,67 @@
+"""Рассылка: 429 от Telegram, интервал в один чат, журнал для докачки."""
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from utils.broadcast import BroadcastEngine, BroadcastJournal
+
+
+class FakeBot:
+    """Отвечает 429 на первые retry_after_times отправки, 403 — заблокировавшим."""
+
+    def __init__(self, retry_after_times=0, blocked=()):
+        self.retry_after_times = retry_after_times
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        method = SendMessage(chat_id=chat_id, text=text)
+        if self.retry_after_times:
+            self.retry_after_times -= 1
+            raise TelegramRetryAfter(method, "Too Many Requests", retry_after=1)
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(method, "bot was blocked by the user")
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+def _engine(tmp_path, **kwargs):
+    return BroadcastEngine(rate=1000, burst=1000, directory=tmp_path, **kwargs)
+
+
+def test_retry_after_pauses_and_retries(tmp_path):
+    bot = FakeBot(retry_after_times=1, blocked={3})
+    engine = _engine(tmp_path, per_chat_interval=0)
+
+    started = time.monotonic()
+    summary = asyncio.run(engine.run("test", [1, 2, 3, 4], lambda chat_id: bot.send_message(chat_id, "hi")))
+
+    assert summary == {"skipped": 0, "sent": 3, "blocked": 1}
+    assert sorted(chat_id for chat_id, _, _ in bot.sent) == [1, 2, 4]
+    # Вся рассылка ждала retry_after, а не только получатель с 429
+    assert min(at for _, _, at in bot.sent) - started >= 1
+    journal = BroadcastJournal("test", tmp_path)
+    assert journal.load() == {1: "sent", 2: "sent", 3: "blocked", 4: "sent"}
+    assert journal.finished
+
+
+def test_concurrent_broadcasts_keep_per_chat_interval(tmp_path):
+    bot = FakeBot()
+    engine = _engine(tmp_path, per_chat_interval=0.2)
+
+    async def main():
+        await asyncio.gather(
+            engine.run("first", [1], lambda chat_id: bot.send_message(chat_id, "first")),
+            engine.run("second", [1], lambda chat_id: bot.send_message(chat_id, "second")),
+            engine.run("third", [1], lambda chat_id: bot.send_message(chat_id, "third")),
+        )
+
+    asyncio.run(main())
+    times = sorted(at for _, _, at in bot.sent)
+    assert len(times) == 3
+    assert all(b - a >= 0.19 for a, b in zip(times, times[1:]))
@@ -0,0 +1,95 @@
+"""Нагрузочная проверка блокировок хранилища: нет взаимных блокировок и потерянных обновлений."""
+import asyncio
+import random
+
+from utils.locks import KeyedLockManager, storage_locks
+from utils.preferences import PreferencesStore
+from utils.storage import load_user_data_async, save_user_data
+
+# Дольше этого — считаем, что всё повисло
+DEADLOCK_TIMEOUT = 30
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, DEADLOCK_TIMEOUT))
+
+
+def test_keys_in_any_order_do_not_deadlock():
+    locks = KeyedLockManager(shards=4)
+    counter = {"value": 0}
+
+    async def worker(first, second):
+        for _ in range(200):
+            async with locks.keys(first, second):
+                value = counter["value"]
+                await asyncio.sleep(0)
+                counter["value"] = value + 1
+
+    async def main():
+        await asyncio.gather(*(
+            worker(a, b) for a, b in [("x", "y"), ("y", "x"), ("x", "z"), ("z", "y")] * 5
+        ))
+
+    run(main())
+    # Все задачи пересекаются хотя бы по одному ключу — обновления не теряются
+    assert counter["value"] == 20 * 200
+
+
+def test_reentrant_user_lock():
+    async def main():
+        async with storage_locks.user(1):
+            async with storage_locks.user(1):
+                async with storage_locks.keys(1):
+                    return True
+
+    assert run(main())
+
+
+def test_user_writers_documents_and_flush_under_load(data_dir):
+    """
+    Сценарий, который раньше вешал бота: писатели статистики держат
+    блокировку пользователя и сохраняют документ, платежи берут
+    (платёж, пользователь), настройки сбрасываются каждые несколько мс.
+    """
+    from stats.user_stats import UserStats
+
+    preferences = PreferencesStore(data_dir / "data" / "user_preferences.json", flush_interval=0.001)
+    users = list(range(1, 41))
+    rng = random.Random(7)
+
+    async def stats_writer(user_id):
+        stats = UserStats(user_id)
+        for _ in range(10):
+            await stats.update_stats("conscious_stop")
+
+    async def preferences_writer(user_id):
+        for i in range(20):
+            async with storage_locks.user(user_id):
+                await preferences.set_value(user_id, "n", i)
+                await asyncio.sleep(0)
+
+    async def payment_writer(n):
+        for i in range(20):
+            user_id = rng.choice(users)
+            async with storage_locks.keys(f"payment:{n}:{i}", user_id):
+                async with storage_locks.user(user_id):
+                    await save_user_data({"n": i}, f"payment_{n}")
+
+    async def main():
+        preferences.start()
+        try:
+            await asyncio.gather(
+                *(stats_writer(u) for u in users),
+                *(preferences_writer(u) for u in users),
+                *(payment_writer(n) for n in range(10)),
+            )
+        finally:
+            await preferences.close()
+        return (
+            [await load_user_data_async(f"user_stats_{u}") for u in users],
+            [await preferences.get_user(u) for u in users],
+        )
+
+    saved, prefs = run(main())
+    assert all(s["event_totals"]["conscious_stop"] == 10 for s in saved)
+    assert all(p["n"] == 19 for p in prefs)
@@ -0,0 +1,143 @@
+"""Уведомления ЮKassa: локальный сервер бота и фейковый отправитель уведомлений."""
+import asyncio
+import ipaddress
+import os
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("aiohttp")
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST_TOKEN")
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import bot as bot_module
+from payment import notifications
+from payment.notifications import send_fake_notification
+from payment.pending import STATUS_PENDING, STATUS_SUCCEEDED, pending_payments
+
+USER_ID = 42
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def yookassa(data_dir, monkeypatch):
+    """Платежи «в ЮKassa» (payment_id -> статус) и подменённый бот."""
+    payments = {}
+
+    async def get_payment(payment_id):
+        if payment_id not in payments:
+            return None
+        return {"id": payment_id, "status": payments[payment_id], "metadata": {"user_id": str(USER_ID)}}
+
+    fake_bot = FakeBot()
+    monkeypatch.setattr(bot_module, "get_payment", get_payment)
+    monkeypatch.setattr(bot_module, "bot", fake_bot)
+    monkeypatch.setattr(bot_module.preferences, "_data", {})
+    monkeypatch.setattr(pending_payments, "_payments", None)
+    monkeypatch.setattr(notifications, "_networks", [ipaddress.ip_network("127.0.0.1/32")])
+    payments["fake_bot"] = fake_bot
+    return payments
+
+
+async def _with_server(scenario):
+    app = web.Application()
+    app.router.add_post("/yookassa", bot_module.handle_yookassa)
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    try:
+        return await scenario(str(server.make_url("/yookassa")))
+    finally:
+        await server.close()
+
+
+def _user_data(user_id):
+    return asyncio.run(bot_module.preferences.get_user(user_id))
+
+
+def _subscription_days(user_id):
+    end = datetime.fromisoformat(_user_data(user_id)["subscription_end_date"])
+    return (end - bot_module.get_moscow_time()).total_seconds() / 86400
+
+
+def test_notification_activates_subscription_once(yookassa):
+    yookassa["p1"] = "succeeded"
+
+    async def scenario(url):
+        await pending_payments.add("p1", USER_ID)
+        # Повторные доставки, параллельная кнопка «Проверить оплату» и сверка
+        return await asyncio.gather(
+            *(send_fake_notification(url, "p1") for _ in range(5)),
+            bot_module.apply_payment({"id": "p1", "status": "succeeded", "metadata": {}}, notify=False),
+            bot_module.apply_payment({"id": "p1", "status": "succeeded", "metadata": {}}, notify=False),
+        )
+
+    results = asyncio.run(_with_server(scenario))
+    assert [status for status, _ in results[:5]] == [200] * 5
+    assert 29.9 < _subscription_days(USER_ID) <= 30
+    assert pending_payments.get("p1")["status"] == STATUS_SUCCEEDED
+    assert len(yookassa["fake_bot"].sent) <= 1
+
+
+def test_repeat_after_restart_does_not_extend(yookassa):
+    yookassa["p1"] = "succeeded"
+
+    async def scenario(url):
+        await pending_payments.add("p1", USER_ID)
+        first = await send_fake_notification(url, "p1")
+        # Перезапуск: платежи перечитываются из хранилища
+        pending_payments._payments = None
+        second = await send_fake_notification(url, "p1")
+        return first, second
+
+    first, second = asyncio.run(_with_server(scenario))
+    assert first[0] == second[0] == 200
+    assert 29.9 < _subscription_days(USER_ID) <= 30
+    assert len(yookassa["fake_bot"].sent) == 1
+
+
+def test_payment_without_record_uses_metadata(yookassa):
+    yookassa["p2"] = "succeeded"
+
+    status, _ = asyncio.run(_with_server(lambda url: send_fake_notification(url, "p2")))
+    assert status == 200
+    assert pending_payments.get("p2")["user_id"] == USER_ID
+    assert 29.9 < _subscription_days(USER_ID) <= 30
+
+
+def test_body_status_is_not_trusted(yookassa):
+    # В уведомлении succeeded, а API говорит pending — подписку не даём
+    yookassa["p1"] = "pending"
+
+    async def scenario(url):
+        await pending_payments.add("p1", USER_ID)
+        return await send_fake_notification(url, "p1", "payment.succeeded")
+
+    status, _ = asyncio.run(_with_server(scenario))
+    assert status == 200
+    assert pending_payments.get("p1")["status"] == STATUS_PENDING
+    assert "subscription_end_date" not in _user_data(USER_ID)
+
+
+def test_api_failure_asks_for_redelivery(yookassa):
+    status, _ = asyncio.run(_with_server(lambda url: send_fake_notification(url, "unknown")))
+    assert status == 503
+
+
+def test_foreign_sender_rejected(yookassa, monkeypatch):
+    yookassa["p1"] = "succeeded"
+    monkeypatch.setattr(notifications, "_networks", notifications._parse_networks(""))
+
+    status, _ = asyncio.run(_with_server(lambda url: send_fake_notification(url, "p1")))
+    assert status == 403
+    assert _user_data(USER_ID) == {}
@@ -0,0 +1,46 @@
+"""Дневная практика: выдача, выполнение и отметка в индексе."""
+import asyncio
+
+import pytest
+
+from daily_practice import completions, schedule
+
+
+@pytest.fixture
+def practice_index(data_dir, monkeypatch):
+    index = completions.PracticeCompletionIndex()
+    monkeypatch.setattr(completions, "practice_index", index)
+    return index
+
+
+def test_complete_practice_once(practice_index):
+    async def main():
+        practice = await schedule.get_next_practice(7)
+        results = await asyncio.gather(*(schedule.complete_practice(7) for _ in range(3)))
+        return practice, results, await practice_index.done_on()
+
+    practice, results, done = asyncio.run(main())
+    assert practice["practice_id"] >= 1
+    assert sorted(results) == [False, False, True]
+    assert done == {7}
+
+
+def test_complete_without_practice(practice_index):
+    assert asyncio.run(schedule.complete_practice(8)) is False
+
+
+def test_next_practice_reads_schedule_off_the_loop(practice_index, monkeypatch):
+    from utils import storage
+
+    def forbidden(*args, **kwargs):
+        raise AssertionError("синхронное чтение в event loop")
+
+    monkeypatch.setattr(storage, "load_user_data", forbidden)
+
+    async def main():
+        first = await schedule.get_next_practice(9)
+        return first, await schedule.get_next_practice(9), await schedule.should_update_practice(9)
+
+    first, second, needs_update = asyncio.run(main())
+    assert second == first
+    assert needs_update is False
@@ -0,0 +1,188 @@
+"""Фоновая сверка платежей: экспоненциальная пауза и переходы статусов."""
+import asyncio
+import time
+
+import pytest
+
+from payment import reconcile
+from payment.pending import (
+    FIRST_CHECK_DELAY,
+    STATUS_CANCELED,
+    STATUS_EXPIRED,
+    STATUS_PENDING,
+    STATUS_SUCCEEDED,
+    PendingPayments,
+)
+from payment.reconcile import BACKOFF_BASE, PaymentReconciler, backoff_delay
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubPayments:
+    """Заглушка клиента ЮKassa: статусы по очереди, None — ошибка запроса."""
+
+    def __init__(self, **scripts):
+        self.scripts = {pid: list(statuses) for pid, statuses in scripts.items()}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def fetch(self, payment_id):
+        self.calls.append(payment_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        script = self.scripts[payment_id]
+        status = script.pop(0) if len(script) > 1 else script[0]
+        if isinstance(status, Exception):
+            raise status
+        if status is None:
+            return None
+        return {"id": payment_id, "status": status, "metadata": {}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def store(data_dir):
+    return PendingPayments(storage_key="test_pending")
+
+
+def _reconciler(store, stub, concurrency=4):
+    reconciler = PaymentReconciler(store, concurrency=concurrency)
+    applied = []
+
+    async def apply(payment):
+        # Как apply_payment: итоговый статус пишется в запись платежа
+        applied.append((payment["id"], payment["status"]))
+        await store.set_status(payment["id"], payment["status"])
+
+    reconciler._fetch = stub.fetch
+    reconciler._apply = apply
+    return reconciler, applied
+
+
+def test_pending_payment_backs_off_exponentially(store, clock):
+    stub = StubPayments(p1=["pending", None, "pending", "succeeded"])
+    reconciler, applied = _reconciler(store, stub)
+
+    async def main():
+        await store.add("p1", 1)
+        # До первой паузы сверять рано: обычно раньше приходит уведомление
+        assert await reconciler.run_once() == 0
+        clock.now += FIRST_CHECK_DELAY
+        for attempt in range(3):
+            assert await reconciler.run_once() == 1
+            record = store.get("p1")
+            assert record["attempts"] == attempt + 1
+            assert record["next_check_at"] == clock.now + backoff_delay(attempt)
+            # Раньше срока платёж не перечитывается
+            clock.now += backoff_delay(attempt) - 1
+            assert await reconciler.run_once() == 0
+            clock.now += 1
+        assert await reconciler.run_once() == 1
+
+    asyncio.run(main())
+    assert [backoff_delay(a) for a in range(3)] == [BACKOFF_BASE, BACKOFF_BASE * 2, BACKOFF_BASE * 4]
+    assert stub.calls == ["p1"] * 4
+    assert applied == [("p1", STATUS_SUCCEEDED)]
+    assert store.get("p1")["status"] == STATUS_SUCCEEDED
+    assert reconciler.metrics() == {"pending": 0, "checked": 4, "resolved": 1, "expired": 0, "errors": 1}
+
+
+def test_status_transitions(store, clock):
+    stub = StubPayments(
+        paid=["succeeded"], canceled=["canceled"], abandoned=["pending"], broken=[RuntimeError("boom")],
+    )
+    reconciler, applied = _reconciler(store, stub)
+
+    async def main():
+        for payment_id in stub.scripts:
+            await store.add(payment_id, 1)
+        clock.now += FIRST_CHECK_DELAY
+        await reconciler.run_once()
+        # Завершённые больше не сверяются, брошенный истекает через PAYMENT_EXPIRE_HOURS
+        clock.now += reconcile.PAYMENT_EXPIRE_HOURS * 3600
+        await reconciler.run_once()
+
+    asyncio.run(main())
+    assert sorted(applied) == [("canceled", STATUS_CANCELED), ("paid", STATUS_SUCCEEDED)]
+    assert store.get("abandoned")["status"] == STATUS_EXPIRED
+    # Исключение клиента — та же пауза, платёж остаётся на сверке
+    assert store.get("broken")["status"] == STATUS_PENDING
+    assert store.get("broken")["attempts"] == 2
+    assert stub.calls.count("paid") == 1 and stub.calls.count("canceled") == 1
+
+
+def test_concurrency_limit_and_saved_schedule(store, clock):
+    stub = StubPayments(**{f"p{i}": ["pending"] for i in range(10)})
+    reconciler, _ = _reconciler(store, stub, concurrency=2)
+
+    async def main():
+        for payment_id in stub.scripts:
+            await store.add(payment_id, 1)
+        clock.now += FIRST_CHECK_DELAY
+        await reconciler.run_once()
+        # Перезапуск: сроки сверки читаются из хранилища
+        reloaded = PendingPayments(storage_key="test_pending")
+        await reloaded.load()
+        return reloaded
+
+    reloaded = asyncio.run(main())
+    assert stub.max_in_flight == 2
+    assert all(reloaded.get(f"p{i}")["attempts"] == 1 for i in range(10))
+    assert reloaded.due(clock.now, 100) == []
+
+
+def test_save_snapshots_records(store, monkeypatch):
+    saved = []
+
+    async def fake_save(data, storage_key):
+        # Пока документ «сериализуется», сверка меняет запись
+        await asyncio.sleep(0)
+        store.defer("p1", 60)
+        saved.append(data["payments"]["p1"]["attempts"])
+        return True
+
+    async def main():
+        await store.add("p1", 1)
+        with monkeypatch.context() as patch:
+            patch.setattr("payment.pending.save_user_data", fake_save)
+            await store.save()
+
+    asyncio.run(main())
+    assert saved == [0]
+    assert store.get("p1")["attempts"] == 1
+
+
+def test_shared_store_keeps_other_workers_payments(data_dir):
+    first = PendingPayments(storage_key="test_pending", shared=True)
+    second = PendingPayments(storage_key="test_pending", shared=True)
+
+    async def main():
+        await first.add("p1", 1)
+        await first.load()
+        # Пока сверка первого воркера идёт, второй создаёт платёж и закрывает p1
+        first.defer("p1", 60)
+        await second.add("p2", 2)
+        await second.set_status("p1", STATUS_CANCELED)
+        await first.save()
+        await asyncio.gather(*(w.add(f"p{i}", i) for i, w in zip(range(3, 9), [first, second] * 3)))
+        return await PendingPayments(storage_key="test_pending").load()
+
+    payments = asyncio.run(main())
+    assert sorted(payments) == [f"p{i}" for i in range(1, 9)]
+    # Отложенная сверка не вернула отменённый платёж в pending
+    assert payments["p1"]["status"] == STATUS_CANCELED
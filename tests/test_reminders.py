@@ -0,0 +1,251 @@
+"""Вечерние напоминания: имя из корзины, дата у пользователя, очистка журналов."""
+import asyncio
+import os
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+pytest.importorskip("apscheduler")
+pytest.importorskip("aiogram")
+
+import scheduler
+from daily_practice.completions import PracticeCompletionIndex
+from utils.broadcast import cleanup_journals
+from utils.reminder_buckets import DEFAULT_REMINDER_WINDOW, MINUTES_PER_DAY, ReminderBuckets, utc_minute
+
+DAY = date(2026, 10, 17)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def reminders(data_dir, monkeypatch):
+    buckets = ReminderBuckets()
+    buckets.day = DAY
+    index = PracticeCompletionIndex()
+    index._days = {}
+    monkeypatch.setattr(scheduler, "reminder_buckets", buckets)
+    monkeypatch.setattr(scheduler, "practice_index", index)
+    reminder_scheduler = scheduler.ReminderScheduler.__new__(scheduler.ReminderScheduler)
+    reminder_scheduler.bot = FakeBot()
+    return reminder_scheduler, buckets, index
+
+
+def test_reminder_uses_name_and_local_date(reminders):
+    reminder_scheduler, buckets, index = reminders
+    # 23:30 в Москве и 09:30 того же момента в Лос-Анджелесе: у первого уже 18-е
+    minute = utc_minute("23:30", "Europe/Moscow", DAY)
+
+    async def main():
+        await buckets.set_user(1, {"reminder_time": "23:30", "timezone": "Europe/Moscow", "full_name": "Аня"})
+        await buckets.set_user(2, {"reminder_time": "13:30", "timezone": "America/Los_Angeles"})
+        assert await buckets.users_at(minute) == {1, 2}
+        # Оба выполнили практику 17-го по своему календарю
+        await index.mark_done(1, DAY)
+        await index.mark_done(2, DAY)
+        return await reminder_scheduler._get_users_needing_reminder(minute, DAY)
+
+    # Корзина 20:30 UTC 17-го: в Москве ещё 17-е, в Лос-Анджелесе тоже
+    assert asyncio.run(main()) == []
+
+    minute = utc_minute("00:30", "Asia/Tokyo", DAY)
+
+    async def moved():
+        await buckets.set_user(1, {"reminder_time": "00:30", "timezone": "Asia/Tokyo", "full_name": "Аня"})
+        return await reminder_scheduler._get_users_needing_reminder(minute, DAY)
+
+    users = asyncio.run(moved())
+    # В Токио уже 18-е — практика 17-го не считается
+    assert users == [{"user_id": 1, "full_name": "Аня"}]
+
+    asyncio.run(reminder_scheduler._send_reminder_to_user(users[0]))
+    assert "Аня" in reminder_scheduler.bot.sent[0][1]
+
+
+def test_default_reminder_time_spreads_users():
+    buckets = ReminderBuckets()
+
+    async def main():
+        await buckets.build(((str(user_id), {}) for user_id in range(1, 1001)), DAY)
+        busiest, minutes = await buckets.busiest(top=1), await buckets.busiest(top=MINUTES_PER_DAY)
+        minute = [m for m in minutes if 7 in await buckets.users_at(m)][0]
+        await buckets.set_user(7, {})
+        return busiest, minutes, minute, await buckets.users_at(minute)
+
+    busiest, minutes, minute, users = asyncio.run(main())
+    assert len(minutes) == DEFAULT_REMINDER_WINDOW
+    assert max(busiest.values()) <= -(-1000 // DEFAULT_REMINDER_WINDOW)
+    # Окно начинается в 19:00 МСК; у пользователя время не меняется при пересборке
+    assert min(minutes) == utc_minute("19:00", "Europe/Moscow", DAY)
+    assert 7 in users
+
+
+def test_old_journals_are_removed(data_dir):
+    directory = data_dir / "data" / "broadcasts"
+    directory.mkdir()
+    old, fresh = directory / "reminder_2026-10-10_0600.jsonl", directory / "reminder_2026-10-17_0600.jsonl"
+    old.write_text("{}\n")
+    fresh.write_text("{}\n")
+    week_ago = time.time() - 7 * 86400
+    os.utime(old, (week_ago, week_ago))
+
+    assert cleanup_journals(directory, keep_days=2) == 1
+    assert not old.exists() and fresh.exists()
+
+
+def test_unknown_jobstore_is_reported(monkeypatch, capsys):
+    monkeypatch.setattr(scheduler, "SCHEDULER_JOBSTORE", "postgres")
+    assert type(scheduler._build_jobstore()).__name__ == "MemoryJobStore"
+    output = capsys.readouterr().out
+    assert "SCHEDULER_JOBSTORE='postgres'" in output and "SQLAlchemy" not in output
+
+
+def test_missed_daily_check_runs_once_after_restart(data_dir, monkeypatch):
+    pytest.importorskip("sqlalchemy")
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+    calls = []
+
+    async def check(self):
+        calls.append(datetime.now())
+
+    async def nothing(self):
+        pass
+
+    monkeypatch.setattr(scheduler, "SCHEDULER_JOBSTORE", "sqlite")
+    monkeypatch.setattr(scheduler.ReminderScheduler, "check_subscriptions_once_a_day", check)
+    monkeypatch.setattr(scheduler.ReminderScheduler, "dispatch_due_buckets", nothing)
+    monkeypatch.setattr(scheduler.ReminderScheduler, "rebuild_reminder_buckets", nothing)
+    job_id = "check_subscription_reminders"
+
+    async def main():
+        # AsyncIOScheduler запускается и останавливается в следующей итерации цикла
+        await scheduler.start_reminder_system(FakeBot())
+        await asyncio.sleep(0.1)
+        await scheduler.stop_reminder_system()
+        await asyncio.sleep(0.1)
+
+        # Пока бот лежал, прошли сутки: сохранённый срок 12:00 уже позади
+        offline = AsyncIOScheduler(jobstores={"default": scheduler._build_jobstore()}, timezone=scheduler.MOSCOW_TZ)
+        offline.start(paused=True)
+        offline.modify_job(job_id, next_run_time=datetime.now(scheduler.MOSCOW_TZ) - timedelta(hours=1))
+        offline.shutdown()
+        await asyncio.sleep(0.1)
+
+        await scheduler.start_reminder_system(FakeBot())
+        await asyncio.sleep(0.5)
+        next_run = scheduler._scheduler_instance.scheduler.get_job(job_id).next_run_time
+        await scheduler.stop_reminder_system()
+        return next_run
+
+    next_run = asyncio.run(main())
+    assert len(calls) == 1
+    assert next_run > datetime.now(scheduler.MOSCOW_TZ)
+
+
+def test_bucket_is_sent_by_one_instance_at_a_time(reminders, monkeypatch):
+    reminder_scheduler, buckets, index = reminders
+    other = scheduler.ReminderScheduler.__new__(scheduler.ReminderScheduler)
+    other.bot = reminder_scheduler.bot
+    minute = utc_minute("19:00", "Europe/Moscow", DAY)
+    started = []
+
+    async def slow_run(broadcast_id, chat_ids, send):
+        started.append(broadcast_id)
+        await asyncio.sleep(0.1)
+        if len(started) == 1:
+            # Первый экземпляр падает посреди рассылки
+            raise RuntimeError("остановка")
+        return {"sent": len(chat_ids)}
+
+    monkeypatch.setattr(scheduler.broadcast_engine, "run", slow_run)
+
+    async def main():
+        await buckets.set_user(1, {"reminder_time": "19:00", "timezone": "Europe/Moscow"})
+        # Старый экземпляр ещё рассылает корзину, новый поднимает её из журнала
+        await asyncio.gather(
+            reminder_scheduler.dispatch_reminder_bucket(minute, DAY),
+            other.dispatch_reminder_bucket(minute, DAY),
+        )
+        # Рассылка не закончилась — метки нет, корзину догоняют
+        await other.dispatch_reminder_bucket(minute, DAY)
+        # Разослана — больше не трогаем
+        await reminder_scheduler.dispatch_reminder_bucket(minute, DAY)
+
+    asyncio.run(main())
+    assert started == [scheduler.reminder_broadcast_id(DAY, minute)] * 2
+
+
+def test_failed_subscription_check_is_retried(data_dir, monkeypatch):
+    reminder_scheduler = scheduler.ReminderScheduler.__new__(scheduler.ReminderScheduler)
+    reminder_scheduler.bot = FakeBot()
+    calls = []
+
+    async def check(broadcast_id=None):
+        calls.append(broadcast_id)
+        if len(calls) == 1:
+            raise RuntimeError("Redis недоступен")
+
+    monkeypatch.setattr(reminder_scheduler, "check_subscriptions_and_remind", check)
+
+    async def main():
+        for _ in range(3):
+            await reminder_scheduler.check_subscriptions_once_a_day()
+
+    asyncio.run(main())
+    # Первая попытка упала, вторая выполнила проверку, третья её пропустила
+    assert len(calls) == 2
+
+
+def test_yesterdays_interrupted_bucket_is_resumed(data_dir):
+    from utils.broadcast import BROADCAST_DIR
+
+    class Jobs:
+        def __init__(self):
+            self.added = []
+
+        def add_job(self, func, kwargs, id, replace_existing):
+            self.added.append(kwargs)
+
+    yesterday = datetime.now(scheduler.pytz.utc).date() - timedelta(days=1)
+    BROADCAST_DIR.mkdir(parents=True)
+    (BROADCAST_DIR / f"{scheduler.reminder_broadcast_id(yesterday, 1439)}.jsonl").write_text(
+        '{"chat_id": 1, "status": "sent", "at": 0}\n'
+    )
+    reminder_scheduler = scheduler.ReminderScheduler.__new__(scheduler.ReminderScheduler)
+    reminder_scheduler.scheduler = Jobs()
+    reminder_scheduler._resume_reminders()
+    assert reminder_scheduler.scheduler.added == [{"minute": 1439, "day": yesterday.isoformat()}]
+
+
+def test_reminders_go_to_practicing_and_opted_in_users(reminders, monkeypatch):
+    from utils.storage import update_user_record
+
+    reminder_scheduler, buckets, _ = reminders
+
+    class Preferences:
+        async def items(self):
+            return [
+                ("1", {"full_name": "Практикует"}),
+                ("2", {"full_name": "Только /start"}),
+                ("3", {"reminder_time": "21:00"}),
+                ("4", {"reminder_time": "off"}),
+            ]
+
+    monkeypatch.setattr(scheduler, "preferences", Preferences())
+
+    async def main():
+        for user_id in (1, 4, 5):
+            await update_user_record(user_id, lambda record: record.setdefault("practice_history", {}))
+        await reminder_scheduler.rebuild_reminder_buckets()
+
+    asyncio.run(main())
+    # 5 практиковался, но настроек у него нет; 4 напоминания выключил
+    assert set(buckets._user_bucket) == {1, 3, 5}
@@ -0,0 +1,411 @@
+"""Общее состояние воркеров в Redis (fakeredis) и SQLite."""
+import asyncio
+import os
+import time
+
+import pytest
+
+from utils import shared_state
+from utils.shared_state import (
+    RedisCounterStore,
+    RedisLeaseStore,
+    RedisTimerStore,
+    SqliteLeaseStore,
+    SqliteTimerStore,
+    lease_lock,
+)
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis()
+    monkeypatch.setattr(shared_state, "_redis", client)
+    return client
+
+
+def test_redis_timers_fire_once(redis):
+    store = RedisTimerStore(prefix="test")
+
+    async def main():
+        await store.put("quick_pause:1", {"kind": "quick_pause", "user_id": 1, "due_at": 10.0})
+        await store.put("quick_pause:2", {"kind": "quick_pause", "user_id": 2, "due_at": 20.0})
+        listed = sorted(r["key"] for r in await store.all())
+        popped = await asyncio.gather(*(store.pop("quick_pause:1") for _ in range(5)))
+        return listed, popped, await store.get("quick_pause:2")
+
+    listed, popped, other = asyncio.run(main())
+    assert listed == ["quick_pause:1", "quick_pause:2"]
+    assert [p for p in popped if p] == [{"kind": "quick_pause", "user_id": 1, "due_at": 10.0}]
+    assert other["user_id"] == 2
+
+
+def test_sqlite_timers_survive_restart(data_dir):
+    from utils.timers import TimerService
+
+    path = str(data_dir / "data" / "state.sqlite3")
+    fired = []
+
+    async def before_restart():
+        service = TimerService(SqliteTimerStore(path))
+        await service.schedule("quick_pause:1", "quick_pause", time.time() + 0.05, user_id=1)
+        await service.schedule("quick_pause:2", "quick_pause", time.time() + 60, user_id=2)
+        await service.cancel("quick_pause:2")
+
+    async def after_restart():
+        store = SqliteTimerStore(path)
+        service = TimerService(store)
+
+        async def handler(record):
+            fired.append(record["user_id"])
+
+        service.register("quick_pause", handler)
+        recovered = await service.start()
+        await asyncio.sleep(0.2)
+        await service.close()
+        return recovered, await store.all()
+
+    asyncio.run(before_restart())
+    recovered, left = asyncio.run(after_restart())
+    assert recovered == 1
+    assert fired == [1] and left == []
+
+
+def test_failed_timer_is_retried(monkeypatch):
+    from utils import timers
+    from utils.timers import TimerService
+
+    monkeypatch.setattr(timers, "TIMER_RETRY_DELAY", 0.02)
+    store = shared_state.TimerStore()
+    calls = []
+
+    async def flaky(record):
+        calls.append(record.get("attempts", 0))
+        if len(calls) == 1:
+            raise RuntimeError("сеть недоступна")
+
+    async def main():
+        service = TimerService(store)
+        service.register("followup", flaky)
+        await service.start()
+        await service.schedule("followup:1", "followup", time.time(), user_id=1)
+        await asyncio.sleep(0.2)
+        await service.close()
+        return await store.all()
+
+    assert asyncio.run(main()) == []
+    assert calls == [0, 1]
+
+
+def test_close_waits_for_handlers_and_keeps_interrupted_timers():
+    from utils.timers import TimerService
+
+    store = shared_state.TimerStore()
+    finished = []
+
+    async def handler(record):
+        await asyncio.sleep(record["takes"])
+        finished.append(record["user_id"])
+
+    async def main():
+        service = TimerService(store)
+        service.register("followup", handler)
+        await service.start()
+        await service.schedule("followup:1", "followup", time.time(), user_id=1, takes=0.05)
+        await service.schedule("followup:2", "followup", time.time(), user_id=2, takes=5)
+        await asyncio.sleep(0.02)
+        await service.close(timeout=0.1)
+        return await store.all()
+
+    left = asyncio.run(main())
+    # Короткий обработчик дождались, долгий прерван, и его таймер остался в хранилище
+    assert finished == [1]
+    assert [record["key"] for record in left] == ["followup:2"]
+
+
+def test_sqlite_timer_pops_once(data_dir):
+    store = SqliteTimerStore(str(data_dir / "data" / "state.sqlite3"))
+
+    async def main():
+        await store.put("followup:1", {"kind": "followup", "due_at": 1.0})
+        return await asyncio.gather(*(store.pop("followup:1") for _ in range(5)))
+
+    assert [p for p in asyncio.run(main()) if p] == [{"kind": "followup", "due_at": 1.0}]
+
+
+def test_timer_keys_by_prefix(data_dir, redis):
+    stores = [shared_state.TimerStore(), SqliteTimerStore(str(data_dir / "data" / "state.sqlite3")),
+              RedisTimerStore(prefix="test")]
+
+    async def main():
+        result = []
+        for store in stores:
+            for key in ("followup:1:a", "followup:1:b", "followup:12:a", "quick_pause:1"):
+                await store.put(key, {"kind": "followup", "due_at": 1.0})
+            result.append(sorted(await store.keys("followup:1:")))
+        return result
+
+    assert asyncio.run(main()) == [["followup:1:a", "followup:1:b"]] * 3
+
+
+def test_quick_followups_are_all_delivered_in_order(data_dir, monkeypatch):
+    pytest.importorskip("aiogram")
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST_TOKEN")
+    import bot as bot_module
+    from utils.timers import TimerService
+
+    sent = []
+
+    class FakeBot:
+        async def send_message(self, chat_id, text, **kwargs):
+            sent.append(text)
+
+    async def slow_menu_text(user_id, ctx=None):
+        await asyncio.sleep(0.1)
+        return "меню"
+
+    async def no_keyboard(user_id, ctx=None):
+        return None
+
+    service = TimerService(shared_state.TimerStore())
+    service.register("followup", bot_module.on_followup_timer)
+    monkeypatch.setattr(bot_module, "timer_service", service)
+    monkeypatch.setattr(bot_module, "bot", FakeBot())
+    monkeypatch.setattr(bot_module, "get_menu_text", slow_menu_text)
+    monkeypatch.setattr(bot_module, "get_main_menu", no_keyboard)
+
+    async def main():
+        await service.start()
+        # Меню собирается медленно, вопрос о причине приходит следом
+        await bot_module.send_followup(1, "menu", delay=0.02)
+        await asyncio.sleep(0.01)
+        await bot_module.send_followup(1, "qp_reason", delay=0.02)
+        await asyncio.sleep(0.3)
+        await service.close()
+
+    asyncio.run(main())
+    assert sent == ["меню", bot_module.QP_REASON]
+
+
+def test_followup_survives_send_error_and_restart(data_dir, monkeypatch):
+    pytest.importorskip("aiogram")
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST_TOKEN")
+    import bot as bot_module
+    from utils import timers
+    from utils.timers import TimerService
+
+    monkeypatch.setattr(timers, "TIMER_RETRY_DELAY", 0.02)
+    sent, calls = [], []
+
+    class FakeBot:
+        async def send_message(self, chat_id, text, **kwargs):
+            calls.append(text)
+            if len(calls) == 1:
+                raise RuntimeError("сеть недоступна")
+            if len(calls) == 3:
+                # Бот останавливается посреди отправки
+                await asyncio.sleep(5)
+            sent.append(text)
+
+    async def menu_text(user_id, ctx=None):
+        return "меню"
+
+    async def no_keyboard(user_id, ctx=None):
+        return None
+
+    store = shared_state.TimerStore()
+    monkeypatch.setattr(bot_module, "bot", FakeBot())
+    monkeypatch.setattr(bot_module, "get_menu_text", menu_text)
+    monkeypatch.setattr(bot_module, "get_main_menu", no_keyboard)
+
+    async def run_worker(actions):
+        service = TimerService(store)
+        service.register("followup", bot_module.on_followup_timer)
+        monkeypatch.setattr(bot_module, "timer_service", service)
+        await service.start()
+        await actions()
+        await service.close(timeout=0.05)
+
+    async def main():
+        async def first_deploy():
+            await bot_module.send_followup(1, "menu", delay=0)
+            await asyncio.sleep(0.1)
+            await bot_module.send_followup(1, "qp_reason", delay=0)
+            await asyncio.sleep(0.02)
+
+        await run_worker(first_deploy)
+        await run_worker(lambda: asyncio.sleep(0.1))
+
+    asyncio.run(main())
+    assert sent == ["меню", bot_module.QP_REASON]
+
+
+def test_redis_counters_are_shared_and_expire(redis):
+    first, second = RedisCounterStore(prefix="test", ttl=60), RedisCounterStore(prefix="test", ttl=60)
+
+    async def main():
+        await asyncio.gather(*(first.incr("timers:day", "started") for _ in range(10)))
+        await second.incr("timers:day", "fired", 3)
+        return await second.get_all("timers:day"), await redis.ttl("test:counters:timers:day")
+
+    totals, ttl = asyncio.run(main())
+    assert totals == {"started": 10, "fired": 3}
+    assert 0 < ttl <= 60
+
+
+def test_redis_lease_renew_and_release_only_by_owner(redis):
+    ours, theirs = RedisLeaseStore(prefix="test", owner="host:1"), RedisLeaseStore(prefix="test", owner="host:2")
+
+    async def main():
+        assert await ours.acquire("writer", 30)
+        assert not await theirs.acquire("writer", 30)
+        assert not await theirs.renew("writer", 30)
+        await theirs.release("writer")
+        assert await redis.exists("test:lease:writer")
+        assert await ours.renew("writer", 30)
+        await ours.release("writer")
+        return await redis.exists("test:lease:writer")
+
+    assert asyncio.run(main()) == 0
+
+
+@pytest.fixture
+def lease_stores(data_dir):
+    path = str(data_dir / "data" / "leases.sqlite3")
+    return SqliteLeaseStore(path, owner="host:1"), SqliteLeaseStore(path, owner="host:2")
+
+
+def test_lease_lock_excludes_other_workers(lease_stores):
+    ours, theirs = lease_stores
+    inside = []
+
+    async def worker(store, name):
+        async with lease_lock("payment:1", ttl=5, poll_interval=0.01, store=store):
+            inside.append(name)
+            await asyncio.sleep(0.05)
+            inside.append(name)
+
+    async def main():
+        await asyncio.gather(worker(ours, "a"), worker(theirs, "b"), worker(ours, "c"))
+        return await theirs.acquire("payment:1", 5)
+
+    assert asyncio.run(main())
+    # Блоки не пересекаются: каждый вход сразу за ним же выходом
+    assert [inside[i] for i in range(0, 6, 2)] == [inside[i] for i in range(1, 6, 2)]
+
+
+def test_redis_preferences_shared_between_workers(data_dir, redis):
+    from utils import serializer
+    from utils.preferences import RedisPreferencesStore
+
+    path = data_dir / "data" / "user_preferences.json"
+    path.write_bytes(serializer.dumps({"1": {"full_name": "Аня", "timezone": "Europe/Moscow"}}))
+    first, second = RedisPreferencesStore(path, prefix="test"), RedisPreferencesStore(path, prefix="test")
+
+    async def main():
+        await asyncio.gather(first.load(), second.load())
+        # Разные поля одного пользователя из двух воркеров
+        await asyncio.gather(*(
+            (first if i % 2 else second).set_value(1, f"field_{i}", i) for i in range(20)
+        ))
+        await first.delete_user(2)
+        await second.set_values(2, {"reminder_time": "21:00"})
+        # Повторный перенос файла не откатывает изменения
+        await first.load()
+        return await second.get_user(1), await first.items(), await first.count()
+
+    user, items, count = asyncio.run(main())
+    assert user["full_name"] == "Аня"
+    assert all(user[f"field_{i}"] == i for i in range(20))
+    assert [user_str for user_str, _ in items] == ["1", "2"] and count == 2
+    assert dict(items)["2"] == {"reminder_time": "21:00"}
+
+
+def test_one_time_build_marked_only_after_success(redis):
+    from utils.shared_state import run_once
+
+    runs = []
+
+    async def failing():
+        runs.append("failed")
+        raise RuntimeError("обрыв связи")
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        runs.append("built")
+        await redis.sadd("test:index", 1)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await run_once("test:built", failing, "test")
+        assert not await redis.exists("test:built")
+
+        # Второй воркер ждёт, пока первый достроит, и видит полный индекс
+        async def waiter():
+            await asyncio.sleep(0.01)
+            done = await run_once("test:built", slow, "test", poll_interval=0.01)
+            return done, await redis.smembers("test:index")
+
+        return await asyncio.gather(run_once("test:built", slow, "test"), waiter())
+
+    built, (waited, members) = asyncio.run(main())
+    assert runs == ["failed", "built"]
+    assert built is True and waited is False and members == {b"1"}
+
+
+def test_redis_indexes_shared_between_workers(redis):
+    from datetime import date, datetime, timedelta
+
+    import pytz
+
+    from utils.reminder_buckets import RedisReminderBuckets, utc_minute
+    from utils.subscription_index import RedisSubscriptionIndex
+
+    now = datetime.now(pytz.timezone("Europe/Moscow"))
+    day = date(2026, 1, 15)
+
+    async def main():
+        first, second = RedisSubscriptionIndex(prefix="test"), RedisSubscriptionIndex(prefix="test")
+        await first.build([("1", {"subscription_end_date": (now + timedelta(days=1)).isoformat()})])
+        await second.update(2, now + timedelta(days=10))
+        # Второй воркер стартует со старым снимком — построенный индекс не пересобирается
+        await second.build([])
+        expiring = await first.expiring_between(now, now + timedelta(days=2))
+        active = await first.active_after(now)
+
+        buckets, other = RedisReminderBuckets(prefix="test"), RedisReminderBuckets(prefix="test")
+        await buckets.build([("1", {"reminder_time": "09:00", "timezone": "Europe/Moscow"}),
+                             ("2", {"reminder_time": "off"})], day)
+        await other.set_user(2, {"reminder_time": "09:00", "timezone": "Europe/Moscow", "full_name": "Боря"})
+        await other.set_user(1, {"reminder_time": "10:00", "timezone": "Europe/Moscow"})
+        minute = utc_minute("09:00", "Europe/Moscow", day)
+        return expiring, active, await buckets.entries_at(minute), await buckets.users_at(minute + 60)
+
+    expiring, active, at_nine, at_ten = asyncio.run(main())
+    assert [user_id for user_id, _ in expiring] == [1]
+    assert [user_id for user_id, _ in active] == [1, 2]
+    assert list(at_nine) == [2] and at_nine[2].full_name == "Боря"
+    assert at_ten == {1}
+
+
+def test_timer_of_stopped_worker_fires_elsewhere():
+    from utils.timers import TimerService
+
+    store = shared_state.TimerStore()
+    fired = []
+
+    async def handler(record):
+        fired.append(record["user_id"])
+
+    async def main():
+        other = TimerService(store, rescan_interval=0.05)
+        other.register("quick_pause", handler)
+        await other.start()
+        stopped = TimerService(store)
+        await stopped.schedule("quick_pause:1", "quick_pause", time.time() + 0.02, user_id=1)
+        await asyncio.sleep(0.2)
+        await other.close()
+
+    asyncio.run(main())
+    assert fired == [1]
@@ -0,0 +1,156 @@
+"""Хранилище: параллельные обновления не теряются, fsync не идёт в event loop."""
+import asyncio
+import os
+import threading
+
+import pytest
+
+from utils import atomic, storage
+from utils.storage import get_backend, load_user_data_async, load_user_record_async, save_user_data
+
+
+def test_concurrent_daily_saves_keep_every_user(data_dir, monkeypatch):
+    from daily_check.check import save_daily_data
+    from daily_practice.completions import PracticeCompletionIndex
+    import daily_check.check as check
+
+    monkeypatch.setattr(check, "practice_index", PracticeCompletionIndex())
+
+    async def main():
+        results = await asyncio.gather(*(save_daily_data(u, {"n": u}) for u in range(1, 51)))
+        return results, [await load_user_record_async(u) for u in range(1, 51)]
+
+    results, records = asyncio.run(main())
+    assert all(results)
+    assert all(len(r["practice_history"]) == 1 for r in records)
+    assert asyncio.run(load_user_data_async("users_data")) == {}
+
+
+def test_batched_fsync_runs_off_the_event_loop(monkeypatch):
+    loop_thread = threading.get_ident()
+    seen = []
+    monkeypatch.setattr(atomic, "_fsync_path", lambda path, directory=False: seen.append(threading.get_ident()))
+
+    async def main():
+        batcher = atomic.FsyncBatcher(interval=0.01)
+        batcher.note("some_file")
+        batcher._task = asyncio.create_task(batcher._loop())
+        await asyncio.sleep(0.1)
+        await batcher.close()
+
+    asyncio.run(main())
+    assert seen and loop_thread not in seen
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "json"])
+def test_users_data_split_into_records(data_dir, monkeypatch, backend):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", backend)
+    legacy = {
+        "1": {"practice_history": {"2024-05-01": {"type": "daily_practice"}}, "stats": {"total_practices": 1}},
+        "2": {"practice_history": {"2024-05-02": {"type": "daily_practice"}}},
+        "daily_check_3": {"note": "старый ключ"},
+    }
+    get_backend().save("users_data", legacy)
+    get_backend().put_user(1, {"practice_history": {"2024-05-03": {"type": "daily_practice"}}})
+    # Бэкенд уже создан (и перенос отмечен) — снимаем отметку, как у старой базы
+    get_backend().set_meta("users_data_split_at", "")
+
+    # Перезапуск: перенос выполняется при создании бэкенда
+    monkeypatch.setattr(storage, "_backend", None)
+    records = dict(storage.iter_user_records())
+
+    assert set(records[1]["practice_history"]) == {"2024-05-01", "2024-05-03"}
+    assert records[1]["stats"] == {"total_practices": 1}
+    assert set(records) == {1, 2}
+    assert get_backend().load("users_data") == {}
+    assert get_backend().load("users_data_backup") == legacy
+
+
+def test_unstart_removes_documents_and_record(data_dir, monkeypatch):
+    pytest.importorskip("aiogram")
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST_TOKEN")
+    import bot as bot_module
+
+    class FakeMessage:
+        class from_user:
+            id = 5
+
+        async def answer(self, text, **kwargs):
+            self.text = text
+
+    monkeypatch.setattr(bot_module.preferences, "_data", {})
+
+    async def main():
+        await save_user_data({"event_totals": {}}, "user_stats_5")
+        await save_user_data({"current_practice": {}}, "daily_practice_schedule_5")
+        await storage.update_user_record(5, lambda record: record.update(practice_history={"2024-05-01": {}}))
+        timers = bot_module.timer_service
+        await timers.schedule(bot_module.quick_pause_timer_key(5), "quick_pause", 2e9, user_id=5, minutes=5)
+        await bot_module.send_followup(5, "menu", delay=2e9)
+        await bot_module.send_followup(5, "qp_reason", delay=2e9)
+        await bot_module.cmd_unstart(FakeMessage())
+        return (await load_user_data_async("user_stats_5"),
+                await load_user_data_async("daily_practice_schedule_5"),
+                await load_user_record_async(5),
+                any(key.endswith(":5") or key.startswith(bot_module.followup_timer_prefix(5))
+                    for key in timers._entries),
+                await timers.store.all())
+
+    assert asyncio.run(main()) == ({}, {}, {}, False, [])
+
+
+def test_parallel_atomic_writes_from_threads(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from utils import serializer
+
+    batcher = atomic.FsyncBatcher()
+    monkeypatch.setattr(atomic, "FSYNC_POLICY", "batch")
+    monkeypatch.setattr(atomic, "fsync_batcher", batcher)
+    target = tmp_path / "shared.json"
+
+    def write(n):
+        atomic.atomic_write_json(target, {"n": n, "payload": "x" * 10_000})
+        atomic.atomic_write_json(tmp_path / f"dir_{n % 20}" / f"own_{n}.json", {"n": n})
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(write, range(200)))
+
+    # Целый файл от одной из записей, временных файлов не осталось
+    assert serializer.load_file(target)["n"] in range(200)
+    assert not list(tmp_path.glob("**/.*.tmp"))
+    # Ни один каталог не потерян при одновременных note_directory()
+    assert batcher.sync() == 21
+
+
+@pytest.mark.parametrize("policy, expected", [
+    ("always", ["fsync", "replace", "fsync"]),
+    ("batch", ["fsync", "replace"]),
+    ("never", ["replace"]),
+])
+def test_data_is_synced_before_rename(tmp_path, monkeypatch, policy, expected):
+    events = []
+    real_replace = os.replace
+    monkeypatch.setattr(atomic, "FSYNC_POLICY", policy)
+    monkeypatch.setattr(atomic, "fsync_batcher", atomic.FsyncBatcher())
+    monkeypatch.setattr(atomic.os, "fsync", lambda fd: events.append("fsync"))
+    monkeypatch.setattr(atomic.os, "replace", lambda src, dst: (events.append("replace"), real_replace(src, dst)))
+
+    atomic.atomic_write_json(tmp_path / "prefs.json", {"n": 1})
+
+    assert events == expected
+
+
+def test_json_migration_skips_foreign_files(tmp_path):
+    from utils.storage_backends import SqliteBackend, migrate_json_to_sqlite
+
+    for name in ("actions_snapshot.json", "actions_base.json", "user_preferences.json", "user_stats_5.json"):
+        atomic.atomic_write_json(tmp_path / name, {"file": name})
+    backend = SqliteBackend(str(tmp_path / "storage.sqlite3"))
+
+    result = migrate_json_to_sqlite(str(tmp_path), backend)
+
+    assert result["documents"] == 1
+    assert backend.load("actions_snapshot") == {} and backend.load("actions_base") == {}
+    # Статистика пользователя — документ хранилища, её UserStats читает уже из SQLite
+    assert backend.load("user_stats_5") == {"file": "user_stats_5.json"}
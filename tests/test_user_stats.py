@@ -0,0 +1,94 @@
+"""Реестр статистики: вытеснение не теряет изменения держателей объекта."""
+import asyncio
+
+from stats.user_stats import UserStatsRegistry
+from utils.storage import load_user_data_async
+
+
+def test_evicted_object_held_by_caller_keeps_updates(data_dir):
+    async def main():
+        registry = UserStatsRegistry(capacity=1)
+        held = await registry.get(1)
+        await held.update_stats("sos")
+        await registry.get(2)  # вытесняет пользователя 1 с записью на диск
+        # Держатель продолжает менять вытесненный объект
+        await held.update_stats("sos")
+        again = await registry.get(1)
+        await again.update_stats("sos")
+        await registry.close()
+        return held, again, await load_user_data_async("user_stats_1"), registry.metrics()
+
+    held, again, saved, metrics = asyncio.run(main())
+    assert again is held
+    assert saved["summary"]["total_sos"] == 3
+    assert metrics["size"] <= metrics["capacity"]
+
+
+def test_discarded_object_is_not_saved_again(data_dir):
+    async def main():
+        registry = UserStatsRegistry(capacity=1)
+        held = await registry.get(1)
+        await registry.discard(1)
+        await held.update_stats("sos")
+        await registry.close()
+        return await load_user_data_async("user_stats_1"), registry.metrics()
+
+    saved, metrics = asyncio.run(main())
+    # Остался только документ, созданный при первой загрузке
+    assert saved["summary"]["total_sos"] == 0
+    assert metrics["size"] == 0 and metrics["dirty"] == 0
+
+
+def test_shared_registries_do_not_lose_updates(data_dir):
+    async def main():
+        # Два воркера с общей статистикой, события одного пользователя вперемешку
+        first, second = UserStatsRegistry(shared=True), UserStatsRegistry(shared=True)
+        held = [await first.get(1), await second.get(1)]
+        await asyncio.gather(*(held[i % 2].update_stats("sos") for i in range(10)))
+        fresh = await second.get(1)
+        return fresh.data, await load_user_data_async("user_stats_1"), first.metrics()
+
+    fresh, saved, metrics = asyncio.run(main())
+    assert fresh["summary"]["total_sos"] == 10
+    assert saved["summary"]["total_sos"] == 10
+    assert metrics["size"] == 0 and metrics["dirty"] == 0
+
+
+def test_event_history_is_capped_but_counts_are_not(data_dir, monkeypatch):
+    from stats import user_stats
+
+    monkeypatch.setattr(user_stats, "STATS_EVENTS_KEEP", 3)
+
+    async def main():
+        registry = UserStatsRegistry()
+        stats = await registry.get(1)
+        for i in range(10):
+            await stats.update_stats("sos", {"n": i})
+        await registry.close()
+        return await load_user_data_async("user_stats_1"), await stats.get_period_counts()
+
+    saved, counts = asyncio.run(main())
+    assert [event["n"] for event in saved["events"]["sos"]] == [7, 8, 9]
+    assert counts["today"]["sos"] == counts["total"]["sos"] == 10
+
+
+def test_old_event_history_is_trimmed_on_load(data_dir, monkeypatch):
+    from stats import user_stats
+    from utils.storage import save_user_data
+
+    monkeypatch.setattr(user_stats, "STATS_EVENTS_KEEP", 3)
+    today = user_stats.get_moscow_time().date().isoformat()
+    # Запись старого формата: вся история, без счётчиков
+    old = {"user_id": 1, "events": {"sos": [{"date": today, "n": i} for i in range(100)]}}
+
+    async def main():
+        await save_user_data(old, "user_stats_1")
+        registry = UserStatsRegistry()
+        stats = await registry.get(1)
+        await stats.update_stats("sos", {"n": 100})
+        await registry.close()
+        return await load_user_data_async("user_stats_1"), await stats.get_period_counts()
+
+    saved, counts = asyncio.run(main())
+    assert [event["n"] for event in saved["events"]["sos"]] == [98, 99, 100]
+    assert counts["today"]["sos"] == counts["total"]["sos"] == 101
@@ -0,0 +1,95 @@
+"""Клиент API ЮKassa против локального фейкового сервера."""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from payment import yookassa_client
+from payment.yookassa_client import YooKassaClient, YooKassaError
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(yookassa_client, "RETRY_BASE_DELAY", 0.01)
+
+
+def _run(responses, call):
+    """
+    Сервер отвечает по очереди (статус, тело) из responses, последним — дальше.
+    Тело-словарь отдаётся как JSON, строка — как есть.
+    Возвращает (результат или ошибку, запросы).
+    """
+    requests = []
+
+    async def handler(request):
+        assert request.headers["Authorization"] == "Basic c2hvcDpzZWNyZXQ="  # shop:secret
+        requests.append((request.method, request.path, request.headers.get("Idempotence-Key")))
+        status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(body, dict):
+            return web.json_response(body, status=status)
+        return web.Response(status=status, text=body)
+
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/v3/{tail:.*}", handler)
+        server = TestServer(app, host="127.0.0.1")
+        await server.start_server()
+        client = YooKassaClient("shop", "secret", api_url=str(server.make_url("/v3")), retries=3)
+        try:
+            return await call(client)
+        except YooKassaError as e:
+            return e
+        finally:
+            await client.close()
+            await server.close()
+
+    return asyncio.run(main()), requests
+
+
+def test_success_after_server_errors():
+    responses = [
+        (502, "<html>Bad Gateway</html>"),
+        (503, {"description": "busy"}),
+        (200, {"id": "p1", "status": "pending"}),
+    ]
+    result, requests = _run(responses, lambda client: client.create_payment({"amount": {}}))
+    assert result == {"id": "p1", "status": "pending"}
+    assert len(requests) == 3
+    # Повторы POST идут с тем же ключом идемпотентности
+    assert len({key for _, _, key in requests}) == 1
+
+
+def test_client_error_with_html_body_is_not_retried():
+    responses = [(401, "<html>Unauthorized</html>")]
+    result, requests = _run(responses, lambda client: client.find_payment("p1"))
+    assert isinstance(result, YooKassaError) and str(result).startswith("401")
+    assert len(requests) == 1
+
+
+def test_client_error_description_is_kept():
+    responses = [(404, {"description": "Payment not found"})]
+    result, requests = _run(responses, lambda client: client.find_payment("p1"))
+    assert str(result) == "404: Payment not found"
+    assert len(requests) == 1
+
+
+def test_rate_limit_and_processing_are_retried():
+    responses = [
+        (429, {"description": "Too many requests"}),
+        (202, {"type": "processing", "retry_after": 10}),
+        (200, {"id": "p1", "status": "succeeded"}),
+    ]
+    result, requests = _run(responses, lambda client: client.find_payment("p1"))
+    assert result["status"] == "succeeded"
+    assert len(requests) == 3
+
+
+def test_persistent_server_error_gives_up():
+    responses = [(500, "oops")]
+    result, requests = _run(responses, lambda client: client.find_payment("p1"))
+    assert isinstance(result, YooKassaError) and str(result).startswith("500")
+    assert len(requests) == 4
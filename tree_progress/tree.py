@@ -1,9 +1,13 @@
 """Модуль прогресса дерева осознанности (Тихая версия)."""
-import json
 import os
 from datetime import datetime, date
 import logging
 
+from utils import serializer
+from utils.atomic import atomic_write_json
+from utils.executor import run_io
+from utils.locks import storage_locks
+
 logger = logging.getLogger(__name__)
 
 
@@ -34,8 +38,7 @@ class TreeProgress:
     def load(self) -> bool:
         try:
             if os.path.exists(self.storage_file):
-                with open(self.storage_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
+                self.data = serializer.load_file(self.storage_file)
                 return True
         except Exception as e:
             logger.error(f"Ошибка загрузки прогресса: {e}")
@@ -44,8 +47,7 @@ class TreeProgress:
     def save(self) -> bool:
         try:
             self.data["updated_at"] = datetime.now().isoformat()
-            with open(self.storage_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            atomic_write_json(self.storage_file, self.data)
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения прогресса: {e}")
@@ -90,6 +92,16 @@ class TreeProgress:
         Добавляет один осознанный день.
         Возвращает словарь с результатом (изменилась ли стадия).
         """
+        # Перечитываем файл под блокировкой пользователя: другой экземпляр
+        # TreeProgress мог уже записать сегодняшний день
+        async with storage_locks.user(self.user_id):
+            await run_io(self.load)
+            result = self._add_day_locked()
+            if not result["already_grown_today"]:
+                await run_io(self.save)
+            return result
+
+    def _add_day_locked(self) -> dict:
         result = {
             "success": True,
             "already_grown_today": False,
@@ -125,7 +137,6 @@ class TreeProgress:
             self.data["current_streak"] = 1
             
         self.data["last_active_date"] = today.isoformat()
-        self.save()
         
         new_stage = self.get_stage_name()
         
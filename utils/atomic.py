@@ -0,0 +1,170 @@
+"""Атомарная запись файлов данных (временный файл + rename) с пакетным fsync."""
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Optional, Set, Union
+
+from utils import serializer
+from utils.executor import run_io
+from utils.serializer import Default
+
+logger = logging.getLogger(__name__)
+
+PathLike = Union[str, Path]
+
+# Политика fsync:
+#   always — fsync временного файла до rename и каталога сразу после (медленно, максимально надёжно);
+#   batch  — fsync временного файла до rename, fsync каталогов (и дозаписанных
+#            логов) пачкой раз в FSYNC_INTERVAL секунд: после сбоя ОС файл
+#            целый — старый или новый, последняя секунда rename может откатиться;
+#   never  — только rename: целость гарантирована лишь при падении процесса,
+#            после сбоя питания/ОС файл может оказаться пустым или обрезанным.
+FSYNC_POLICY = os.getenv("STORAGE_FSYNC", "batch").lower()
+FSYNC_INTERVAL = float(os.getenv("STORAGE_FSYNC_INTERVAL", "1"))
+
+
+def _fsync_path(path: PathLike, directory: bool = False) -> None:
+    flags = os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0)
+    try:
+        fd = os.open(path, flags)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Некоторые ФС не поддерживают fsync каталога — это не ошибка записи
+        pass
+    finally:
+        os.close(fd)
+
+
+class FsyncBatcher:
+    """
+    Копит пути и делает им fsync одной пачкой.
+
+    Для атомарных записей копятся только каталоги (данные временного файла
+    уже синхронизированы до rename), для дозаписи в лог — сами файлы.
+    note() вызывается из потоков пула хранилища, sync() — из пула же,
+    поэтому наборы путей защищены threading.Lock.
+    """
+
+    def __init__(self, interval: float = FSYNC_INTERVAL):
+        self.interval = interval
+        self._pending: Set[str] = set()
+        self._directories: Set[str] = set()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def note(self, path: PathLike) -> None:
+        """Запомнить дозаписанный файл (и его каталог) для следующего fsync."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._pending.add(path)
+
+    def note_directory(self, path: PathLike) -> None:
+        """Запомнить каталог, в котором файл переименован поверх старого."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._directories.add(path)
+
+    def sync(self) -> int:
+        """
+        Сделать fsync всем накопленным файлам и каталогам.
+
+        Returns:
+            int: Сколько путей (файлов и каталогов) синхронизировано
+        """
+        with self._lock:
+            if not self._pending and not self._directories:
+                return 0
+            paths, self._pending = self._pending, set()
+            directories, self._directories = self._directories, set()
+        for path in paths:
+            _fsync_path(path)
+        directories.update(os.path.dirname(p) for p in paths)
+        for directory in directories:
+            _fsync_path(directory, directory=True)
+        return len(paths) + len(directories)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            # fsync блокирует — в пуле потоков хранилища, не в event loop
+            await run_io(self.sync)
+
+    def start(self) -> None:
+        """Запустить пакетный fsync (нужен только для политики batch)."""
+        if FSYNC_POLICY == "batch" and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Остановить фоновую задачу и досинхронизировать остаток."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_io(self.sync)
+
+
+fsync_batcher = FsyncBatcher()
+
+
+def atomic_write_bytes(path: PathLike, payload: bytes) -> None:
+    """
+    Записать файл атомарно: читатель видит либо старое, либо новое содержимое.
+
+    Данные пишутся во временный файл рядом с целевым и переименовываются
+    поверх него (os.replace атомарен в пределах одной ФС). Кроме политики
+    never, данные временного файла синхронизируются до rename: иначе после
+    сбоя ОС на месте файла может оказаться пустой или обрезанный. fsync
+    каталога — сразу (always) или пачкой (batch).
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Свой временный файл у каждой записи: параллельные записи одного файла
+    # из разных потоков не пишут в общий .tmp
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            if FSYNC_POLICY != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    if FSYNC_POLICY == "always":
+        _fsync_path(path.parent, directory=True)
+    elif FSYNC_POLICY == "batch":
+        fsync_batcher.note_directory(path.parent)
+
+
+def dumps_json(data: Any, pretty: bool = False, default: Default = None) -> bytes:
+    """Сериализация в UTF-8: компактно по умолчанию, с отступами для людей."""
+    if pretty:
+        return serializer.dumps_pretty(data, default=default)
+    return serializer.dumps(data, default=default)
+
+
+def atomic_write_json(path: PathLike, data: Any, pretty: bool = False, default: Default = None) -> None:
+    """Атомарно записать JSON (компактный, если не указан pretty)."""
+    atomic_write_bytes(path, dumps_json(data, pretty=pretty, default=default))
+
+
+def note_appended(path: PathLike) -> None:
+    """Учесть дозапись в файл (append-only лог) в политике fsync."""
+    if FSYNC_POLICY == "always":
+        _fsync_path(path)
+    elif FSYNC_POLICY == "batch":
+        fsync_batcher.note(path)
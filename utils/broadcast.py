@@ -0,0 +1,269 @@
+"""Массовая рассылка с ограничением скорости и журналом для докачки."""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from utils import serializer
+from utils.atomic import note_appended
+from utils.executor import run_io
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_DIR = Path("data") / "broadcasts"
+
+# Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+PER_CHAT_INTERVAL = 1.0
+MAX_RETRIES = 3
+# Журнал дописывается пачками не реже раза в JOURNAL_FLUSH_INTERVAL секунд
+JOURNAL_FLUSH_INTERVAL = 1.0
+
+# Журналы рассылок старше стольких дней удаляются (докачка нужна только сегодня)
+BROADCAST_KEEP_DAYS = float(os.getenv("BROADCAST_KEEP_DAYS", "2"))
+
+# Итоговые статусы: повторно таким получателям не пишем
+FINAL_STATUSES = {"sent", "blocked", "bad_request"}
+
+SendFunc = Callable[[int], Awaitable[None]]
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Никому не выдавать токены seconds секунд (ответ 429 от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastJournal:
+    """
+    Журнал рассылки: data/broadcasts/<id>.jsonl, строка на результат.
+
+    После падения load() возвращает последний статус каждого получателя,
+    и повторный запуск той же рассылки пропускает уже обработанных.
+    """
+
+    def __init__(self, broadcast_id: str, directory: Path = BROADCAST_DIR):
+        self.path = Path(directory) / f"{broadcast_id}.jsonl"
+        self._pending: List[bytes] = []
+        self.finished = False
+
+    def load(self) -> Dict[int, str]:
+        """Последние статусы получателей (для вызова из пула потоков)."""
+        statuses: Dict[int, str] = {}
+        self.finished = False
+        if not self.path.exists():
+            return statuses
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = serializer.loads(line)
+                except Exception:
+                    # Недописанная последняя строка после падения
+                    continue
+                if "chat_id" in record:
+                    statuses[record["chat_id"]] = record["status"]
+                else:
+                    self.finished = "finished_at" in record
+        return statuses
+
+    def record(self, chat_id: int, status: str, error: Optional[str] = None) -> None:
+        entry = {"chat_id": chat_id, "status": status, "at": time.time()}
+        if error:
+            entry["error"] = error
+        self._pending.append(serializer.dumps_line(entry))
+
+    def mark_finished(self, summary: Dict[str, int]) -> None:
+        """Отметить, что все получатели обработаны."""
+        self._pending.append(serializer.dumps_line({"finished_at": time.time(), "summary": summary}))
+
+    def _append(self, payload: bytes) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(payload)
+        note_appended(self.path)
+
+    async def flush(self) -> None:
+        if self._pending:
+            payload, self._pending = b"".join(self._pending), []
+            await run_io(self._append, payload)
+
+
+def cleanup_journals(directory: Path = BROADCAST_DIR, keep_days: float = BROADCAST_KEEP_DAYS) -> int:
+    """
+    Удалить журналы рассылок, которые не менялись дольше keep_days.
+
+    Корзины напоминаний создают журнал на каждую минуту с получателями
+    (до 1440 в сутки), а докачка смотрит только сегодняшние. Вызывается
+    из пула потоков.
+
+    Returns:
+        int: Сколько журналов удалено
+    """
+    directory = Path(directory)
+    if not directory.exists():
+        return 0
+    cutoff = time.time() - keep_days * 86400
+    removed = 0
+    for path in directory.glob("*.jsonl"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+class BroadcastEngine:
+    """
+    Рассылка одному сообщению многим получателям.
+
+    Параллельно отправляется не больше concurrency сообщений. Общее ведро
+    токенов держит скорость бота, а отдельный интервал — скорость в один чат.
+    TelegramRetryAfter ставит на паузу всю рассылку на указанное время,
+    после чего отправка повторяется (до MAX_RETRIES раз). Каждый результат
+    пишется в журнал, поэтому прерванная рассылка с тем же id продолжается
+    с места остановки.
+    """
+
+    def __init__(
+        self,
+        rate: float = BROADCAST_RATE,
+        burst: int = BROADCAST_BURST,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        per_chat_interval: float = PER_CHAT_INTERVAL,
+        directory: Path = BROADCAST_DIR,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.directory = Path(directory)
+        # Когда в чат можно писать снова — общее для всех рассылок движка,
+        # поэтому одновременные рассылки в один чат тоже идут с интервалом
+        self._chat_next: Dict[int, float] = {}
+
+    def _prune_chats(self, now: float) -> None:
+        """Забыть чаты, интервал которых уже прошёл (словарь не пересоздаётся)."""
+        for chat_id in [c for c, ready in self._chat_next.items() if ready <= now]:
+            del self._chat_next[chat_id]
+
+    async def _wait_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        ready = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, ready) + self.per_chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+    async def _deliver(self, chat_id: int, send: SendFunc, journal: BroadcastJournal) -> str:
+        error = None
+        for _ in range(MAX_RETRIES + 1):
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await send(chat_id)
+                journal.record(chat_id, "sent")
+                return "sent"
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка: 429, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+                error = f"retry_after={e.retry_after}"
+            except TelegramForbiddenError:
+                journal.record(chat_id, "blocked")
+                return "blocked"
+            except TelegramBadRequest as e:
+                journal.record(chat_id, "bad_request", str(e))
+                return "bad_request"
+            except Exception as e:
+                error = str(e)
+                break
+        journal.record(chat_id, "failed", error)
+        return "failed"
+
+    async def run(self, broadcast_id: str, chat_ids: Iterable[int], send: SendFunc) -> Dict[str, int]:
+        """
+        Разослать всем chat_ids (или продолжить прерванную рассылку).
+
+        Args:
+            broadcast_id: Идентификатор рассылки, например "daily_reminder_2026-10-17"
+            chat_ids: Получатели
+            send: Корутина отправки одному получателю; ошибки Telegram не глушит
+
+        Returns:
+            Dict[str, int]: Количество по статусам (sent, blocked, failed, ...),
+            skipped — обработанные в прошлом запуске
+        """
+        journal = BroadcastJournal(broadcast_id, self.directory)
+        done = await run_io(journal.load)
+        recipients = list(dict.fromkeys(chat_ids))
+        todo = [c for c in recipients if done.get(c) not in FINAL_STATUSES]
+        summary: Counter = Counter(skipped=len(recipients) - len(todo))
+        if summary["skipped"]:
+            logger.info(f"Рассылка {broadcast_id}: продолжение, уже обработано {summary['skipped']}")
+
+        started = time.monotonic()
+        self._prune_chats(started)
+        queue = iter(todo)
+
+        async def worker() -> None:
+            # Фиксированный пул воркеров вместо задачи на каждого получателя
+            for chat_id in queue:
+                summary[await self._deliver(chat_id, send, journal)] += 1
+
+        async def flusher() -> None:
+            while True:
+                await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+                await journal.flush()
+
+        flush_task = asyncio.create_task(flusher())
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(todo)))))
+        finally:
+            flush_task.cancel()
+            try:
+                await flush_task
+            except asyncio.CancelledError:
+                pass
+            await journal.flush()
+        journal.mark_finished(dict(summary))
+        await journal.flush()
+
+        logger.info(
+            f"Рассылка {broadcast_id}: {dict(summary)} за {time.monotonic() - started:.1f} с"
+        )
+        return dict(summary)
+
+
+# Единый экземпляр на процесс: общее ведро для всех рассылок бота
+broadcast_engine = BroadcastEngine()
@@ -0,0 +1,118 @@
+"""Пул потоков для дискового I/O и метрики задержек event loop."""
+import asyncio
+import functools
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Размер пула для операций с хранилищем (отдельно от default executor)
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "4"))
+# STORAGE_EXECUTOR=0 — выполнять I/O прямо в event loop (для сравнения «до/после»)
+STORAGE_EXECUTOR_ENABLED = os.getenv("STORAGE_EXECUTOR", "1") != "0"
+
+# Монитор задержек: как часто просыпаться и сколько замеров хранить
+STALL_SAMPLE_INTERVAL = 0.05
+STALL_WINDOW = 2000
+STALL_THRESHOLD = 0.1  # задержка больше этой считается «зависанием» (сек)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+    return _executor
+
+
+async def run_io(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Выполнить блокирующую функцию хранилища в пуле потоков.
+
+    Вызывающий не должен менять переданные объекты, пока await не вернулся
+    (для этого записи идут под storage_locks).
+    """
+    if not STORAGE_EXECUTOR_ENABLED:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executor() -> None:
+    """Дождаться завершения операций и остановить пул."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+class LoopStallMonitor:
+    """
+    Измеряет, насколько event loop опаздывает с пробуждением.
+
+    Задача засыпает на STALL_SAMPLE_INTERVAL и смотрит, сколько прошло на
+    самом деле. Разница — время, пока loop был занят чужой синхронной работой
+    (обычно файловым I/O в обработчике). Хранит последние STALL_WINDOW
+    замеров для p50/p99/max.
+    """
+
+    def __init__(self, interval: float = STALL_SAMPLE_INTERVAL, window: int = STALL_WINDOW):
+        self.interval = interval
+        self._samples: deque = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= STALL_THRESHOLD:
+                self.stalls += 1
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def reset(self) -> None:
+        """Начать новое окно измерений (например, перед нагрузочным прогоном)."""
+        self._samples.clear()
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        """Метрики текущего окна в миллисекундах."""
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0, "stalls": 0}
+
+        def percentile(p: float) -> float:
+            return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+        return {
+            "samples": len(samples),
+            "p50_ms": round(percentile(0.50), 2),
+            "p99_ms": round(percentile(0.99), 2),
+            "max_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.stalls,
+        }
+
+
+loop_monitor = LoopStallMonitor()
@@ -0,0 +1,93 @@
+"""Блокировки для read-modify-write общих файлов данных."""
+import asyncio
+import zlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable, Optional
+
+# Количество шардов: пользователи с разными шардами пишут параллельно
+LOCK_SHARDS = 64
+
+
+class _TaskReentrantLock:
+    """
+    asyncio.Lock, который одна и та же задача может брать повторно.
+
+    Нужен, чтобы вложенные вызовы (например, обработчик держит блокировку
+    пользователя и вызывает функцию, которая берёт её же) не зависали.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner: Optional[asyncio.Task] = None
+        self._depth = 0
+
+    async def acquire(self) -> None:
+        task = asyncio.current_task()
+        if self._owner is task and task is not None:
+            self._depth += 1
+            return
+        await self._lock.acquire()
+        self._owner = task
+        self._depth = 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+
+class KeyedLockManager:
+    """
+    Сервис блокировок по ключу (обычно user_id).
+
+    Ключи раскладываются по LOCK_SHARDS шардам, поэтому обновления разных
+    пользователей идут параллельно, а одного пользователя — строго по
+    очереди.
+
+    Порядок захвата (иначе возможна взаимная блокировка):
+    - задача держит не больше одного блока user()/key()/keys() за раз;
+      повторный захват того же ключа допустим (блокировка реентерабельна);
+    - если нужно несколько ключей сразу (платёж и пользователь), они
+      берутся одним keys(): шарды захватываются по возрастанию номера;
+    - document_locks (запись документов хранилища) — нижний уровень:
+      их можно брать под storage_locks, но не наоборот.
+    """
+
+    def __init__(self, shards: int = LOCK_SHARDS):
+        self._shards = [_TaskReentrantLock() for _ in range(shards)]
+
+    def _index(self, key: Hashable) -> int:
+        # crc32 вместо hash(): стабилен между запусками и не зависит от PYTHONHASHSEED
+        return zlib.crc32(str(key).encode()) % len(self._shards)
+
+    @asynccontextmanager
+    async def keys(self, *keys: Hashable) -> AsyncIterator[None]:
+        """Блокировка нескольких ключей: шарды берутся в едином порядке."""
+        acquired = []
+        try:
+            for index in sorted({self._index(key) for key in keys}):
+                lock = self._shards[index]
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def key(self, key: Hashable):
+        """Блокировка произвольного ключа."""
+        return self.keys(key)
+
+    def user(self, user_id: int):
+        """Блокировка данных одного пользователя."""
+        return self.key(int(user_id))
+
+
+# Единые экземпляры на процесс
+storage_locks = KeyedLockManager()
+# Запись документов хранилища (save_user_data): внутри не берутся другие блокировки
+document_locks = KeyedLockManager()
+# Отправка отложенных сообщений пользователю — по одному, в порядке срабатывания
+# (верхний уровень: под ней можно брать storage_locks)
+followup_locks = KeyedLockManager()
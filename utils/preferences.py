@@ -0,0 +1,318 @@
+"""
+Настройки пользователей.
+
+В одном процессе — кэш user_preferences.json с отложенной записью,
+при STATE_BACKEND=redis — хэш на пользователя в Redis, общий для воркеров.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from utils import serializer
+from utils.atomic import atomic_write_bytes, dumps_json
+from utils.executor import run_io
+from utils.shared_state import REDIS_PREFIX, get_redis, lease_lock, run_once, use_redis
+
+logger = logging.getLogger(__name__)
+
+PREFERENCES_FILE = Path("data") / "user_preferences.json"
+
+# Как часто (в секундах) сбрасывать накопленные изменения на диск
+FLUSH_INTERVAL = float(os.getenv("PREFERENCES_FLUSH_INTERVAL", "2"))
+# Срок аренды на чтение-изменение-запись настроек пользователя (несколько воркеров)
+USER_LOCK_TTL = 30
+
+
+class PreferencesStore:
+    """
+    Процессное хранилище настроек пользователей.
+
+    Файл читается один раз при первом обращении, дальше все чтения
+    обслуживаются из памяти. Изменения помечают хранилище «грязным»,
+    а фоновая задача раз в FLUSH_INTERVAL секунд атомарно переписывает файл.
+    При остановке бота вызывается close(), который сбрасывает остаток.
+    """
+
+    def __init__(self, file_path: Path = PREFERENCES_FILE, flush_interval: float = FLUSH_INTERVAL):
+        self.file_path = Path(file_path)
+        self.flush_interval = flush_interval
+        self._data: Optional[Dict[str, dict]] = None
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        # Два сброса подряд (фон и close) не должны переписать файл в обратном порядке
+        self._flush_lock = asyncio.Lock()
+
+    # ---------- Загрузка ----------
+
+    def _read_file(self) -> Dict[str, dict]:
+        """Читает файл настроек целиком (только при первом обращении)."""
+        if not self.file_path.exists():
+            return {}
+        try:
+            data = serializer.load_file(self.file_path)
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {self.file_path}: {e}")
+            return {}
+
+    def _users(self) -> Dict[str, dict]:
+        if self._data is None:
+            self._data = self._read_file()
+        return self._data
+
+    async def load(self) -> None:
+        """Прочитать файл в пуле потоков, не блокируя event loop."""
+        if self._data is None:
+            data = await run_io(self._read_file)
+            if self._data is None:
+                self._data = data
+
+    # ---------- Чтение ----------
+
+    async def get_user(self, user_id: int) -> dict:
+        """Возвращает копию настроек пользователя (пустой dict, если их нет)."""
+        user_data = self._users().get(str(user_id))
+        return dict(user_data) if isinstance(user_data, dict) else {}
+
+    async def has_user(self, user_id: int) -> bool:
+        """Есть ли запись о пользователе."""
+        return str(user_id) in self._users()
+
+    async def items(self) -> List[Tuple[str, dict]]:
+        """Снимок всех записей (для админских отчётов и планировщика)."""
+        return list(self._users().items())
+
+    async def count(self) -> int:
+        return len(self._users())
+
+    # ---------- Запись ----------
+
+    async def set_value(self, user_id: int, key: str, value: Any) -> None:
+        """Обновляет одно поле настроек пользователя."""
+        users = self._users()
+        user_str = str(user_id)
+        if not isinstance(users.get(user_str), dict):
+            users[user_str] = {}
+        users[user_str][key] = value
+        self._dirty = True
+
+    async def set_values(self, user_id: int, values: Dict[str, Any]) -> None:
+        """Обновляет несколько полей настроек пользователя (остальные не трогает)."""
+        users = self._users()
+        user_str = str(user_id)
+        if not isinstance(users.get(user_str), dict):
+            users[user_str] = {}
+        users[user_str].update(values)
+        self._dirty = True
+
+    async def replace_user(self, user_id: int, user_data: dict) -> None:
+        """Полностью заменяет настройки пользователя."""
+        self._users()[str(user_id)] = dict(user_data)
+        self._dirty = True
+
+    async def delete_user(self, user_id: int) -> None:
+        """Удаляет все настройки пользователя."""
+        if self._users().pop(str(user_id), None) is not None:
+            self._dirty = True
+
+    @asynccontextmanager
+    async def locked(self, user_id: int) -> AsyncIterator[None]:
+        """
+        Блокировка чтения-изменения-записи настроек между воркерами.
+
+        В одном процессе достаточно storage_locks.user — здесь ничего не делается.
+        """
+        yield
+
+    # ---------- Сброс на диск ----------
+
+    def flush(self) -> bool:
+        """
+        Атомарно записывает файл, если были изменения.
+
+        Returns:
+            bool: Успех операции (True, если писать было нечего)
+        """
+        if not self._dirty or self._data is None:
+            return True
+
+        # Снимок делаем синхронно: пока нет await, данные никто не меняет
+        payload = dumps_json(self._data)
+        self._dirty = False
+
+        try:
+            atomic_write_bytes(self.file_path, payload)
+            return True
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Ошибка сохранения {self.file_path}: {e}")
+            return False
+
+    async def flush_async(self) -> bool:
+        """
+        То же, что flush(), но сериализация и запись идут в пуле потоков.
+
+        Снимок берётся синхронно (копия записей пользователей, без await),
+        поэтому блокировки пользователей не нужны: изменения после снимка
+        попадут в следующий сброс. Настройки меняются только заменой
+        значений (set_value/replace_user), вложенные объекты не правятся
+        на месте — поверхностной копии записи достаточно.
+        """
+        async with self._flush_lock:
+            if not self._dirty or self._data is None:
+                return True
+            snapshot = {
+                user_str: dict(user_data) if isinstance(user_data, dict) else user_data
+                for user_str, user_data in self._data.items()
+            }
+            self._dirty = False
+            try:
+                payload = await run_io(dumps_json, snapshot)
+                await run_io(atomic_write_bytes, self.file_path, payload)
+                return True
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"Ошибка сохранения {self.file_path}: {e}")
+                return False
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_async()
+
+    def start(self) -> None:
+        """Запускает фоновый сброс изменений."""
+        self._users()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу и сбрасывает остаток на диск."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_async()
+
+
+class RedisPreferencesStore(PreferencesStore):
+    """
+    Настройки в Redis: хэш <prefix>:prefs:<user_id> (поле -> JSON) и
+    множество <prefix>:prefs:users.
+
+    set_value() — один HSET, поэтому воркеры, меняющие разные поля одного
+    пользователя, не затирают друг друга. Кэша в процессе нет: любой воркер
+    сразу видит изменения остальных. При первом запуске данные переносятся
+    из user_preferences.json (HSETNX — уже записанное в Redis не трогается).
+    """
+
+    # Сколько пользователей читать одним конвейером в items()
+    BATCH = 500
+
+    def __init__(self, file_path: Path = PREFERENCES_FILE, prefix: str = REDIS_PREFIX):
+        super().__init__(file_path)
+        self.prefix = prefix
+        self.users_key = f"{prefix}:prefs:users"
+        self.imported_key = f"{prefix}:prefs:imported"
+
+    def _key(self, user_id) -> str:
+        return f"{self.prefix}:prefs:{user_id}"
+
+    @staticmethod
+    def _decode(raw: Dict[bytes, bytes]) -> dict:
+        return {field.decode(): serializer.loads(value) for field, value in raw.items()}
+
+    async def load(self) -> None:
+        """Перенести файл настроек в Redis (один раз на все воркеры)."""
+        await run_once(self.imported_key, self._import, self.prefix)
+
+    async def _import(self) -> None:
+        users = await run_io(self._read_file)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for user_str, user_data in users.items():
+                if not isinstance(user_data, dict):
+                    continue
+                for field, value in user_data.items():
+                    pipe.hsetnx(self._key(user_str), field, serializer.dumps(value))
+                pipe.sadd(self.users_key, user_str)
+            await pipe.execute()
+        logger.info(f"Настройки перенесены в Redis: {len(users)} пользователей")
+
+    async def get_user(self, user_id: int) -> dict:
+        return self._decode(await get_redis().hgetall(self._key(user_id)))
+
+    async def has_user(self, user_id: int) -> bool:
+        return bool(await get_redis().sismember(self.users_key, str(user_id)))
+
+    async def items(self) -> List[Tuple[str, dict]]:
+        redis = get_redis()
+        user_strs = sorted(m.decode() for m in await redis.smembers(self.users_key))
+        result = []
+        for i in range(0, len(user_strs), self.BATCH):
+            chunk = user_strs[i:i + self.BATCH]
+            async with redis.pipeline(transaction=False) as pipe:
+                for user_str in chunk:
+                    pipe.hgetall(self._key(user_str))
+                rows = await pipe.execute()
+            result.extend((user_str, self._decode(raw)) for user_str, raw in zip(chunk, rows))
+        return result
+
+    async def count(self) -> int:
+        return await get_redis().scard(self.users_key)
+
+    async def set_value(self, user_id: int, key: str, value: Any) -> None:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(user_id), key, serializer.dumps(value))
+            pipe.sadd(self.users_key, str(user_id))
+            await pipe.execute()
+
+    async def set_values(self, user_id: int, values: Dict[str, Any]) -> None:
+        if not values:
+            return
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(user_id), mapping={k: serializer.dumps(v) for k, v in values.items()})
+            pipe.sadd(self.users_key, str(user_id))
+            await pipe.execute()
+
+    async def replace_user(self, user_id: int, user_data: dict) -> None:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(user_id))
+            if user_data:
+                pipe.hset(self._key(user_id), mapping={k: serializer.dumps(v) for k, v in user_data.items()})
+            pipe.sadd(self.users_key, str(user_id))
+            await pipe.execute()
+
+    async def delete_user(self, user_id: int) -> None:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(user_id))
+            pipe.srem(self.users_key, str(user_id))
+            await pipe.execute()
+
+    @asynccontextmanager
+    async def locked(self, user_id: int) -> AsyncIterator[None]:
+        async with lease_lock(f"prefs:{user_id}", ttl=USER_LOCK_TTL):
+            yield
+
+    # Писать на диск нечего: каждое изменение уже в Redis
+
+    def flush(self) -> bool:
+        return True
+
+    async def flush_async(self) -> bool:
+        return True
+
+    def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+# Единый экземпляр на процесс
+preferences: PreferencesStore = RedisPreferencesStore() if use_redis() else PreferencesStore()
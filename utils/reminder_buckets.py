@@ -0,0 +1,263 @@
+"""Минутные корзины напоминаний: кто получает напоминание в эту минуту (UTC)."""
+import logging
+import os
+import re
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+import pytz
+
+from utils import serializer
+from utils.shared_state import REDIS_PREFIX, get_redis, use_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REMINDER_TIME = "19:00"
+DEFAULT_TIMEZONE = "Europe/Moscow"
+# Пользователи без своего времени раскладываются по окну с начала
+# DEFAULT_REMINDER_TIME (минут), чтобы не попадать все в одну корзину
+DEFAULT_REMINDER_WINDOW = max(1, int(os.getenv("REMINDER_DEFAULT_WINDOW", "60")))
+# Значение reminder_time, отключающее напоминания
+REMINDER_OFF = "off"
+
+MINUTES_PER_DAY = 24 * 60
+
+_TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def parse_reminder_time(text: str) -> Optional[str]:
+    """'9:05' -> '09:05'; None, если формат не ЧЧ:ММ."""
+    match = _TIME_RE.match(text.strip())
+    if not match:
+        return None
+    return f"{int(match.group(1)):02d}:{match.group(2)}"
+
+
+def is_valid_timezone(tz_name: str) -> bool:
+    return tz_name in pytz.all_timezones_set
+
+
+def utc_minute(reminder_time: str, tz_name: str, day: date) -> int:
+    """
+    Минута суток UTC, на которую приходится локальное время пользователя.
+
+    Смещение берётся на конкретный день, поэтому корзины пересчитываются
+    раз в сутки (переход на летнее время).
+    """
+    hour, minute = map(int, reminder_time.split(":"))
+    tz = pytz.timezone(tz_name)
+    local = tz.localize(datetime(day.year, day.month, day.day, hour, minute))
+    utc = local.astimezone(pytz.utc)
+    return utc.hour * 60 + utc.minute
+
+
+def default_reminder_time(user_id: int) -> str:
+    """Время по умолчанию: DEFAULT_REMINDER_TIME + (user_id % окно) минут."""
+    hour, minute = map(int, DEFAULT_REMINDER_TIME.split(":"))
+    total = (hour * 60 + minute + user_id % DEFAULT_REMINDER_WINDOW) % MINUTES_PER_DAY
+    return f"{total // 60:02d}:{total % 60:02d}"
+
+
+def user_reminder_settings(user_data: dict, user_id: Optional[int] = None) -> Tuple[str, str]:
+    """
+    (время, часовой пояс) пользователя с учётом значений по умолчанию.
+
+    Без своего времени пользователь с известным user_id получает
+    default_reminder_time — у одного пользователя оно всегда одно и то же.
+    """
+    reminder_time = user_data.get("reminder_time")
+    if not reminder_time:
+        reminder_time = default_reminder_time(user_id) if user_id is not None else DEFAULT_REMINDER_TIME
+    tz_name = user_data.get("timezone") or DEFAULT_TIMEZONE
+    if not is_valid_timezone(tz_name):
+        tz_name = DEFAULT_TIMEZONE
+    return reminder_time, tz_name
+
+
+def user_local_date(user_data: dict, moment: Optional[datetime] = None) -> date:
+    """Дата у пользователя (его часовой пояс) в момент moment (по умолчанию — сейчас)."""
+    _, tz_name = user_reminder_settings(user_data)
+    return (moment or datetime.now(pytz.utc)).astimezone(pytz.timezone(tz_name)).date()
+
+
+class BucketEntry(NamedTuple):
+    """Что нужно для напоминания без чтения настроек: имя и часовой пояс."""
+    full_name: Optional[str]
+    tz_name: str
+
+
+class ReminderBuckets:
+    """
+    1440 корзин по минутам суток UTC -> {user_id: BucketEntry}.
+
+    Каждый пользователь лежит ровно в одной корзине (или ни в одной, если
+    напоминания выключены). Планировщик раз в минуту забирает одну корзину,
+    поэтому нагрузка распределяется по выбранным пользователями временам
+    (пользователи без своего времени — по окну DEFAULT_REMINDER_WINDOW),
+    а не приходится на один момент.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, Dict[int, BucketEntry]] = {}
+        self._user_bucket: Dict[int, int] = {}
+        self.day: Optional[date] = None
+
+    async def build(self, items: Iterable[Tuple[str, dict]], day: date) -> int:
+        """
+        Разложить всех пользователей по корзинам (preferences.items()).
+
+        Returns:
+            int: Сколько пользователей получают напоминания
+        """
+        self._buckets = {}
+        self._user_bucket = {}
+        self.day = day
+        for user_id_str, user_data in items:
+            self._place(int(user_id_str), user_data)
+        logger.info(f"Корзины напоминаний: {len(self._user_bucket)} пользователей, {len(self._buckets)} минут")
+        return len(self._user_bucket)
+
+    async def set_user(self, user_id: int, user_data: dict) -> None:
+        """Переложить пользователя после изменения настроек."""
+        self._place(user_id, user_data)
+
+    def _place(self, user_id: int, user_data: dict) -> None:
+        self._remove(user_id)
+        placement = bucket_placement(user_id, user_data, self.day or date.today())
+        if placement is None:
+            return
+        minute, entry = placement
+        self._buckets.setdefault(minute, {})[user_id] = entry
+        self._user_bucket[user_id] = minute
+
+    async def remove(self, user_id: int) -> None:
+        self._remove(user_id)
+
+    def _remove(self, user_id: int) -> None:
+        minute = self._user_bucket.pop(user_id, None)
+        if minute is not None:
+            bucket = self._buckets.get(minute)
+            bucket.pop(user_id, None)
+            if not bucket:
+                del self._buckets[minute]
+
+    async def users_at(self, minute: int) -> Set[int]:
+        """Пользователи корзины (копия)."""
+        return set(self._buckets.get(minute % MINUTES_PER_DAY, ()))
+
+    async def entries_at(self, minute: int) -> Dict[int, BucketEntry]:
+        """Пользователи корзины с именем и часовым поясом (копия)."""
+        return dict(self._buckets.get(minute % MINUTES_PER_DAY, {}))
+
+    async def busiest(self, top: int = 5) -> Dict[int, int]:
+        """Самые нагруженные минуты UTC: минута -> число пользователей."""
+        return dict(Counter({m: len(u) for m, u in self._buckets.items()}).most_common(top))
+
+    def __len__(self) -> int:
+        return len(self._user_bucket)
+
+
+def in_reminder_audience(user_data: dict, has_practice: bool) -> bool:
+    """
+    Получает ли пользователь напоминания о практике.
+
+    Да — если у него есть записи практик или он сам выбрал время
+    (/reminder), и напоминания не выключены. Просто зарегистрированным
+    напоминания не приходят.
+    """
+    reminder_time = user_data.get("reminder_time")
+    if reminder_time == REMINDER_OFF:
+        return False
+    return has_practice or bool(reminder_time)
+
+
+def bucket_placement(user_id: int, user_data: dict, day: date) -> Optional[Tuple[int, BucketEntry]]:
+    """Минута UTC и запись корзины пользователя (None — напоминания выключены)."""
+    reminder_time, tz_name = user_reminder_settings(user_data, user_id)
+    if reminder_time == REMINDER_OFF:
+        return None
+    minute = utc_minute(reminder_time, tz_name, day)
+    return minute, BucketEntry(user_data.get("full_name"), tz_name)
+
+
+class RedisReminderBuckets(ReminderBuckets):
+    """
+    Корзины в Redis, общие для воркеров: хэш <prefix>:buckets:<минута>
+    (user_id -> [имя, часовой пояс]) и хэш <prefix>:bucket_of
+    (user_id -> минута). Изменение настроек в одном воркере сразу видно
+    тому, кто разошлёт корзину.
+    """
+
+    def __init__(self, prefix: str = REDIS_PREFIX):
+        super().__init__()
+        self.prefix = prefix
+        self.index_key = f"{prefix}:bucket_of"
+
+    def _key(self, minute: int) -> str:
+        return f"{self.prefix}:buckets:{minute % MINUTES_PER_DAY}"
+
+    def _today(self) -> date:
+        return self.day or datetime.now(pytz.utc).date()
+
+    def _move(self, pipe, user_id: int, old_minute: Optional[int],
+              placement: Optional[Tuple[int, BucketEntry]]) -> None:
+        """Команды переноса пользователя в конвейер (без выполнения)."""
+        if old_minute is not None and (placement is None or placement[0] != old_minute):
+            pipe.hdel(self._key(old_minute), user_id)
+        if placement is None:
+            pipe.hdel(self.index_key, user_id)
+            return
+        minute, entry = placement
+        pipe.hset(self._key(minute), user_id, serializer.dumps(list(entry)))
+        pipe.hset(self.index_key, user_id, minute)
+
+    async def build(self, items: Iterable[Tuple[str, dict]], day: date) -> int:
+        """Пересчитать корзины всех пользователей (переносятся только изменившиеся)."""
+        self.day = day
+        redis = get_redis()
+        old = {int(u): int(m) for u, m in (await redis.hgetall(self.index_key)).items()}
+        placed = 0
+        async with redis.pipeline(transaction=False) as pipe:
+            for user_id_str, user_data in items:
+                user_id = int(user_id_str)
+                placement = bucket_placement(user_id, user_data, day)
+                self._move(pipe, user_id, old.pop(user_id, None), placement)
+                placed += placement is not None
+            # Пользователей без настроек больше нет
+            for user_id, minute in old.items():
+                self._move(pipe, user_id, minute, None)
+            await pipe.execute()
+        logger.info(f"Корзины напоминаний в Redis: {placed} пользователей")
+        return placed
+
+    async def set_user(self, user_id: int, user_data: dict) -> None:
+        redis = get_redis()
+        old_minute = await redis.hget(self.index_key, user_id)
+        async with redis.pipeline(transaction=True) as pipe:
+            self._move(pipe, user_id, int(old_minute) if old_minute is not None else None,
+                       bucket_placement(user_id, user_data, self._today()))
+            await pipe.execute()
+
+    async def remove(self, user_id: int) -> None:
+        redis = get_redis()
+        old_minute = await redis.hget(self.index_key, user_id)
+        if old_minute is not None:
+            async with redis.pipeline(transaction=True) as pipe:
+                self._move(pipe, user_id, int(old_minute), None)
+                await pipe.execute()
+
+    async def users_at(self, minute: int) -> Set[int]:
+        return {int(u) for u in await get_redis().hkeys(self._key(minute))}
+
+    async def entries_at(self, minute: int) -> Dict[int, BucketEntry]:
+        raw = await get_redis().hgetall(self._key(minute))
+        return {int(u): BucketEntry(*serializer.loads(v)) for u, v in raw.items()}
+
+    async def busiest(self, top: int = 5) -> Dict[int, int]:
+        minutes = Counter(int(m) for m in (await get_redis().hgetall(self.index_key)).values())
+        return dict(minutes.most_common(top))
+
+
+# Единый экземпляр на процесс
+reminder_buckets: ReminderBuckets = RedisReminderBuckets() if use_redis() else ReminderBuckets()
@@ -0,0 +1,150 @@
+"""
+Сериализация JSON: быстрая библиотека, если установлена, иначе stdlib.
+
+Порядок выбора: orjson -> msgspec -> json. JSON_BACKEND=json принудительно
+включает стандартную библиотеку (для сравнения и отладки).
+
+Офлайн-команды:
+    python -m utils.serializer export <файл> [выход]   — красивая копия для людей
+    python -m utils.serializer bench [actions_log.json] — сравнение бэкендов
+"""
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_FORCED = os.getenv("JSON_BACKEND", "").lower()
+
+orjson = None
+msgspec = None
+if _FORCED in ("", "orjson"):
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+if orjson is None and _FORCED in ("", "msgspec"):
+    try:
+        import msgspec
+    except ImportError:
+        msgspec = None
+
+BACKEND = "orjson" if orjson else "msgspec" if msgspec else "json"
+
+Default = Optional[Callable[[Any], Any]]
+
+
+def _stdlib_dumps(data: Any, pretty: bool = False, default: Default = None) -> bytes:
+    if pretty:
+        text = json.dumps(data, ensure_ascii=False, indent=2, default=default)
+    else:
+        text = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=default)
+    return text.encode("utf-8")
+
+
+def dumps(data: Any, default: Default = None) -> bytes:
+    """Компактный JSON в UTF-8 (для горячих записей)."""
+    if orjson is not None:
+        # Ключи-числа (часы, user_id) допускаются, как и в stdlib
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+    if msgspec is not None:
+        return msgspec.json.encode(data, enc_hook=default)
+    return _stdlib_dumps(data, default=default)
+
+
+def dumps_pretty(data: Any, default: Default = None) -> bytes:
+    """JSON с отступами — только для экспорта и ручного просмотра."""
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2)
+    if msgspec is not None:
+        return msgspec.json.format(msgspec.json.encode(data, enc_hook=default), indent=2)
+    return _stdlib_dumps(data, pretty=True, default=default)
+
+
+def dumps_line(data: Any, default: Default = None) -> bytes:
+    """Одна строка JSONL (с переводом строки)."""
+    return dumps(data, default=default) + b"\n"
+
+
+def loads(payload: Union[bytes, str]) -> Any:
+    """Разобрать JSON из bytes или str."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    if msgspec is not None:
+        return msgspec.json.decode(payload)
+    return json.loads(payload)
+
+
+def load_file(path: Union[str, Path]) -> Any:
+    """Прочитать и разобрать JSON-файл целиком."""
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+# ==================== ОФЛАЙН-КОМАНДЫ ====================
+
+def export_pretty(src: Union[str, Path], dst: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Сохранить читаемую копию файла данных (JSON или JSONL).
+
+    Args:
+        src: Исходный файл
+        dst: Куда писать (по умолчанию <имя>.pretty.json рядом)
+
+    Returns:
+        Path: Путь к созданному файлу
+    """
+    src = Path(src)
+    dst = Path(dst) if dst else src.with_name(f"{src.stem}.pretty.json")
+    if src.suffix == ".jsonl":
+        with open(src, "rb") as f:
+            data = [loads(line) for line in f if line.strip()]
+    else:
+        data = load_file(src)
+    # Сортированные списки вместо множеств, как в снимках
+    dst.write_bytes(dumps_pretty(data, default=lambda o: sorted(o) if isinstance(o, set) else str(o)))
+    return dst
+
+
+def _bench(path: Union[str, Path], rounds: int = 200) -> None:
+    """Сравнить прежнюю запись (stdlib, indent=2) с быстрой компактной."""
+    raw = Path(path).read_bytes()
+    data = json.loads(raw)
+
+    def measure(func: Callable[[], Any]) -> float:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        return (time.perf_counter() - start) / rounds * 1_000_000
+
+    old_payload = _stdlib_dumps(data, pretty=True)
+    new_payload = dumps(data)
+    results = [
+        ("dumps stdlib indent=2", measure(lambda: _stdlib_dumps(data, pretty=True)), len(old_payload)),
+        ("dumps stdlib compact", measure(lambda: _stdlib_dumps(data)), len(_stdlib_dumps(data))),
+        (f"dumps {BACKEND} compact", measure(lambda: dumps(data)), len(new_payload)),
+        ("loads stdlib", measure(lambda: json.loads(raw)), len(raw)),
+        (f"loads {BACKEND}", measure(lambda: loads(raw)), len(raw)),
+    ]
+    print(f"{path}: {len(raw)} байт, {rounds} повторов")
+    for name, micros, size in results:
+        print(f"  {name:<28} {micros:10.1f} мкс  {size:>10} байт")
+
+
+def main(argv: list) -> int:
+    if len(argv) >= 2 and argv[0] == "export":
+        print(export_pretty(argv[1], argv[2] if len(argv) > 2 else None))
+        return 0
+    if argv and argv[0] == "bench":
+        _bench(argv[1] if len(argv) > 1 else Path("data") / "actions_log.json")
+        return 0
+    print(__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,446 @@
+"""
+Общее состояние воркеров: FSM, таймеры, счётчики, аренды.
+
+STATE_BACKEND=memory (по умолчанию) — один процесс: FSM и счётчики в
+памяти, таймеры — в таблице SQLite рядом с данными (переживают
+перезапуск), настройки и индексы — кэши в памяти с отложенной записью.
+
+STATE_BACKEND=redis (REDIS_URL) — несколько воркеров за webhook. В Redis
+лежат FSM, таймеры, счётчики, аренды, а также то, что в режиме памяти
+кэшируется в процессе: настройки пользователей (utils.preferences),
+индексы подписок и выполненных практик, корзины напоминаний. Каждое
+изменение пишет одну запись (HSET, SADD, ZADD), а не весь документ,
+поэтому воркеры не затирают друг друга. Остальные данные лежат в
+хранилище data/, общем для воркеров (одна машина или общий том):
+статистика пользователей и незавершённые платежи меняются под арендой
+(lease_lock) по свежей копии, лог действий — под файловой блокировкой.
+Разовые задачи (рассылки, проверка подписок, сверка платежей) выполняет
+тот, кто взял аренду.
+"""
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from utils import serializer
+from utils.executor import run_io
+from utils.storage import SQLITE_DB_FILE
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Префикс ключей: несколько ботов могут жить в одном Redis
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "untt")
+# Счётчики за день живут чуть дольше суток
+COUNTER_TTL = 2 * 24 * 3600
+
+_redis = None
+
+
+def use_redis() -> bool:
+    return STATE_BACKEND == "redis"
+
+
+def get_redis():
+    """Общий асинхронный клиент Redis (создаётся при первом обращении)."""
+    global _redis
+    if _redis is None:
+        from redis.asyncio import Redis
+        _redis = Redis.from_url(REDIS_URL)
+    return _redis
+
+
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        # aclose() появился в redis-py 5, раньше был close()
+        close = getattr(_redis, "aclose", None) or _redis.close
+        await close()
+        _redis = None
+
+
+def create_fsm_storage():
+    """Хранилище FSM aiogram по STATE_BACKEND."""
+    if use_redis():
+        from aiogram.fsm.storage.redis import RedisStorage
+        logger.info(f"FSM хранится в Redis: {REDIS_URL}")
+        return RedisStorage(redis=get_redis())
+    from aiogram.fsm.storage.memory import MemoryStorage
+    return MemoryStorage()
+
+
+def _connect_sqlite(db_path: str, schema: str) -> sqlite3.Connection:
+    """Соединение с базой рядом с данными (autocommit) и создание таблицы."""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute(schema)
+    return conn
+
+
+# ==================== ТАЙМЕРЫ ====================
+
+class TimerStore:
+    """
+    Отложенные таймеры пользователей (в памяти процесса).
+
+    Запись: {"kind", "user_id", "due_at" (unix-время), ...}. Ключ — строка,
+    обычно "<kind>:<user_id>". pop() атомарен: если таймер сработал или
+    отменён в другом воркере, второй pop() вернёт None.
+    """
+
+    def __init__(self):
+        self._timers: Dict[str, dict] = {}
+
+    async def put(self, key: str, record: dict) -> None:
+        self._timers[key] = dict(record)
+
+    async def get(self, key: str) -> Optional[dict]:
+        record = self._timers.get(key)
+        return dict(record) if record else None
+
+    async def pop(self, key: str) -> Optional[dict]:
+        return self._timers.pop(key, None)
+
+    async def all(self) -> List[dict]:
+        return [dict(r, key=k) for k, r in self._timers.items()]
+
+    async def keys(self, prefix: str) -> List[str]:
+        """Ключи таймеров, начинающиеся с prefix."""
+        return [k for k in self._timers if k.startswith(prefix)]
+
+
+def _glob_escape(text: str) -> str:
+    """Экранировать спецсимволы шаблона Redis (MATCH)."""
+    return "".join("\\" + c if c in "*?[]\\" else c for c in text)
+
+
+class RedisTimerStore(TimerStore):
+    """Таймеры в хэше Redis: переживают перезапуск и видны всем воркерам."""
+
+    def __init__(self, prefix: str = REDIS_PREFIX):
+        self.hash_key = f"{prefix}:timers"
+
+    async def put(self, key: str, record: dict) -> None:
+        await get_redis().hset(self.hash_key, key, serializer.dumps(record))
+
+    async def get(self, key: str) -> Optional[dict]:
+        raw = await get_redis().hget(self.hash_key, key)
+        return serializer.loads(raw) if raw else None
+
+    async def pop(self, key: str) -> Optional[dict]:
+        # HGET + HDEL в одной транзакции: сработает ровно один воркер
+        async with get_redis().pipeline(transaction=True) as pipe:
+            raw, deleted = await pipe.hget(self.hash_key, key).hdel(self.hash_key, key).execute()
+        return serializer.loads(raw) if raw and deleted else None
+
+    async def all(self) -> List[dict]:
+        raw = await get_redis().hgetall(self.hash_key)
+        return [dict(serializer.loads(v), key=k.decode()) for k, v in raw.items()]
+
+    async def keys(self, prefix: str) -> List[str]:
+        keys = []
+        async for key, _ in get_redis().hscan_iter(self.hash_key, match=_glob_escape(prefix) + "*"):
+            keys.append(key.decode())
+        return keys
+
+
+class SqliteTimerStore(TimerStore):
+    """
+    Таймеры в таблице SQLite рядом с данными: переживают перезапуск без Redis.
+
+    pop() — SELECT и DELETE в одной транзакции BEGIN IMMEDIATE, поэтому
+    таймер забирает ровно один поток (и процесс на этой машине).
+    """
+
+    def __init__(self, db_path: str = SQLITE_DB_FILE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _connect_sqlite(
+                self.db_path,
+                "CREATE TABLE IF NOT EXISTS timers (key TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+        return self._conn
+
+    def _put(self, key: str, record: dict) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO timers (key, data) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, serializer.dumps(record).decode("utf-8")),
+            )
+
+    def _get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connect().execute("SELECT data FROM timers WHERE key = ?", (key,)).fetchone()
+        return serializer.loads(row[0]) if row else None
+
+    def _pop(self, key: str) -> Optional[dict]:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT data FROM timers WHERE key = ?", (key,)).fetchone()
+                if row:
+                    conn.execute("DELETE FROM timers WHERE key = ?", (key,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return serializer.loads(row[0]) if row else None
+
+    def _all(self) -> List[dict]:
+        with self._lock:
+            rows = self._connect().execute("SELECT key, data FROM timers").fetchall()
+        return [dict(serializer.loads(data), key=key) for key, data in rows]
+
+    def _keys(self, prefix: str) -> List[str]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT key FROM timers WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+            ).fetchall()
+        return [key for key, in rows]
+
+    async def put(self, key: str, record: dict) -> None:
+        await run_io(self._put, key, dict(record))
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await run_io(self._get, key)
+
+    async def pop(self, key: str) -> Optional[dict]:
+        return await run_io(self._pop, key)
+
+    async def all(self) -> List[dict]:
+        return await run_io(self._all)
+
+    async def keys(self, prefix: str) -> List[str]:
+        return await run_io(self._keys, prefix)
+
+
+# ==================== СЧЁТЧИКИ ====================
+
+class CounterStore:
+    """Частые счётчики вида name -> field -> int (в памяти процесса)."""
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    async def incr(self, name: str, field: str, amount: int = 1) -> int:
+        self._counters[name][field] += amount
+        return self._counters[name][field]
+
+    async def get_all(self, name: str) -> Dict[str, int]:
+        return dict(self._counters.get(name, {}))
+
+
+class RedisCounterStore(CounterStore):
+    """Счётчики в хэшах Redis (HINCRBY), общие для всех воркеров."""
+
+    def __init__(self, prefix: str = REDIS_PREFIX, ttl: int = COUNTER_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def incr(self, name: str, field: str, amount: int = 1) -> int:
+        key = f"{self.prefix}:counters:{name}"
+        async with get_redis().pipeline(transaction=False) as pipe:
+            value, _ = await pipe.hincrby(key, field, amount).expire(key, self.ttl).execute()
+        return int(value)
+
+    async def get_all(self, name: str) -> Dict[str, int]:
+        raw = await get_redis().hgetall(f"{self.prefix}:counters:{name}")
+        return {k.decode(): int(v) for k, v in raw.items()}
+
+
+# ==================== АРЕНДЫ ====================
+
+# Кто держит аренду: хост и процесс
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+# Истёкшие аренды удаляются раз в столько захватов
+LEASE_CLEANUP_EVERY = 500
+
+
+class SqliteLeaseStore:
+    """
+    Аренды в таблице SQLite: захват — один INSERT ... ON CONFLICT,
+    который срабатывает, только если записи нет или её срок истёк.
+    """
+
+    def __init__(self, db_path: str = SQLITE_DB_FILE, owner: str = LEASE_OWNER):
+        self.db_path = db_path
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._calls = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _connect_sqlite(
+                self.db_path,
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def _acquire(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.expires_at < ?",
+                (name, self.owner, now + ttl, now),
+            )
+            self._calls += 1
+            if self._calls % LEASE_CLEANUP_EVERY == 0:
+                conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            return cursor.rowcount == 1
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        """Захватить аренду на ttl секунд (False — её держит кто-то другой)."""
+        return await run_io(self._acquire, name, ttl)
+
+    def _execute_owned(self, query: str, params: tuple) -> bool:
+        with self._lock:
+            return self._connect().execute(query, params).rowcount == 1
+
+    def _exists(self, name: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM leases WHERE name = ? AND expires_at >= ?", (name, time.time())
+            ).fetchone()
+        return row is not None
+
+    async def exists(self, name: str) -> bool:
+        """Держит ли кто-нибудь аренду name (в том числе метку «сделано»)."""
+        return await run_io(self._exists, name)
+
+    async def renew(self, name: str, ttl: float) -> bool:
+        """Продлить свою аренду (False — её уже забрал другой процесс)."""
+        return await run_io(
+            self._execute_owned,
+            "UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?",
+            (time.time() + ttl, name, self.owner),
+        )
+
+    async def release(self, name: str) -> None:
+        """Отпустить свою аренду (чужую не трогает)."""
+        await run_io(self._execute_owned, "DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+
+class RedisLeaseStore:
+    """Аренды в Redis: SET NX EX."""
+
+    def __init__(self, prefix: str = REDIS_PREFIX, owner: str = LEASE_OWNER):
+        self.prefix = prefix
+        self.owner = owner
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        return bool(await get_redis().set(f"{self.prefix}:lease:{name}", self.owner, nx=True, ex=int(ttl)))
+
+    async def exists(self, name: str) -> bool:
+        return bool(await get_redis().exists(f"{self.prefix}:lease:{name}"))
+
+    async def _if_owner(self, name: str, command: Callable) -> bool:
+        """Выполнить команду, только если аренда наша (WATCH: без гонки с чужим захватом)."""
+        from redis.exceptions import WatchError
+
+        key = f"{self.prefix}:lease:{name}"
+        async with get_redis().pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                owner = await pipe.get(key)
+                if owner is None or owner.decode() != self.owner:
+                    return False
+                pipe.multi()
+                command(pipe, key)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def renew(self, name: str, ttl: float) -> bool:
+        return await self._if_owner(name, lambda pipe, key: pipe.expire(key, int(ttl)))
+
+    async def release(self, name: str) -> None:
+        await self._if_owner(name, lambda pipe, key: pipe.delete(key))
+
+
+# ==================== БЛОКИРОВКА НА АРЕНДЕ ====================
+
+@asynccontextmanager
+async def lease_lock(name: str, ttl: float = 60, poll_interval: float = 0.05,
+                     store=None) -> AsyncIterator[None]:
+    """
+    Взаимное исключение между воркерами (и задачами одного процесса) на аренде.
+
+    Ждёт, пока аренда name освободится, держит её на время блока и отпускает.
+    ttl — страховка: аренда упавшего воркера истечёт сама.
+    """
+    store = store or lease_store
+    while not await store.acquire(name, ttl):
+        await asyncio.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        await store.release(name)
+
+
+# Срок аренды разовой работы (перенос, построение индекса); продлевается, пока она идёт
+ONCE_LEASE_TTL = 60
+
+
+async def run_once(marker: str, build: Callable[[], Awaitable[None]], prefix: str = REDIS_PREFIX,
+                   poll_interval: float = 0.2) -> bool:
+    """
+    Разовая работа на все воркеры (STATE_BACKEND=redis): перенос данных в Redis, построение индекса.
+
+    Работу выполняет тот, кто взял аренду, метка marker ставится только после
+    успешного build(). Остальные воркеры ждут метку: пока её нет, данные в
+    Redis неполные. Если build() упал или воркер умер, аренда отпускается
+    (или истекает), и работу повторяет следующий.
+
+    Returns:
+        bool: True — работу выполнил этот воркер
+    """
+    redis = get_redis()
+    leases = RedisLeaseStore(prefix)
+    lease = f"{marker}:running"
+    while not await redis.exists(marker):
+        if not await leases.acquire(lease, ONCE_LEASE_TTL):
+            await asyncio.sleep(poll_interval)
+            continue
+
+        async def renew():
+            while True:
+                await asyncio.sleep(ONCE_LEASE_TTL / 3)
+                await leases.renew(lease, ONCE_LEASE_TTL)
+
+        renewer = asyncio.create_task(renew())
+        try:
+            # Другой воркер мог закончить, пока мы ждали аренду
+            if await redis.exists(marker):
+                return False
+            await build()
+            await redis.set(marker, "1")
+            return True
+        finally:
+            renewer.cancel()
+            await leases.release(lease)
+    return False
+
+
+# Единые экземпляры на процесс
+timer_store: TimerStore = RedisTimerStore() if use_redis() else SqliteTimerStore()
+counter_store: CounterStore = RedisCounterStore() if use_redis() else CounterStore()
+lease_store = RedisLeaseStore() if use_redis() else SqliteLeaseStore()
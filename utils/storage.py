@@ -1,15 +1,28 @@
-"""Модуль для сохранения и загрузки данных пользователей в JSON."""
-import json
+"""Модуль для сохранения и загрузки данных пользователей (SQLite или JSON)."""
 import os
-from typing import Optional, Any
+from typing import Any, Callable, Iterator, Optional, Tuple
 from datetime import datetime
 import logging
 
+from utils.executor import run_io
+from utils.locks import document_locks, storage_locks
+from utils.storage_backends import (
+    StorageBackend,
+    JsonFileBackend,
+    SqliteBackend,
+    migrate_json_to_sqlite,
+    split_users_data,
+)
+
 logger = logging.getLogger(__name__)
 
 # Директория для хранения данных
 STORAGE_DIR = "data"
 USER_DATA_FILE = os.path.join(STORAGE_DIR, "users.json")
+SQLITE_DB_FILE = os.path.join(STORAGE_DIR, "storage.sqlite3")
+
+# Бэкенд хранилища: sqlite | json
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
 
 
 def _ensure_storage_dir() -> None:
@@ -30,66 +43,81 @@ def _get_user_storage_path(user_id: int) -> str:
     return os.path.join(STORAGE_DIR, f"user_{user_id}.json")
 
 
-def _load_all_users() -> dict:
-    """
-    Загружает все данные пользователей из общего файла.
-    
-    Returns:
-        dict: Словарь с данными всех пользователей
-    """
-    _ensure_storage_dir()
-    
-    if not os.path.exists(USER_DATA_FILE):
-        return {}
-    
-    try:
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки всех пользователей: {e}")
-        return {}
+_backend: Optional[StorageBackend] = None
 
 
-def _save_all_users(users_data: dict) -> bool:
+def get_backend() -> StorageBackend:
     """
-    Сохраняет данные всех пользователей в общий файл.
+    Возвращает бэкенд хранилища (создаётся при первом обращении).
     
-    Args:
-        users_data: Словарь с данными пользователей
+    Выбирается переменной окружения STORAGE_BACKEND: "sqlite" (по умолчанию)
+    или "json". При первом запуске SQLite данные из data/*.json переносятся
+    в базу автоматически, общий документ users_data раскладывается по
+    записям пользователей (для обоих бэкендов).
     
     Returns:
-        bool: Успех операции
+        StorageBackend: Активный бэкенд
     """
-    try:
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_data, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка сохранения всех пользователей: {e}")
-        return False
+    global _backend
+    if _backend is None:
+        _ensure_storage_dir()
+        if STORAGE_BACKEND == "json":
+            _backend = JsonFileBackend(STORAGE_DIR)
+        else:
+            _backend = SqliteBackend(SQLITE_DB_FILE)
+            migrate_json_to_sqlite(STORAGE_DIR, _backend)
+        split_users_data(_backend)
+        logger.info(f"Бэкенд хранилища: {_backend.name}")
+    return _backend
 
 
 async def save_user_data(data: dict, storage_key: str = "users_data") -> bool:
-    """Сохранение данных без создания моделей."""
-    try:
-        # Простое сохранение словаря, без BaseModel
-        with open(f"{STORAGE_DIR}/{storage_key}.json", "w", encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка сохранения: {e}")
-        return False
+    """
+    Сохранение данных без создания моделей (сериализация и запись — в пуле потоков).
+
+    Блокировка документа — из document_locks, поэтому вызывать можно и под
+    блокировкой пользователя: порядок всегда storage_locks -> document_locks.
+    """
+    async with document_locks.key(storage_key):
+        return await run_io(get_backend().save, storage_key, data)
 
 def load_user_data(storage_key: str = "users_data") -> dict:
     """Загрузка данных без создания моделей."""
-    try:
-        with open(f"{STORAGE_DIR}/{storage_key}.json", "r", encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-    except Exception as e:
-        logger.error(f"Ошибка загрузки: {e}")
-        return {}
+    return get_backend().load(storage_key)
+
+
+async def load_user_data_async(storage_key: str = "users_data") -> dict:
+    """Загрузка данных в пуле потоков, не блокируя event loop."""
+    return await run_io(get_backend().load, storage_key)
+
+
+async def delete_document(storage_key: str) -> bool:
+    """Удалить документ (блокировка — та же, что у save_user_data)."""
+    async with document_locks.key(storage_key):
+        return await run_io(get_backend().delete, storage_key)
+
+
+async def load_user_record_async(user_id: int) -> dict:
+    """Запись одного пользователя (practice_history, stats, ...) или {}."""
+    return await run_io(get_backend().get_user, user_id) or {}
+
+
+async def update_user_record(user_id: int, mutate: Callable[[dict], Any]) -> bool:
+    """
+    Прочитать запись пользователя, изменить и сохранить под его блокировкой.
+
+    Читается и пишется одна строка, а не данные всех пользователей.
+    mutate(record) меняет словарь на месте.
+    """
+    async with storage_locks.user(user_id):
+        record = await load_user_record_async(user_id)
+        mutate(record)
+        return await run_io(get_backend().put_user, user_id, record)
+
+
+def iter_user_records() -> Iterator[Tuple[int, dict]]:
+    """Все записи пользователей (для разовых проходов, например построения индекса)."""
+    return get_backend().iter_users()
 
 
 async def get_all_user_data(user_id: int) -> Optional[dict]:
@@ -103,14 +131,12 @@ async def get_all_user_data(user_id: int) -> Optional[dict]:
         dict или None: Все данные пользователя
     """
     try:
-        all_users = _load_all_users()
-        user_str = str(user_id)
+        user_data = await run_io(get_backend().get_user, user_id)
         
-        if user_str in all_users:
+        if user_data is not None:
             logger.info(f"Все данные загружены для user_id: {user_id}")
-            return all_users[user_str]
         
-        return None
+        return user_data
         
     except Exception as e:
         logger.error(f"Ошибка загрузки всех данных для user_id {user_id}: {e}")
@@ -129,29 +155,32 @@ async def delete_user_data(user_id: int, key: str = None) -> bool:
         bool: Успех операции
     """
     try:
-        all_users = _load_all_users()
-        user_str = str(user_id)
-        
-        if user_str not in all_users:
-            return True
-        
-        if key is None:
-            # Удаляем всё
-            del all_users[user_str]
-            logger.info(f"Все данные удалены для user_id: {user_id}")
-        else:
-            # Удаляем конкретный ключ
-            if key in all_users[user_str]:
-                del all_users[user_str][key]
-                logger.info(f"Данные '{key}' удалены для user_id: {user_id}")
-        
-        return _save_all_users(all_users)
-        
+        async with storage_locks.user(user_id):
+            return await run_io(_delete_user_data_locked, user_id, key)
     except Exception as e:
         logger.error(f"Ошибка удаления данных для user_id {user_id}: {e}")
         return False
 
 
+def _delete_user_data_locked(user_id: int, key: Optional[str]) -> bool:
+    """Удаление под блокировкой пользователя (см. delete_user_data)."""
+    backend = get_backend()
+    
+    if key is None:
+        # Удаляем всё
+        logger.info(f"Все данные удалены для user_id: {user_id}")
+        return backend.delete_user(user_id)
+    
+    user_data = backend.get_user(user_id)
+    if user_data is None or key not in user_data:
+        return True
+    
+    # Удаляем конкретный ключ
+    del user_data[key]
+    logger.info(f"Данные '{key}' удалены для user_id: {user_id}")
+    return backend.put_user(user_id, user_data)
+
+
 async def update_user_data(user_id: int, key: str, updates: dict) -> bool:
     """
     Обновляет часть данных пользователя.
@@ -190,14 +219,14 @@ def get_storage_stats() -> dict:
     
     stats = {
         "storage_dir": STORAGE_DIR,
+        "backend": STORAGE_BACKEND,
         "total_users": 0,
         "files": []
     }
     
     try:
         # Считаем пользователей
-        all_users = _load_all_users()
-        stats["total_users"] = len(all_users)
+        stats["total_users"] = get_backend().count_users()
         
         # Список файлов в директории
         if os.path.exists(STORAGE_DIR):
@@ -221,8 +250,8 @@ async def user_exists(user_id: int) -> bool:
     Returns:
         bool: Существует ли пользователь
     """
-    all_users = _load_all_users()
-    return str(user_id) in all_users
+    return await run_io(get_backend().user_exists, user_id)
+
 async def save_user_profile(user_id: int, profile: dict) -> bool:
     """Сохраняет профиль пользователя."""
     return await save_user_data(user_id, profile, "profile")
@@ -0,0 +1,372 @@
+"""Бэкенды хранилища данных пользователей: JSON-файлы и SQLite."""
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+from utils import serializer
+from utils.atomic import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# Файлы в data/, которыми владеют другие модули (не utils.storage).
+# user_stats_<id>.json сюда не входят: UserStats читает и пишет их как
+# документы хранилища, поэтому при переходе на SQLite они переносятся
+FOREIGN_FILES = {
+    "user_preferences.json",
+    "actions_log.json",
+    "actions_log_backup.json",
+    "actions_snapshot.json",
+    "actions_snapshot_backup.json",
+    "actions_base.json",
+}
+FOREIGN_PREFIXES = ("tree_",)
+
+
+class StorageBackend:
+    """
+    Интерфейс бэкенда хранилища.
+
+    Две сущности:
+    - документы: произвольный JSON по ключу (бывшие data/<key>.json);
+    - пользователи: по одной записи на user_id (бывший data/users.json).
+    """
+
+    name = "base"
+
+    def load(self, storage_key: str) -> dict:
+        raise NotImplementedError
+
+    def save(self, storage_key: str, data: dict) -> bool:
+        raise NotImplementedError
+
+    def delete(self, storage_key: str) -> bool:
+        raise NotImplementedError
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put_user(self, user_id: int, data: dict) -> bool:
+        raise NotImplementedError
+
+    def delete_user(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    def user_exists(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    def count_users(self) -> int:
+        raise NotImplementedError
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        raise NotImplementedError
+
+    def get_meta(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set_meta(self, key: str, value: str) -> bool:
+        raise NotImplementedError
+
+
+class JsonFileBackend(StorageBackend):
+    """Прежнее поведение: документ = файл, все пользователи в одном users.json."""
+
+    name = "json"
+
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        self.users_file = os.path.join(storage_dir, "users.json")
+
+    def _path(self, storage_key: str) -> str:
+        return os.path.join(self.storage_dir, f"{storage_key}.json")
+
+    def load(self, storage_key: str) -> dict:
+        try:
+            return serializer.load_file(self._path(storage_key))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки: {e}")
+            return {}
+
+    def save(self, storage_key: str, data: dict) -> bool:
+        try:
+            atomic_write_json(self._path(storage_key), data)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения: {e}")
+            return False
+
+    def delete(self, storage_key: str) -> bool:
+        try:
+            os.remove(self._path(storage_key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Ошибка удаления: {e}")
+            return False
+        return True
+
+    def _load_all_users(self) -> dict:
+        if not os.path.exists(self.users_file):
+            return {}
+        try:
+            return serializer.load_file(self.users_file)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки всех пользователей: {e}")
+            return {}
+
+    def _save_all_users(self, users_data: dict) -> bool:
+        try:
+            atomic_write_json(self.users_file, users_data)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения всех пользователей: {e}")
+            return False
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        return self._load_all_users().get(str(user_id))
+
+    def put_user(self, user_id: int, data: dict) -> bool:
+        all_users = self._load_all_users()
+        all_users[str(user_id)] = data
+        return self._save_all_users(all_users)
+
+    def delete_user(self, user_id: int) -> bool:
+        all_users = self._load_all_users()
+        if all_users.pop(str(user_id), None) is None:
+            return True
+        return self._save_all_users(all_users)
+
+    def user_exists(self, user_id: int) -> bool:
+        return str(user_id) in self._load_all_users()
+
+    def count_users(self) -> int:
+        return len(self._load_all_users())
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        for user_str, user_data in self._load_all_users().items():
+            if user_str.isdigit():
+                yield int(user_str), user_data
+
+    def get_meta(self, key: str) -> Optional[str]:
+        return self.load("storage_meta").get(key)
+
+    def set_meta(self, key: str, value: str) -> bool:
+        meta = self.load("storage_meta")
+        meta[key] = value
+        return self.save("storage_meta", meta)
+
+
+class SqliteBackend(StorageBackend):
+    """
+    SQLite в режиме WAL.
+
+    Пользователи лежат построчно с user_id в качестве PRIMARY KEY (B-дерево),
+    поэтому чтение/удаление одного пользователя — O(log n), без разбора
+    всего файла. Документы хранятся в отдельной таблице по ключу.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Одно соединение на процесс; доступ сериализуем блокировкой
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                storage_key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+
+    def _fetch_one(self, query: str, params: tuple) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(query, params).fetchone()
+
+    def _execute(self, query: str, params: tuple) -> bool:
+        try:
+            with self._lock:
+                self._conn.execute(query, params)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка SQLite: {e}")
+            return False
+
+    def load(self, storage_key: str) -> dict:
+        try:
+            row = self._fetch_one("SELECT data FROM documents WHERE storage_key = ?", (storage_key,))
+            return serializer.loads(row[0]) if row else {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки: {e}")
+            return {}
+
+    def save(self, storage_key: str, data: dict) -> bool:
+        return self._execute(
+            "INSERT INTO documents (storage_key, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(storage_key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (storage_key, serializer.dumps(data).decode("utf-8"), datetime.now().isoformat()),
+        )
+
+    def delete(self, storage_key: str) -> bool:
+        return self._execute("DELETE FROM documents WHERE storage_key = ?", (storage_key,))
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        try:
+            row = self._fetch_one("SELECT data FROM users WHERE user_id = ?", (int(user_id),))
+            return serializer.loads(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка загрузки пользователя {user_id}: {e}")
+            return None
+
+    def put_user(self, user_id: int, data: dict) -> bool:
+        return self._execute(
+            "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (int(user_id), serializer.dumps(data).decode("utf-8"), datetime.now().isoformat()),
+        )
+
+    def delete_user(self, user_id: int) -> bool:
+        return self._execute("DELETE FROM users WHERE user_id = ?", (int(user_id),))
+
+    def user_exists(self, user_id: int) -> bool:
+        return self._fetch_one("SELECT 1 FROM users WHERE user_id = ?", (int(user_id),)) is not None
+
+    def count_users(self) -> int:
+        row = self._fetch_one("SELECT COUNT(*) FROM users", ())
+        return row[0] if row else 0
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        for user_id, data in rows:
+            try:
+                yield user_id, serializer.loads(data)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки пользователя {user_id}: {e}")
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._fetch_one("SELECT value FROM meta WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> bool:
+        return self._execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+def migrate_json_to_sqlite(storage_dir: str, backend: SqliteBackend, force: bool = False) -> dict:
+    """
+    Одноразовый перенос data/*.json в SQLite.
+
+    users.json раскладывается построчно в таблицу users, остальные файлы
+    становятся документами с ключом = имя файла без .json. Файлы других
+    модулей (настройки, лог действий, деревья) не трогаются. Исходные файлы
+    не удаляются. Повторный запуск ничего не делает, если не указан force.
+
+    Returns:
+        dict: Сколько пользователей и документов перенесено
+    """
+    result = {"users": 0, "documents": 0, "skipped": False}
+
+    if not force and backend.get_meta("json_migrated_at"):
+        result["skipped"] = True
+        return result
+
+    if not os.path.isdir(storage_dir):
+        backend.set_meta("json_migrated_at", datetime.now().isoformat())
+        return result
+
+    for file_name in sorted(os.listdir(storage_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        if file_name in FOREIGN_FILES or file_name.startswith(FOREIGN_PREFIXES):
+            continue
+
+        path = os.path.join(storage_dir, file_name)
+        try:
+            content = serializer.load_file(path)
+        except Exception as e:
+            logger.error(f"Миграция: не удалось прочитать {path}: {e}")
+            continue
+
+        if file_name == "users.json":
+            for user_str, user_data in content.items():
+                try:
+                    user_id = int(user_str)
+                except ValueError:
+                    # Старые записи вида "daily_check_<id>" переносим документами
+                    if backend.save(user_str, user_data):
+                        result["documents"] += 1
+                    continue
+                if backend.put_user(user_id, user_data):
+                    result["users"] += 1
+        elif backend.save(file_name[:-len(".json")], content):
+            result["documents"] += 1
+
+    backend.set_meta("json_migrated_at", datetime.now().isoformat())
+    logger.info(f"Миграция JSON -> SQLite: {result['users']} пользователей, {result['documents']} документов")
+    return result
+
+
+def split_users_data(backend: StorageBackend, storage_key: str = "users_data") -> dict:
+    """
+    Одноразовый перенос общего документа users_data в записи пользователей.
+
+    Раньше practice_history и stats всех пользователей лежали в одном
+    документе, который читался и перезаписывался целиком на каждую
+    практику. Теперь это поля записи пользователя (таблица users).
+    Истории объединяются по датам, остальные поля записи не затираются.
+    Исходный документ сохраняется копией <storage_key>_backup и удаляется.
+
+    Returns:
+        dict: Сколько пользователей перенесено
+    """
+    result = {"users": 0, "skipped": False}
+
+    if backend.get_meta("users_data_split_at"):
+        result["skipped"] = True
+        return result
+
+    document = backend.load(storage_key)
+    for user_str, user_info in document.items():
+        if not user_str.isdigit() or not isinstance(user_info, dict):
+            continue
+        user_id = int(user_str)
+        record = backend.get_user(user_id) or {}
+        for field, value in user_info.items():
+            if field == "practice_history" and isinstance(value, dict):
+                record.setdefault(field, {}).update(value)
+            else:
+                record.setdefault(field, value)
+        if not backend.put_user(user_id, record):
+            logger.error(f"Перенос users_data: не удалось сохранить пользователя {user_id}")
+            return result
+        result["users"] += 1
+
+    if document:
+        if not backend.save(f"{storage_key}_backup", document) or not backend.delete(storage_key):
+            return result
+    backend.set_meta("users_data_split_at", datetime.now().isoformat())
+    logger.info(f"Перенос users_data: {result['users']} пользователей")
+    return result
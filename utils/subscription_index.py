@@ -0,0 +1,149 @@
+"""Индекс подписок, упорядоченный по дате окончания."""
+import bisect
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pytz
+
+from utils.shared_state import REDIS_PREFIX, get_redis, run_once, use_redis
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+
+
+def subscription_end_ts(sub_end_str: Optional[str]) -> Optional[float]:
+    """
+    Дата окончания подписки из настроек -> unix-время.
+
+    Старые записи хранились без часового пояса — считаем их московскими,
+    как get_user_status.
+    """
+    if not sub_end_str:
+        return None
+    try:
+        sub_end = datetime.fromisoformat(sub_end_str)
+    except ValueError:
+        return None
+    if sub_end.tzinfo is None:
+        sub_end = MOSCOW_TZ.localize(sub_end)
+    return sub_end.timestamp()
+
+
+class SubscriptionIndex:
+    """
+    Отсортированный список (окончание, user_id) + словарь user_id -> окончание.
+
+    Источник правды — preferences; индекс строится из них один раз при
+    старте и дальше обновляется при каждом продлении. Поиск подписок,
+    заканчивающихся в окне, — два bisect, без разбора всех настроек.
+    """
+
+    def __init__(self):
+        self._sorted: List[Tuple[float, int]] = []
+        self._ends: Dict[int, float] = {}
+
+    async def build(self, items: Iterable[Tuple[str, dict]]) -> int:
+        """
+        Построить индекс по снимку настроек (preferences.items()).
+
+        Returns:
+            int: Сколько подписок в индексе
+        """
+        self._ends = {}
+        for user_id_str, user_data in items:
+            end_ts = subscription_end_ts(user_data.get("subscription_end_date"))
+            if end_ts is not None:
+                self._ends[int(user_id_str)] = end_ts
+        self._sorted = sorted((end_ts, user_id) for user_id, end_ts in self._ends.items())
+        logger.info(f"Индекс подписок: {len(self._sorted)}")
+        return len(self._sorted)
+
+    async def update(self, user_id: int, end: datetime) -> None:
+        """Записать новую дату окончания подписки пользователя."""
+        await self.remove(user_id)
+        end_ts = end.timestamp()
+        self._ends[user_id] = end_ts
+        bisect.insort(self._sorted, (end_ts, user_id))
+
+    async def remove(self, user_id: int) -> None:
+        end_ts = self._ends.pop(user_id, None)
+        if end_ts is None:
+            return
+        pos = bisect.bisect_left(self._sorted, (end_ts, user_id))
+        if pos < len(self._sorted) and self._sorted[pos] == (end_ts, user_id):
+            del self._sorted[pos]
+
+    async def get(self, user_id: int) -> Optional[float]:
+        return self._ends.get(user_id)
+
+    async def expiring_between(self, start: datetime, end: datetime) -> List[Tuple[int, float]]:
+        """Подписки с окончанием в (start, end]: список (user_id, окончание)."""
+        lo = bisect.bisect_right(self._sorted, (start.timestamp(), float("inf")))
+        hi = bisect.bisect_right(self._sorted, (end.timestamp(), float("inf")))
+        return [(user_id, end_ts) for end_ts, user_id in self._sorted[lo:hi]]
+
+    async def active_after(self, moment: datetime) -> List[Tuple[int, float]]:
+        """Подписки, которые ещё не закончились к moment."""
+        lo = bisect.bisect_right(self._sorted, (moment.timestamp(), float("inf")))
+        return [(user_id, end_ts) for end_ts, user_id in self._sorted[lo:]]
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+
+class RedisSubscriptionIndex(SubscriptionIndex):
+    """
+    Тот же индекс в сортированном множестве Redis (score — окончание),
+    общий для воркеров: продление в одном сразу видно остальным.
+
+    Строится из настроек один раз на все воркеры (дальше его ведут
+    update/remove), иначе старт нового воркера со снимком настроек мог бы
+    откатить продление, сделанное в это время другим.
+    """
+
+    def __init__(self, prefix: str = REDIS_PREFIX):
+        super().__init__()
+        self.prefix = prefix
+        self.key = f"{prefix}:subscriptions"
+        self.built_key = f"{prefix}:subscriptions:built"
+
+    async def build(self, items: Iterable[Tuple[str, dict]]) -> int:
+        redis = get_redis()
+
+        async def build():
+            ends = {}
+            for user_id_str, user_data in items:
+                end_ts = subscription_end_ts(user_data.get("subscription_end_date"))
+                if end_ts is not None:
+                    ends[user_id_str] = end_ts
+            if ends:
+                await redis.zadd(self.key, ends)
+            logger.info(f"Индекс подписок в Redis: {len(ends)}")
+
+        await run_once(self.built_key, build, self.prefix)
+        return await redis.zcard(self.key)
+
+    async def update(self, user_id: int, end: datetime) -> None:
+        await get_redis().zadd(self.key, {str(user_id): end.timestamp()})
+
+    async def remove(self, user_id: int) -> None:
+        await get_redis().zrem(self.key, str(user_id))
+
+    async def get(self, user_id: int) -> Optional[float]:
+        return await get_redis().zscore(self.key, str(user_id))
+
+    async def _range(self, low: str, high: str) -> List[Tuple[int, float]]:
+        rows = await get_redis().zrangebyscore(self.key, low, high, withscores=True)
+        return [(int(member), score) for member, score in rows]
+
+    async def expiring_between(self, start: datetime, end: datetime) -> List[Tuple[int, float]]:
+        return await self._range(f"({start.timestamp()}", str(end.timestamp()))
+
+    async def active_after(self, moment: datetime) -> List[Tuple[int, float]]:
+        return await self._range(f"({moment.timestamp()}", "+inf")
+
+
+# Единый экземпляр на процесс
+subscription_index: SubscriptionIndex = RedisSubscriptionIndex() if use_redis() else SubscriptionIndex()
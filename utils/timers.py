@@ -0,0 +1,282 @@
+"""Сервис отложенных таймеров: одна куча и одна задача-диспетчер на процесс."""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from utils.shared_state import TimerStore, timer_store, use_redis
+
+logger = logging.getLogger(__name__)
+
+TimerHandler = Callable[[dict], Awaitable[None]]
+
+# Как часто перечитывать общее хранилище таймеров (несколько воркеров), секунды
+TIMER_RESCAN_INTERVAL = float(os.getenv("TIMER_RESCAN_INTERVAL", "60"))
+# Через сколько секунд повторить таймер, обработчик которого упал, и сколько попыток дать
+TIMER_RETRY_DELAY = float(os.getenv("TIMER_RETRY_DELAY", "30"))
+TIMER_MAX_ATTEMPTS = int(os.getenv("TIMER_MAX_ATTEMPTS", "5"))
+# Сколько секунд close() ждёт работающие обработчики
+TIMER_CLOSE_TIMEOUT = float(os.getenv("TIMER_CLOSE_TIMEOUT", "10"))
+
+
+class _Entry:
+    __slots__ = ("due_at", "seq", "key", "cancelled")
+
+    def __init__(self, due_at: float, seq: int, key: str):
+        self.due_at = due_at
+        self.seq = seq
+        self.key = key
+        self.cancelled = False
+
+    def __lt__(self, other: "_Entry") -> bool:
+        return (self.due_at, self.seq) < (other.due_at, other.seq)
+
+
+class TimerService:
+    """
+    Таймеры на куче с ленивой отменой.
+
+    Вместо задачи на каждый таймер — min-куча сроков и один диспетчер,
+    который спит до ближайшего срока. schedule() — O(log n), cancel() —
+    O(1): запись только помечается отменённой и выбрасывается, когда
+    дойдёт до вершины кучи. Сроки хранятся в TimerStore (SQLite или Redis),
+    при старте всё сохранённое возвращается в кучу, просроченное
+    срабатывает сразу.
+
+    Обработчики регистрируются по типу таймера (record["kind"]) и
+    вызываются отдельной задачей, чтобы медленная отправка не задерживала
+    остальные таймеры.
+
+    rescan_interval (несколько воркеров): раз в столько секунд хранилище
+    перечитывается, и в кучу попадают таймеры, поставленные другими
+    воркерами, — если тот воркер остановлен, таймер всё равно сработает.
+    Срабатывает ровно один воркер: запись забирается через store.pop().
+
+    Запись возвращается в хранилище, если обработчик упал (повтор через
+    TIMER_RETRY_DELAY, не больше TIMER_MAX_ATTEMPTS попыток) или был прерван
+    остановкой воркера (сработает при следующем запуске), поэтому
+    обработчики должны быть идемпотентными. close() ждёт работающие
+    обработчики не дольше TIMER_CLOSE_TIMEOUT.
+    """
+
+    def __init__(self, store: TimerStore = timer_store, rescan_interval: Optional[float] = None):
+        self.store = store
+        self.rescan_interval = rescan_interval
+        self._rescan_task: Optional[asyncio.Task] = None
+        self._heap: List[_Entry] = []
+        self._entries: Dict[str, _Entry] = {}
+        self._handlers: Dict[str, TimerHandler] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[asyncio.Task, Optional[str]] = {}
+        self.fired = 0
+
+    def register(self, kind: str, handler: TimerHandler) -> None:
+        """Назначить обработчик для таймеров типа kind."""
+        self._handlers[kind] = handler
+
+    # ---------- Локальная куча ----------
+
+    def _push(self, key: str, due_at: float) -> None:
+        old = self._entries.get(key)
+        if old is not None:
+            old.cancelled = True
+        entry = _Entry(due_at, next(self._seq), key)
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        # Будим диспетчер, только если срок стал ближайшим
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def _drop(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry.cancelled = True
+        return True
+
+    # ---------- API ----------
+
+    async def schedule(self, key: str, kind: str, due_at: float, **payload) -> None:
+        """
+        Поставить таймер; повторный вызов с тем же ключом переносит срок.
+
+        Args:
+            key: Уникальный ключ, например "quick_pause:<user_id>"
+            kind: Тип таймера — по нему выбирается обработчик
+            due_at: Срок срабатывания (unix-время)
+            payload: Данные для обработчика (должны сериализоваться в JSON)
+        """
+        await self.store.put(key, {**payload, "kind": kind, "due_at": due_at})
+        self._push(key, due_at)
+
+    async def cancel(self, key: str) -> bool:
+        """Отменить таймер (в том числе поставленный другим воркером)."""
+        removed = await self.store.pop(key) is not None
+        # Сработавший таймер после отмены не повторяем, даже если обработчик упадёт
+        for task, running_key in list(self._running.items()):
+            if running_key == key:
+                self._running[task] = None
+        return self._drop(key) or removed
+
+    async def cancel_prefix(self, prefix: str) -> int:
+        """
+        Отменить все таймеры с ключом, начинающимся с prefix.
+
+        Returns:
+            int: Сколько таймеров отменено
+        """
+        keys = set(await self.store.keys(prefix))
+        keys.update(key for key in self._entries if key.startswith(prefix))
+        cancelled = 0
+        for key in keys:
+            if await self.cancel(key):
+                cancelled += 1
+        return cancelled
+
+    def has(self, key: str) -> bool:
+        """Есть ли таймер в локальной куче."""
+        return key in self._entries
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    # ---------- Диспетчер ----------
+
+    async def _fire(self, entry: _Entry) -> None:
+        # Запись могли отменить или перенести в другом воркере
+        record = await self.store.get(entry.key)
+        if record is None:
+            return
+        if record["due_at"] > time.time() + 0.5:
+            self._push(entry.key, record["due_at"])
+            return
+        if await self.store.pop(entry.key) is None:
+            return
+
+        handler = self._handlers.get(record.get("kind"))
+        if handler is None:
+            logger.error(f"Нет обработчика таймера {record.get('kind')} ({entry.key})")
+            return
+        self.fired += 1
+        task = asyncio.create_task(self._run_handler(handler, entry.key, record))
+        self._running[task] = entry.key
+        task.add_done_callback(lambda done: self._running.pop(done, None))
+
+    async def _run_handler(self, handler: TimerHandler, key: str, record: dict) -> None:
+        try:
+            await handler(record)
+        except asyncio.CancelledError:
+            # Воркер останавливается — таймер сработает при следующем запуске
+            await self._restore(key, record, record["due_at"])
+            raise
+        except Exception as e:
+            attempts = record.get("attempts", 0) + 1
+            if attempts >= TIMER_MAX_ATTEMPTS:
+                logger.error(f"Ошибка обработчика таймера {record.get('kind')} ({key}), попытки исчерпаны: {e}")
+                return
+            logger.error(f"Ошибка обработчика таймера {record.get('kind')} ({key}), повтор: {e}")
+            await self._restore(key, {**record, "attempts": attempts}, time.time() + TIMER_RETRY_DELAY)
+
+    async def _restore(self, key: str, record: dict, due_at: float) -> None:
+        """Вернуть сработавший таймер в хранилище, если его не отменили и не поставили заново."""
+        if self._running.get(asyncio.current_task(), key) is None:
+            return
+        if await self.store.get(key) is not None or key in self._entries:
+            return
+        await self.store.put(key, {**record, "due_at": due_at})
+        self._push(key, due_at)
+
+    async def _dispatch(self) -> None:
+        while True:
+            # Выбрасываем отменённые записи с вершины
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                timeout = None
+            else:
+                timeout = self._heap[0].due_at - time.time()
+
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            if self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+            try:
+                await self._fire(entry)
+            except Exception as e:
+                logger.error(f"Ошибка таймера {entry.key}: {e}")
+
+    async def start(self) -> int:
+        """
+        Загрузить сохранённые таймеры и запустить диспетчер.
+
+        Returns:
+            int: Сколько таймеров восстановлено
+        """
+        recovered = await self._load()
+        if recovered:
+            logger.info(f"Восстановлено таймеров: {recovered}")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        if self.rescan_interval and (self._rescan_task is None or self._rescan_task.done()):
+            self._rescan_task = asyncio.create_task(self._rescan_loop())
+        return recovered
+
+    async def _load(self) -> int:
+        """Положить в кучу сохранённые таймеры, которых в ней нет."""
+        loaded = 0
+        for record in await self.store.all():
+            if record["key"] not in self._entries:
+                self._push(record["key"], record["due_at"])
+                loaded += 1
+        return loaded
+
+    async def _rescan_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.rescan_interval)
+            try:
+                await self._load()
+            except Exception as e:
+                logger.error(f"Ошибка чтения хранилища таймеров: {e}")
+
+    async def close(self, timeout: float = TIMER_CLOSE_TIMEOUT) -> None:
+        """
+        Остановить диспетчер. Сроки остаются в хранилище до следующего запуска.
+
+        Работающие обработчики ждём не дольше timeout секунд; прерванные
+        возвращают свои таймеры в хранилище.
+        """
+        for task in (self._task, self._rescan_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._rescan_task = None
+        running = list(self._running)
+        if not running:
+            return
+        _, pending = await asyncio.wait(running, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Обработчики таймеров прерваны при остановке: {len(pending)}")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+# Единый экземпляр на процесс
+timer_service = TimerService(rescan_interval=TIMER_RESCAN_INTERVAL if use_redis() else None)
@@ -0,0 +1,154 @@
+"""Очередь входящих обновлений webhook: быстрый ответ Telegram, обработка воркерами."""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# WEBHOOK_MODE=async — ставить обновление в очередь и сразу отвечать 200,
+# inline — обрабатывать прямо в запросе (как раньше)
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "inline").lower()
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+# Ёмкость очереди одного воркера; при переполнении Telegram получает 503 и повторит
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+LATENCY_WINDOW = 2000
+
+UpdateHandler = Callable[[dict], Awaitable[Any]]
+
+
+def update_chat_key(data: dict) -> int:
+    """
+    Ключ упорядочивания: id чата (или пользователя) из сырого обновления.
+
+    Обновления одного чата всегда попадают к одному воркеру, поэтому
+    обрабатываются в порядке поступления.
+    """
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in data:
+            return data[field]["chat"]["id"]
+    callback = data.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        if message:
+            return message["chat"]["id"]
+        return callback["from"]["id"]
+    for field in ("my_chat_member", "chat_member", "chat_join_request"):
+        if field in data:
+            return data[field]["chat"]["id"]
+    for field in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        if field in data:
+            return data[field]["from"]["id"]
+    return data.get("update_id", 0)
+
+
+def _percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+
+class UpdateQueue:
+    """
+    Шардированная очередь обновлений.
+
+    workers очередей, у каждой своя задача-воркер; обновление попадает в
+    очередь по update_chat_key, так что разные чаты обрабатываются
+    параллельно, а один чат — строго по порядку. Медленный обработчик
+    (например, долгий запрос к API) задерживает только свой чат
+    и не держит HTTP-запрос Telegram.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._handler: Optional[UpdateHandler] = None
+        self._wait: deque = deque(maxlen=LATENCY_WINDOW)
+        self._handle: deque = deque(maxlen=LATENCY_WINDOW)
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def submit(self, data: dict) -> bool:
+        """
+        Поставить сырое обновление в очередь.
+
+        Returns:
+            bool: False, если очередь чата переполнена (ответить 503)
+        """
+        queue = self._queues[update_chat_key(data) % self.workers]
+        try:
+            queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            enqueued_at, data = item
+            started = time.monotonic()
+            self._wait.append(started - enqueued_at)
+            try:
+                await self._handler(data)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+            self._handle.append(time.monotonic() - started)
+            self.processed += 1
+
+    def start(self, handler: UpdateHandler) -> None:
+        """Запустить воркеры с обработчиком сырого обновления."""
+        if self.running:
+            return
+        self._handler = handler
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def close(self) -> None:
+        """Дообработать очередь и остановить воркеры."""
+        if not self.running:
+            return
+        for queue in self._queues:
+            # Маркер остановки встаёт после уже принятых обновлений
+            await queue.put(None)
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    def metrics(self) -> Dict[str, Any]:
+        """Глубина очередей и задержки (ожидание в очереди и обработка), мс."""
+        depths = [q.qsize() for q in self._queues]
+        wait = list(self._wait)
+        handle = list(self._handle)
+        return {
+            "mode": WEBHOOK_MODE,
+            "workers": self.workers,
+            "queue_depth": sum(depths),
+            "max_shard_depth": max(depths, default=0),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "errors": self.errors,
+            "wait_p50_ms": _percentile(wait, 0.50),
+            "wait_p99_ms": _percentile(wait, 0.99),
+            "handle_p50_ms": _percentile(handle, 0.50),
+            "handle_p99_ms": _percentile(handle, 0.99),
+        }
+
+
+# Единый экземпляр на процесс
+update_queue = UpdateQueue()